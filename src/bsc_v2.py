@@ -66,30 +66,93 @@ except ValueError as error:
     exit(1)
 from gi.repository import Nautilus as FileManager
 from gi.repository import GObject
-from gi.repository import GExiv2
-
-import urllib
-# for id3 support
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MPEGInfo
-# for reading image dimensions
-from PIL import Image
-# for reading pdf
-from PyPDF2 import PdfFileReader
-# for reading videos. for future improvement, this can also read mp3!
-from plumbum import local
-from plumbum import CommandNotFound
+from gi.repository import GLib
+from gi.repository import Gio
+
+import urllib.parse
+# GExiv2 (image tags), mutagen (audio tags), PIL (image dimensions), PyPDF2 (pdf) and plumbum (mediainfo) are only
+# imported by the extractors that use them. Nautilus loads this extension in every process, also the ones that never
+# show a list view, so these imports should not slow down its start-up.
 # locale
 import sys
 import os
+import errno
 import json
 import math
 import locale
 import gettext
+import argparse
+# for extracting in the background
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+# for limiting the parsers
+import multiprocessing
+import resource
+import shutil
+# for caching extracted metadata
+import sqlite3
+import subprocess
+import time
+# for reading media container headers
+import struct
+import hashlib
+import uuid
+# for instrumentation
+import bisect
+import heapq
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from types import MappingProxyType
 
 APP = 'nautilus-columns'
 ROOTDIR = '/usr/share/'
 LANGDIR = os.path.join(ROOTDIR, 'locale-langpack')
+# Number of worker threads extracting metadata in the background. Most of the time they are waiting for disk or
+# mediainfo, so there can be more than CPUs.
+WORKERS = int(os.environ.get('NAUTILUS_COLUMNS_WORKERS', 16))
+# Files of the same directory requested within this window (in seconds) are analysed by a single mediainfo process.
+BATCH_WINDOW = float(os.environ.get('NAUTILUS_COLUMNS_BATCH_WINDOW', 0.05))
+BATCH_SIZE = int(os.environ.get('NAUTILUS_COLUMNS_BATCH_SIZE', 64))
+# 'auto' reads the headers of known containers in-process and only runs mediainfo for the others, 'mediainfo' always
+# runs mediainfo.
+MEDIA_BACKEND = os.environ.get('NAUTILUS_COLUMNS_MEDIA_BACKEND', 'auto')
+# Read at most this number of KB of image and PDF headers, set to 0 to let PIL, GExiv2 and PyPDF2 read the files.
+READ_BUDGET = int(os.environ.get('NAUTILUS_COLUMNS_READ_BUDGET', 256)) * 1024
+# Record timing and errors per extractor, log them and write them to this JSON file every STATS_INTERVAL seconds. Use
+# '-' to only log them.
+STATS_PATH = os.environ.get('NAUTILUS_COLUMNS_STATS')
+STATS_INTERVAL = int(os.environ.get('NAUTILUS_COLUMNS_STATS_INTERVAL', 60))
+# Only extract the columns that are visible in the list view of Nautilus, set to 0 to always extract all columns.
+VISIBLE_ONLY = os.environ.get('NAUTILUS_COLUMNS_VISIBLE_ONLY', '1') != '0'
+# Show the columns of the fast extractors (tags, image headers) first, and the ones of the slow extractors (container
+# analysis, pdf page tree) when they are ready. Set to 0 to show all columns of a file at once.
+PROGRESSIVE = os.environ.get('NAUTILUS_COLUMNS_PROGRESSIVE', '1') != '0'
+# Abandon an extractor when it did not finish a file within this number of seconds, set to 0 to wait forever. Files of
+# which an extractor timed out or failed are not tried again for FAILURE_RETRY seconds, unless they change.
+TIMEOUT = float(os.environ.get('NAUTILUS_COLUMNS_TIMEOUT', 10))
+FAILURE_RETRY = int(os.environ.get('NAUTILUS_COLUMNS_FAILURE_RETRY', 24 * 3600))
+# Maximum address space in MB of the processes parsing files: mediainfo, the parser processes and the pre-warm workers.
+# Set to 0 to not limit them.
+MEMORY_LIMIT = int(os.environ.get('NAUTILUS_COLUMNS_MEMORY_LIMIT', 1024)) * 1024 * 1024
+# Number of processes running the parsers that read whole files (PyPDF2, GExiv2 and PIL) for Nautilus, so they are
+# limited in memory and killed when they time out. Set to 0 to run them within Nautilus.
+PARSER_WORKERS = int(os.environ.get('NAUTILUS_COLUMNS_PARSER_WORKERS', 2))
+# Persistent cache of the extracted metadata, set the size to 0 to disable it.
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), APP)
+CACHE_SIZE = int(os.environ.get('NAUTILUS_COLUMNS_CACHE_SIZE', 200000))
+# Maximum number of files extracted at the same time per mount, by kind of filesystem or by mount point, e.g.
+# 'network=2,rotational=1,/media/nas=8'. Mounts back off to fewer files when their latency rises.
+CONCURRENCY = os.environ.get('NAUTILUS_COLUMNS_CONCURRENCY', f'local={WORKERS},rotational=2,network=4')
+# Number of files of which the column values are also kept in memory, for files Nautilus asks for again shortly after.
+MEMORY_CACHE_SIZE = int(os.environ.get('NAUTILUS_COLUMNS_MEMORY_CACHE_SIZE', 10000))
+# Also store the extracted metadata in an extended attribute of the file, so other machines showing the same file,
+# e.g. on a NAS, do not have to extract it again. Set to 1 to enable it.
+XATTRS = os.environ.get('NAUTILUS_COLUMNS_XATTRS', '0') == '1'
+# Number of KB hashed from the start and the end of a file for its fingerprint, files with the same size, mime type and
+# fingerprint reuse the cached metadata of each other instead of being extracted again. Set to 0 to disable it.
+FINGERPRINT_SIZE = int(os.environ.get('NAUTILUS_COLUMNS_FINGERPRINT_SIZE', 4)) * 1024
 
 try:
     current_locale, encoding = locale.getdefaultlocale()
@@ -108,15 +171,16 @@ RESOLUTION_UNIT = {
     '2' : 'Inch',
     '3' : 'Centimeter'
 }
+# The values of GExiv2.Orientation, which equal the EXIF orientation tag.
 ORIENTATION = {
-    GExiv2.Orientation.NORMAL : 'Normal',
-    GExiv2.Orientation.HFLIP : 'Flipped',
-    GExiv2.Orientation.VFLIP : 'Flipped',
-    GExiv2.Orientation.ROT_90_HFLIP : 'Flipped',
-    GExiv2.Orientation.ROT_90_VFLIP : 'Flipped',
-    GExiv2.Orientation.ROT_90 : '90º',
-    GExiv2.Orientation.ROT_180 : '180º',
-    GExiv2.Orientation.ROT_270 : '270º',
+    1 : 'Normal',     # NORMAL
+    2 : 'Flipped',    # HFLIP
+    4 : 'Flipped',    # VFLIP
+    5 : 'Flipped',    # ROT_90_HFLIP
+    7 : 'Flipped',    # ROT_90_VFLIP
+    6 : '90º',        # ROT_90
+    3 : '180º',       # ROT_180
+    8 : '270º',       # ROT_270
 }
 METERING_MODE = {
     '1' : 'Average',
@@ -172,55 +236,106 @@ FLASH = {
     '32': 'No flash function',
     '64': 'Red eye reduction mode',
 }
+# The type of a column is used by the metadata index, see `index_value`. Columns without a type are text.
 COLUMN_DEFINITIONS = [
     # Media
     { 'name' : 'title', 'label': 'Title', 'description': 'Song title'},
     { 'name' : 'album', 'label': 'Album', 'description': 'Album'},
     { 'name' : 'artist', 'label': 'Artist', 'description': 'Artist'},
-    { 'name' : 'tracknumber', 'label': 'Track', 'description': 'Track number'},
+    { 'name' : 'tracknumber', 'label': 'Track', 'description': 'Track number', 'type': 'integer'},
     { 'name' : 'genre', 'label': 'Genre', 'description': 'Genre'},
     { 'name' : 'date', 'label': 'Date', 'description': 'Date'},
-    { 'name' : 'bitrate', 'label': 'Bitrate', 'description': 'Audio Bitrate in kilo bits per second'},
-    { 'name' : 'samplerate', 'label': 'Sample rate', 'description': 'Sample rate in Hz'},
-    { 'name' : 'length', 'label': 'Length', 'description': 'Length of audio'},
+    { 'name' : 'bitrate', 'label': 'Bitrate', 'description': 'Audio Bitrate in kilo bits per second', 'type': 'integer'},
+    { 'name' : 'samplerate', 'label': 'Sample rate', 'description': 'Sample rate in Hz', 'type': 'integer'},
+    { 'name' : 'length', 'label': 'Length', 'description': 'Length of audio', 'type': 'seconds'},
     # Images
-    { 'name' : 'exposure_time', 'label': 'Exposure time', 'description': 'Exposure time in seconds'},
-    { 'name' : 'fnumber', 'label': 'F number', 'description': 'Exposure F number'},
-    { 'name' : 'focal_length', 'label': 'Focal length', 'description': 'The actual focal length of the lens, in mm.'},
-    { 'name' : 'gps_altitude', 'label': 'Altitude', 'description': 'GPS Altitude'},
-    { 'name' : 'gps_latitude', 'label': 'Latitude', 'description': 'GPS Latitude'},
-    { 'name' : 'gps_longitude', 'label': 'Longitude', 'description': 'GPS Longitude'},
-    { 'name' : 'iso_speed', 'label': 'ISO', 'description': 'ISO Speed'},
+    { 'name' : 'exposure_time', 'label': 'Exposure time', 'description': 'Exposure time in seconds', 'type': 'number'},
+    { 'name' : 'fnumber', 'label': 'F number', 'description': 'Exposure F number', 'type': 'number'},
+    { 'name' : 'focal_length', 'label': 'Focal length', 'description': 'The actual focal length of the lens, in mm.', 'type': 'number'},
+    { 'name' : 'gps_altitude', 'label': 'Altitude', 'description': 'GPS Altitude', 'type': 'number'},
+    { 'name' : 'gps_latitude', 'label': 'Latitude', 'description': 'GPS Latitude', 'type': 'number'},
+    { 'name' : 'gps_longitude', 'label': 'Longitude', 'description': 'GPS Longitude', 'type': 'number'},
+    { 'name' : 'iso_speed', 'label': 'ISO', 'description': 'ISO Speed', 'type': 'integer'},
     { 'name' : 'orientation', 'label': 'Orientation', 'description': 'Orientation'},
     { 'name' : 'model', 'label': 'Model', 'description': 'Model'},
     { 'name' : 'resolution_unit', 'label': 'Resolution unit', 'description': 'The unit for measuring'},
-    { 'name' : 'xresolution', 'label': 'X resolution', 'description': 'The resolution in the x axis'},
-    { 'name' : 'yresolution', 'label': 'Y resolution', 'description': 'The resolution in the y axis'},
+    { 'name' : 'xresolution', 'label': 'X resolution', 'description': 'The resolution in the x axis', 'type': 'number'},
+    { 'name' : 'yresolution', 'label': 'Y resolution', 'description': 'The resolution in the y axis', 'type': 'number'},
     { 'name' : 'datetime_original', 'label': 'Capture date', 'description': 'Photo capture date'},
-    { 'name' : 'shutter_speed_value', 'label': 'Shutter speed', 'description': 'Shutter speed'},
-    { 'name' : 'aperture_value', 'label': 'Aperture', 'description': 'The lens aperture'},
-    { 'name' : 'brightness_value', 'label': 'Brightness', 'description': 'Brightness'},
-    { 'name' : 'exposure_bias_value', 'label': 'Exposure', 'description': 'The exposure bias'},
-    { 'name' : 'max_aperture_value', 'label': 'Max aperture', 'description': 'The smallest F number of the lens'},
+    { 'name' : 'shutter_speed_value', 'label': 'Shutter speed', 'description': 'Shutter speed', 'type': 'number'},
+    { 'name' : 'aperture_value', 'label': 'Aperture', 'description': 'The lens aperture', 'type': 'number'},
+    { 'name' : 'brightness_value', 'label': 'Brightness', 'description': 'Brightness', 'type': 'number'},
+    { 'name' : 'exposure_bias_value', 'label': 'Exposure', 'description': 'The exposure bias', 'type': 'number'},
+    { 'name' : 'max_aperture_value', 'label': 'Max aperture', 'description': 'The smallest F number of the lens', 'type': 'number'},
     { 'name' : 'metering_mode', 'label': 'Metering mode', 'description': 'The metering mode'},
     { 'name' : 'light_source', 'label': 'Light source', 'description': 'The kind of light source'},
     { 'name' : 'flash', 'label': 'Flash', 'description': 'Indicates the status of flash when the image was shot'},
     { 'name' : 'exposure_mode', 'label': 'Exposure mode', 'description': 'The exposure mode set when the image was shot'},
     { 'name' : 'gain_control', 'label': 'Gain control', 'description': 'The degree of overall image gain adjustment'},
-    { 'name' : 'width', 'label': 'Width', 'description': 'Image/video/pdf width (pixel/mm)'},
-    { 'name' : 'height', 'label': 'Height', 'description': 'Image/video/pdf height (pixel/mm)'},
-    { 'name' : 'pages', 'label': 'Pages', 'description': 'Number of pages'},
+    { 'name' : 'width', 'label': 'Width', 'description': 'Image/video/pdf width (pixel/mm)', 'type': 'integer'},
+    { 'name' : 'height', 'label': 'Height', 'description': 'Image/video/pdf height (pixel/mm)', 'type': 'integer'},
+    { 'name' : 'pages', 'label': 'Pages', 'description': 'Number of pages', 'type': 'integer'},
     { 'name' : 'usercomment', 'label': 'UserComment', 'description': 'Comment of the user'},
-    { 'name' : 'duration', 'label': 'Duration', 'description': 'Duration of the media file'},
+    { 'name' : 'duration', 'label': 'Duration', 'description': 'Duration of the media file', 'type': 'seconds'},
     { 'name' : 'format', 'label': 'Format', 'description': 'Format of the media file'},
-    { 'name' : 'overall_bitrate', 'label': 'Overall ', 'description': 'Overall bitrate of the media file'},
-    { 'name' : 'frame_count', 'label': 'Frame count', 'description': 'Number of frames in video file'},
+    { 'name' : 'overall_bitrate', 'label': 'Overall ', 'description': 'Overall bitrate of the media file', 'type': 'integer'},
+    { 'name' : 'frame_count', 'label': 'Frame count', 'description': 'Number of frames in video file', 'type': 'integer'},
     { 'name' : 'video_format', 'label': 'Video format', 'description': 'Format of the video'},
-    { 'name' : 'bit_depth', 'label': 'Bit depth', 'description': 'Bit depth of the media file'},
+    { 'name' : 'bit_depth', 'label': 'Bit depth', 'description': 'Bit depth of the media file', 'type': 'integer'},
     { 'name' : 'audio_format', 'label': 'Audio format', 'description': 'Format of the audio'},
     { 'name' : 'sharpness', 'label': 'Sharpness', 'description': 'Sharpness of subject in image file'},
 ]
 
+# The names of all columns, to check mapped fields against.
+COLUMN_NAMES = frozenset(column['name'] for column in COLUMN_DEFINITIONS)
+# The names of all columns in order, and the index of every column within them, see ColumnValues.
+COLUMN_ORDER = tuple(column['name'] for column in COLUMN_DEFINITIONS)
+COLUMN_INDEX = {name: index for index, name in enumerate(COLUMN_ORDER)}
+# Columns with few distinct values, these values are shared by all files instead of stored for every file.
+INTERNED_COLUMNS = frozenset(['album', 'artist', 'genre', 'date', 'bitrate', 'samplerate', 'length', 'exposure_mode',
+                              'flash', 'gain_control', 'iso_speed', 'light_source', 'metering_mode', 'model',
+                              'orientation', 'resolution_unit', 'xresolution', 'yresolution', 'fnumber',
+                              'focal_length', 'exposure_time', 'format', 'duration', 'video_format', 'audio_format',
+                              'bit_depth', 'width', 'height', 'pages'])
+# The types of the columns in the metadata index, and the SQLite column type they are stored as.
+COLUMN_TYPES = {column['name']: column.get('type', 'text') for column in COLUMN_DEFINITIONS}
+INDEX_AFFINITY = {'text': 'TEXT', 'integer': 'INTEGER', 'number': 'REAL', 'seconds': 'REAL'}
+# The first number within a value, possibly a rational like 1/320, and the first integer, e.g. 3 of track 3/12.
+NUMBER = re.compile(r'[-+]?\d+(?:\.\d*)?(?:/[-+]?\d+(?:\.\d*)?)?')
+INTEGER = re.compile(r'[-+]?\d+')
+
+
+def index_value(field, value):
+    """
+    Convert a column value to the typed value stored in the metadata index: seconds for 'seconds' columns like
+    '00:03:25', the leading integer for 'integer' columns like '128 Kbps' or '3/12', the number for 'number' columns
+    like '1/320', the value itself for text.
+
+    :return: the typed value, or None for empty values, errors and values without a number.
+    """
+    if value is None or value == '' or value == _('Error'):
+        return None
+    kind = COLUMN_TYPES.get(field, 'text')
+    if kind == 'text':
+        return value
+    try:
+        if kind == 'seconds' and ':' in value:
+            seconds = 0.0
+            for part in value.split(':'):
+                seconds = seconds * 60 + float(part)
+            return seconds
+        if kind == 'integer':
+            match = INTEGER.search(value)
+            return int(match.group()) if match is not None else None
+        match = NUMBER.search(value)
+        if match is None:
+            return None
+        numerator, _slash, denominator = match.group().partition('/')
+        return float(numerator) / float(denominator) if denominator else float(numerator)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
 def convert(dict, value):
     return dict.get(value, 'Unknown')
 
@@ -237,7 +352,7 @@ def map_exif(file, metadata, field, tag=None, c=lambda v:v, f=lambda m,t:m.get_t
     map_any(file, metadata, field, f=lambda m: f(m, tag), c=c)
 
 def map_audio(file, audio, field):
-    map_any(file, audio, field, f=lambda a:a.get(field, [''])[0])
+    map_any(file, audio, field, f=lambda a: audio_tag(a, AUDIO_TAGS[field]))
 
 def map_mediainfo(file, metadata, field, tag, c=lambda v:v):
     map_any(file, metadata, field, f=lambda m:m.get(tag), c=c)
@@ -256,44 +371,260 @@ def map_any(file, info_element, field,  f, c=lambda v:v):
     :return: nothing
     """
     try:
-        if field not in [c['name'] for c in COLUMN_DEFINITIONS]:
+        if field not in COLUMN_NAMES:
             print(f"WARNING! Setting attribute for {field}, but there is no corresponding Column defined.")
         value = f(info_element)
         if value is not None:
             convertedValue = c(value)
             file.add_string_attribute(field, _(str(convertedValue)))
     except Exception:
+        file.errors += 1
         file.add_string_attribute(field, _('Error'))
 
 
+class ExtractionStats:
+    """
+    ExtractionStats records per extractor the number of calls, the latency, the bytes read and the number of
+    exceptions, together with the slowest files, so pathological files can be found:
+        stats = ExtractionStats(enabled=True)
+        stats.record('image', filename, seconds, bytes_read, errors)
+        stats.dump('/tmp/nautilus-columns-stats.json')
+    Other events, like cache hits, are counted with `increment`. Nothing is recorded when it is not enabled.
+    """
+
+    # Upper bounds, in seconds, of the latency histogram buckets. The last bucket holds the slower calls.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    # Number of slowest files kept per extractor.
+    SLOWEST = 10
+    # The hit rates reported, from their hit and miss counters.
+    HIT_RATES = {'memory': ('memory_hits', 'memory_misses'), 'cache': ('cache_hits', 'cache_misses'),
+                 'dedupe': ('dedupe_hits', 'dedupe_misses')}
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.extractors = {}
+        self.counters = {}
+
+    def record(self, name, filename, seconds, bytes_read=0, errors=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.extractors.get(name)
+            if entry is None:
+                entry = self.extractors[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes_read': 0,
+                                                 'errors': 0, 'histogram': [0] * (len(self.BUCKETS) + 1),
+                                                 'slowest': []}
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['bytes_read'] += bytes_read
+            entry['errors'] += errors
+            entry['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            slowest = entry['slowest']
+            if len(slowest) < self.SLOWEST or seconds > slowest[-1][0]:
+                slowest.append((seconds, filename))
+                slowest.sort(reverse=True)
+                del slowest[self.SLOWEST:]
+
+    def increment(self, counter, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'updated': time.time(),
+                'buckets': list(self.BUCKETS),
+                'extractors': {name: {**entry, 'slowest': [{'seconds': seconds, 'file': filename}
+                                                           for seconds, filename in entry['slowest']]}
+                               for name, entry in self.extractors.items()},
+                'counters': dict(self.counters),
+                'hit_rates': self.hit_rates(),
+            }
+
+    def hit_rates(self):
+        """
+        The fraction of hits of the HIT_RATES that were counted. The caller must hold the lock.
+        """
+        rates = {}
+        for name, (hits, misses) in self.HIT_RATES.items():
+            total = self.counters.get(hits, 0) + self.counters.get(misses, 0)
+            if total:
+                rates[name] = self.counters.get(hits, 0) / total
+        return rates
+
+    def dump(self, path):
+        # Write to a temporary file first, so readers never see a partial file.
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temporary, path)
+
+    def log_line(self):
+        snapshot = self.snapshot()
+        parts = [f"{name}: {entry['calls']} calls, {entry['seconds'] / entry['calls'] * 1000:.1f} ms avg, "
+                 f"{entry['max_seconds'] * 1000:.1f} ms max, {entry['bytes_read']} bytes, {entry['errors']} errors"
+                 for name, entry in sorted(snapshot['extractors'].items())]
+        parts += [f'{counter}: {value}' for counter, value in sorted(snapshot['counters'].items())]
+        parts += [f'{name} hit rate: {rate:.1%}' for name, rate in sorted(snapshot['hit_rates'].items())]
+        return f'{APP} stats; ' + '; '.join(parts)
+
+
+stats = ExtractionStats(enabled=bool(STATS_PATH))
+
+
+def limit_memory(pid=0):
+    """
+    Limit the address space of a process, the current one by default, to MEMORY_LIMIT. Used for the processes that
+    parse files, so a pathological file makes the parser fail instead of exhausting the memory of the machine.
+    """
+    if MEMORY_LIMIT > 0:
+        resource.prlimit(pid, resource.RLIMIT_AS, (MEMORY_LIMIT, MEMORY_LIMIT))
+
+
+def init_parser_process():
+    """
+    Set up a process that parses files, a worker of ParserPool or Prewarmer: limit its memory, and run the parsers
+    within the process, as it is limited already.
+    """
+    limit_memory()
+    parser_pool.workers = 0
+
+
+def parser_context():
+    """
+    The multiprocessing context of the parser processes. They are spawned, as forking Nautilus with its threads could
+    deadlock the child. Nautilus embeds Python, so its sys.executable may not be a Python interpreter.
+    """
+    context = multiprocessing.get_context('spawn')
+    if not os.path.basename(sys.executable).startswith('python'):
+        context.set_executable(shutil.which('python3') or '/usr/bin/python3')
+    return context
+
+
+class ParserPool:
+    """
+    ParserPool runs the parsers that read whole files, like PyPDF2, GExiv2 and PIL, in a few processes of which the
+    memory is limited, instead of within Nautilus:
+        values = parser_pool.run(extract_pdf_file, filename)
+    A parser that does not finish within TIMEOUT is killed with the processes of the pool. Without workers, e.g. within
+    the pre-warm workers, the parsers run in the calling process.
+    """
+
+    def __init__(self, workers=PARSER_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+        # The pool breaks when a process crashes or is killed for the timeout of another file, the file is parsed once
+        # more in a new pool then.
+        for attempt in range(2):
+            executor = self.start()
+            try:
+                future = executor.submit(function, *args)
+                return future.result(TIMEOUT or None)
+            except FutureTimeoutError:
+                if not future.cancel():
+                    # The parser is running, a process cannot stop a single call.
+                    self.kill(executor)
+                raise ExtractionTimeout(f'{function.__name__} did not finish within {TIMEOUT} s') from None
+            except BrokenProcessPool:
+                self.kill(executor)
+                if attempt:
+                    raise
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=parser_context(),
+                                                    initializer=init_parser_process)
+            return self.executor
+
+    def kill(self, executor):
+        with self.lock:
+            if self.executor is not executor:
+                # Killed already by another file.
+                return
+            self.executor = None
+        stats.increment('parser_pool_kills')
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+parser_pool = ParserPool()
+
+
 class MediaInfo:
     """
     MediaInfo extracts the mediainfo values into a single dict:
         metadata = MediaInfo('multimedia-file.mov')
     Elements can be extracted using `get`.
     Available elements can be retrieved using 'keys'.
+    When the mediainfo output of the file is already available, e.g. from a batch, it can be passed as `media`.
     """
 
-    def __init__(self, path_to_video):
+    def __init__(self, path_to_video, media=None):
         self.path_to_video = path_to_video
+        self.merged_data = {}
+
+        if media is None:
+            if not os.path.isfile(path_to_video):
+                return
+            media = self.run([path_to_video])[0]
+
+        # Merge all metadata to one dict.
+        for metadata in media['media']['track']:
+            # Avoid that Format is overwritten, this is the only key that occurs within the different tracks.
+            if metadata['@type'] == 'Video':
+                self.merged_data['VideoFormat'] = metadata.get('Format', _('Unknown'))
+            elif metadata['@type'] == 'Audio':
+                self.merged_data['AudioFormat'] = metadata.get('Format', _('Unknown'))
+            self.merged_data = {**metadata, **self.merged_data}
+
+    @staticmethod
+    def run(paths):
+        """
+        Run mediainfo once for all paths. mediainfo is killed after TIMEOUT seconds, for all paths together.
+
+        :param paths: the files to analyse.
+        :return: a list with the parsed mediainfo output of every file.
+        """
+        from plumbum import local, CommandNotFound
 
         try:
             mediainfo = local['mediainfo']
         except CommandNotFound:
             raise IOError('mediainfo not found.')
 
-        if os.path.isfile(path_to_video):
-            options = ['--Output=JSON', '-f', path_to_video]
-            data = json.loads(mediainfo(options))
-            self.merged_data = {}
-            # Merge all metadata to one dict.
-            for metadata in data['media']['track']:
-                # Avoid that Format is overwritten, this is the only key that occurs within the different tracks.
-                if metadata['@type'] == 'Video':
-                    self.merged_data['VideoFormat'] = metadata.get('Format', _('Unknown'))
-                elif metadata['@type'] == 'Audio':
-                    self.merged_data['AudioFormat'] = metadata.get('Format', _('Unknown'))
-                self.merged_data = {**metadata, **self.merged_data}
+        stats.increment('mediainfo_processes')
+        process = mediainfo.popen(['--Output=JSON', '-f', *paths])
+        # The limit is set on the started process, a preexec_fn is not safe in a process with threads.
+        try:
+            limit_memory(process.pid)
+        except OSError:
+            # mediainfo exited already.
+            pass
+        # mediainfo is killed when it hangs on a corrupt file, see MediaInfoBatcher.resolve for the files of a batch.
+        try:
+            output, errors = process.communicate(timeout=TIMEOUT or None)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise IOError(f'mediainfo did not finish within {TIMEOUT} s.') from None
+        if process.returncode != 0:
+            raise IOError(f'mediainfo failed with exit code {process.returncode}.')
+        data = json.loads(output)
+        # mediainfo only returns a list when it analysed multiple files.
+        return data if isinstance(data, list) else [data]
 
     def get(self, key):
         return self.merged_data.get(key, '')
@@ -302,150 +633,2895 @@ class MediaInfo:
         return list(self.merged_data.keys())
 
 
-class ColumnExtension(GObject.GObject,
-                      FileManager.ColumnProvider,
-                      FileManager.InfoProvider):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class MediaInfoBatcher:
+    """
+    MediaInfoBatcher collects the files of the same directory that are requested within a short window, and resolves
+    them with a single mediainfo process, because starting mediainfo is the most expensive part for short clips:
+        batcher = MediaInfoBatcher()
+        metadata = batcher.get('multimedia-file.mov')
+    `get` blocks until the batch of the file has been resolved, so it should be called from a worker thread.
+    """
 
-    def get_columns(self):
-        return [self.jsonToColumn(column) for column in COLUMN_DEFINITIONS]
+    def __init__(self, window=BATCH_WINDOW, max_size=BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Maps a directory to the batch that is still collecting files, a batch maps each filename to its future.
+        self.batches = {}
+
+    def get(self, filename):
+        if self.window <= 0:
+            return MediaInfo(filename)
+        return self.submit(filename).result()
+
+    def submit(self, filename):
+        filename = os.path.abspath(filename)
+        directory = os.path.dirname(filename)
+        full = None
+        with self.lock:
+            batch = self.batches.get(directory)
+            if batch is None:
+                batch = self.batches[directory] = {}
+                timer = threading.Timer(self.window, self.flush, (directory, batch))
+                timer.daemon = True
+                timer.start()
+            future = batch.setdefault(filename, Future())
+            if len(batch) >= self.max_size:
+                full = self.batches.pop(directory)
+        if full is not None:
+            self.resolve(full)
+        return future
+
+    def flush(self, directory, batch):
+        with self.lock:
+            if self.batches.get(directory) is not batch:
+                # Already resolved because the batch was full.
+                return
+            del self.batches[directory]
+        self.resolve(batch)
 
     @staticmethod
-    def jsonToColumn(dict):
-        name = dict.get('name')
-        return FileManager.Column(name=f'NautilusPython::{name}_column',
-                                  attribute=name,
-                                  label=_(dict.get('label')),
-                                  description=_(dict.get('description')))
+    def resolve(batch):
+        """
+        Resolve the futures of a batch. When mediainfo fails on a batch, e.g. because one corrupt file made it time
+        out, the files are analysed again one by one, so only the files mediainfo fails on by themselves fail. The
+        files are analysed again in parallel, so a file waits at most twice TIMEOUT for its batch and its retry.
+        """
+        try:
+            filenames = [filename for filename in batch if os.path.isfile(filename)]
+            results = MediaInfo.run(filenames) if filenames else []
+            media_by_ref = {media['media']['@ref']: media for media in results if media.get('media')}
+            for filename, future in batch.items():
+                if filename in media_by_ref:
+                    future.set_result(MediaInfo(filename, media_by_ref[filename]))
+                elif os.path.isfile(filename):
+                    future.set_exception(IOError(f'mediainfo could not analyse {filename}.'))
+                else:
+                    future.set_result(MediaInfo(filename))
+        except Exception as error:
+            pending = {filename: future for filename, future in batch.items() if not future.done()}
+            if len(pending) > 1:
+                stats.increment('mediainfo_batch_retries')
+                for filename, future in pending.items():
+                    threading.Thread(target=MediaInfoBatcher.resolve, args=({filename: future},),
+                                     name=f'{APP}-mediainfo', daemon=True).start()
+            else:
+                for future in pending.values():
+                    future.set_exception(error)
 
-    def update_file_info(self, file, **kwargs):
-        if file.get_uri_scheme() != 'file':
+
+mediainfo_batcher = MediaInfoBatcher()
+
+
+###########################
+# media container headers #
+###########################
+# The parsers below read only the container headers of the most common formats and return the few fields the columns
+# need, shaped like the output of mediainfo, so MediaInfo can merge them the same way. A parser returns None when it
+# does not understand the file, mediainfo is used for those files.
+
+# Headers larger than this are not read in-process.
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+MP4_VIDEO_FORMATS = {
+    b'avc1': 'AVC', b'avc3': 'AVC', b'hvc1': 'HEVC', b'hev1': 'HEVC', b'mp4v': 'MPEG-4 Visual', b'av01': 'AV1',
+    b'vp08': 'VP8', b'vp09': 'VP9', b'jpeg': 'JPEG', b'mjp2': 'Motion JPEG 2000', b's263': 'H.263',
+    b'apcn': 'ProRes', b'apch': 'ProRes', b'apcs': 'ProRes', b'apco': 'ProRes', b'ap4h': 'ProRes',
+}
+MP4_AUDIO_FORMATS = {
+    b'mp4a': 'AAC', b'ac-3': 'AC-3', b'ec-3': 'E-AC-3', b'alac': 'ALAC', b'Opus': 'Opus', b'fLaC': 'FLAC',
+    b'samr': 'AMR', b'lpcm': 'PCM', b'sowt': 'PCM', b'twos': 'PCM', b'ipcm': 'PCM', b'.mp3': 'MPEG Audio',
+}
+# Audio formats of which the bit depth is reported, lossy formats have no bit depth.
+LOSSLESS_AUDIO_FORMATS = ('PCM', 'ALAC', 'FLAC')
+# MPEG-4 object types within the esds box that are not AAC.
+MP4_OBJECT_TYPES = {0x69: 'MPEG Audio', 0x6B: 'MPEG Audio', 0xA5: 'AC-3', 0xA6: 'E-AC-3', 0xAD: 'Opus'}
+MATROSKA_CODECS = {
+    'V_MPEG4/ISO/AVC': 'AVC', 'V_MPEGH/ISO/HEVC': 'HEVC', 'V_MPEG4/ISO/ASP': 'MPEG-4 Visual', 'V_MPEG2': 'MPEG Video',
+    'V_VP8': 'VP8', 'V_VP9': 'VP9', 'V_AV1': 'AV1', 'V_THEORA': 'Theora', 'V_MS/VFW/FOURCC': 'VfW',
+    'A_AAC': 'AAC', 'A_AC3': 'AC-3', 'A_EAC3': 'E-AC-3', 'A_DTS': 'DTS', 'A_OPUS': 'Opus', 'A_VORBIS': 'Vorbis',
+    'A_FLAC': 'FLAC', 'A_MPEG/L3': 'MPEG Audio', 'A_MPEG/L2': 'MPEG Audio', 'A_PCM/INT/LIT': 'PCM',
+    'A_PCM/INT/BIG': 'PCM', 'A_PCM/FLOAT/IEEE': 'PCM', 'A_TRUEHD': 'MLP FBA',
+}
+WAVE_FORMATS = {0x0001: 'PCM', 0x0003: 'PCM', 0xFFFE: 'PCM', 0x0002: 'ADPCM', 0x0011: 'ADPCM', 0x0055: 'MPEG Audio'}
+ASF_AUDIO_FORMATS = {0x0160: 'WMA', 0x0161: 'WMA', 0x0162: 'WMA', 0x0163: 'WMA', 0x000A: 'WMA',
+                     0x0001: 'PCM', 0x0055: 'MPEG Audio', 0x2000: 'AC-3'}
+ASF_VIDEO_FORMATS = {b'WMV1': 'WMV1', b'WMV2': 'WMV2', b'WMV3': 'VC-1', b'WVC1': 'VC-1', b'WMVA': 'VC-1',
+                     b'MP43': 'MPEG-4 Visual', b'MP4S': 'MPEG-4 Visual', b'M4S2': 'MPEG-4 Visual'}
+ASF_HEADER = uuid.UUID('75b22630-668e-11cf-a6d9-00aa0062ce6c')
+ASF_FILE_PROPERTIES = uuid.UUID('8cabdca1-a947-11cf-8ee4-00c00c205365')
+ASF_STREAM_PROPERTIES = uuid.UUID('b7dc0791-a9b7-11cf-8ee6-00c00c205365')
+ASF_AUDIO_MEDIA = uuid.UUID('f8699e40-5b4d-11cf-a8fd-00805f5c442b')
+ASF_VIDEO_MEDIA = uuid.UUID('bc19efc0-5b4d-11cf-a8fd-00805f5c442b')
+
+
+class MalformedHeader(ValueError):
+    """
+    A container header that cannot be valid, e.g. with an element that would never end. The file is corrupt, and
+    not left to mediainfo.
+    """
+
+
+def media_tracks(filename, general, tracks, file_size):
+    """
+    Build a mediainfo-like dict from the general fields and the video/audio tracks. The overall bitrate is derived
+    from the file size and duration, like mediainfo does.
+    """
+    duration = general.pop('duration', 0)
+    if duration <= 0:
+        return None
+    general['Duration'] = f'{duration:.3f}'
+    general['OverallBitRate'] = str(int(round(file_size * 8 / duration)))
+    return {'media': {'@ref': filename,
+                      'track': [{'@type': 'General', **general}] +
+                               [{k: str(v) for k, v in track.items()} for track in tracks]}}
+
+
+def read_mp4_boxes(data, offset=0, end=None):
+    """
+    Iterate over the (type, payload) of the ISO base media boxes within data.
+    """
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
             return
+        yield box_type, data[offset + header:offset + size]
+        offset += size
 
-        # Set defaults to blank, else values are showing 'unknown' instead.
-        [file.add_string_attribute(column.get('name'), '') for column in COLUMN_DEFINITIONS]
 
-        # strip file:// to get absolute path
-        filename = urllib.parse.unquote_plus(file.get_uri()[7:])
+def find_mp4_box(data, *path):
+    for box_type, payload in read_mp4_boxes(data):
+        if box_type == path[0]:
+            return payload if len(path) == 1 else find_mp4_box(payload, *path[1:])
+    return None
 
-        ################
-        # mp3 handling #
-        ################
-        if file.is_mime_type('audio/mpeg'):
-            # attempt to read ID3 tag
-            try:
-                audio = EasyID3(filename)
-                map_audio(file, audio, 'title')
-                map_audio(file, audio, 'album')
-                map_audio(file, audio, 'artist')
-                map_audio(file, audio, 'tracknumber')
-                map_audio(file, audio, 'genre')
-                map_audio(file, audio, 'date')
-            except Exception:
-                pass
-
-            # try to read MP3 information (bitrate, length, samplerate)
-            with open(filename) as mpfile:
-                try:
-                    mpinfo = MPEGInfo(mpfile)
-                    map_any(file, mpinfo, 'bitrate',    f=lambda m: m.bitrate / 1000, c=lambda v: v + ' Kbps')
-                    map_any(file, mpinfo, 'samplerate', f=lambda m: m.sample_rate,    c=lambda v: v + ' Hz')
-                    map_any(file, mpinfo, 'length',     f=lambda m: m.length,         c=secToTimeFormat)
-                except Exception:
-                    pass
-
-        ##################
-        # image handling #
-        ##################
-        if file.get_mime_type().split('/')[0] in ('image'):
-            try:
-                metadata = GExiv2.Metadata(filename)
-            except Exception:
-                metadata = GExiv2.Metadata()
-
-            map_exif(file, metadata, 'aperture_value', 'Exif.Photo.ApertureValue')
-            map_exif(file, metadata, 'artist', 'Exif.Image.Artist')
-            map_exif(file, metadata, 'brightness_value', 'Exif.Photo.BrightnessValue')
-            map_exif(file, metadata, 'datetime_original', 'Exif.Image.DateTime')
-            map_exif(file, metadata, 'exposure_bias_value', 'Exif.Photo.ExposureBiasValue')
-            map_exif(file, metadata, 'exposure_mode', 'Exif.Photo.ExposureMode', c=lambda v: convert(EXPOSURE_MODE, v))
-            map_exif(file, metadata, 'exposure_time', f=lambda m,t: m.get_exposure_time())
-            map_exif(file, metadata, 'flash', 'Exif.Photo.Flash', c=lambda v: convert(FLASH, v))
-            map_exif(file, metadata, 'fnumber',       f=lambda m,t: m.get_fnumber())
-            map_exif(file, metadata, 'focal_length',  f=lambda m,t: m.get_focal_length())
-            map_exif(file, metadata, 'gain_control', 'Exif.Photo.GainControl', c=lambda v: convert(GAIN_CONTROL, v))
-            map_exif(file, metadata, 'gps_altitude',  f=lambda m,t: m.get_gps_altitude())
-            map_exif(file, metadata, 'gps_latitude',  f=lambda m,t: m.get_gps_latitude())
-            map_exif(file, metadata, 'gps_longitude', f=lambda m,t: m.get_gps_longitude())
-            map_exif(file, metadata, 'iso_speed',     f=lambda m,t: m.get_iso_speed())
-            map_exif(file, metadata, 'light_source', 'Exif.Photo.LightSource', c=lambda v: convert(LIGHT_SOURCE, v))
-            map_exif(file, metadata, 'max_aperture_value', 'Exif.Photo.MaxApertureValue')
-            map_exif(file, metadata, 'metering_mode', 'Exif.Photo.MeteringMode', c=lambda v: convert(METERING_MODE, v))
-            map_exif(file, metadata, 'model', 'Exif.Image.Model')
-            map_exif(file, metadata, 'orientation',   f=lambda m,t:m.get_orientation(), c=lambda v: convert(ORIENTATION, v))
-            map_exif(file, metadata, 'resolution_unit', 'Exif.Image.ResolutionUnit', c=lambda v: convert(RESOLUTION_UNIT, v))
-            map_exif(file, metadata, 'shutter_speed_value', 'Exif.Photo.ShutterSpeedValue')
-            map_exif(file, metadata, 'title', 'Exif.Image.ImageDescription')
-            map_exif(file, metadata, 'xresolution', 'Exif.Image.XResolution')
-            map_exif(file, metadata, 'yresolution', 'Exif.Image.YResolution')
 
-            try:
-                im = Image.open(filename)
-                map_any(file, im, 'width', f=lambda i: i.size[0])
-                map_any(file, im, 'height', f=lambda i: i.size[1])
-            except Exception:
-                pass
-
-        #######################
-        # video/flac handling #
-        #######################
-        if file.is_mime_type('video/x-msvideo') or\
-                file.is_mime_type('video/mpeg') or\
-                file.is_mime_type('video/x-ms-wmv') or\
-                file.is_mime_type('audio/x-ms-wma') or\
-                file.is_mime_type('video/mp4') or\
-                file.is_mime_type('audio/x-flac') or\
-                file.is_mime_type('video/x-flv') or\
-                file.is_mime_type('video/x-matroska') or\
-                file.is_mime_type('audio/x-wav'):
-            try:
-                mediainfo = MediaInfo(filename)
-                map_mediainfo(file, mediainfo, 'format', 'Format')
-                map_mediainfo(file, mediainfo, 'duration', 'Duration', c=secToTimeFormat)
-                map_mediainfo(file, mediainfo, 'overall_bitrate', 'OverallBitRate')
-                map_mediainfo(file, mediainfo, 'frame_count', 'FrameCount')
-                map_mediainfo(file, mediainfo, 'video_format', 'VideoFormat')
-                map_mediainfo(file, mediainfo, 'width', 'Width')
-                map_mediainfo(file, mediainfo, 'height', 'Height')
-                map_mediainfo(file, mediainfo, 'bit_depth', 'BitDepth')
-                map_mediainfo(file, mediainfo, 'audio_format', 'AudioFormat')
-            except Exception:
-                pass
-
-        ################
-        # pdf handling #
-        ################
-        if file.is_mime_type('application/pdf'):
-            try:
-                with open(filename, 'rb') as f:
-                    pdf = PdfFileReader(f)
-                    map_any(file, pdf, 'pages', f=lambda i:i.getNumPages())
+def parse_mp4(f, file_size):
+    # Walk the top level boxes by seeking, the moov box is often written after the media data.
+    moov = None
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack('>I4s', header[:8])
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            size = file_size - offset
+        if size < 8:
+            return None
+        if box_type == b'moov':
+            if size > MAX_HEADER_SIZE:
+                return None
+            f.seek(offset)
+            moov = f.read(size)[8:]
+            break
+        offset += size
+    if moov is None:
+        return None
+
+    mvhd = find_mp4_box(moov, b'mvhd')
+    if mvhd[0] == 1:
+        timescale, duration = struct.unpack('>IQ', mvhd[20:32])
+    else:
+        timescale, duration = struct.unpack('>II', mvhd[12:20])
+
+    tracks = []
+    frame_counts = {}
+    for box_type, trak in read_mp4_boxes(moov):
+        if box_type != b'trak':
+            continue
+        handler = find_mp4_box(trak, b'mdia', b'hdlr')[8:12]
+        stbl = find_mp4_box(trak, b'mdia', b'minf', b'stbl')
+        stsd = find_mp4_box(stbl, b'stsd')
+        # Skip the version, flags and entry count of stsd, to get the first sample entry.
+        entry_type, entry = next(read_mp4_boxes(stsd, 8))
+        stsz = find_mp4_box(stbl, b'stsz')
+        if stsz is not None:
+            frame_counts.setdefault(handler, struct.unpack('>I', stsz[8:12])[0])
+
+        if handler == b'vide':
+            width, height = struct.unpack('>HH', entry[24:28])
+            tracks.append({'@type': 'Video', 'Format': MP4_VIDEO_FORMATS.get(entry_type, entry_type.decode('latin-1')),
+                           'Width': width, 'Height': height})
+        elif handler == b'soun':
+            audio_format = MP4_AUDIO_FORMATS.get(entry_type, entry_type.decode('latin-1'))
+            track = {'@type': 'Audio', 'Format': audio_format}
+            if entry_type == b'mp4a':
+                esds = find_mp4_box(entry[28:], b'esds')
+                object_type = mp4_object_type(esds[4:]) if esds is not None else None
+                track['Format'] = MP4_OBJECT_TYPES.get(object_type, audio_format)
+            elif audio_format in LOSSLESS_AUDIO_FORMATS:
+                track['BitDepth'] = struct.unpack('>H', entry[18:20])[0]
+            tracks.append(track)
+
+    general = {'Format': 'MPEG-4', 'duration': duration / timescale if timescale else 0}
+    # Like mediainfo, the frame count of the first video track, or of the first audio track when there is no video.
+    frame_count = frame_counts.get(b'vide', frame_counts.get(b'soun'))
+    if frame_count is not None:
+        general['FrameCount'] = str(frame_count)
+    return media_tracks(f.name, general, tracks, file_size)
+
+
+def mp4_object_type(descriptors):
+    """
+    Get the object type indication of the DecoderConfigDescriptor within an ES descriptor.
+    """
+    offset = 0
+    while offset < len(descriptors):
+        tag = descriptors[offset]
+        offset += 1
+        length = 0
+        # The length is stored in 7 bits per byte, the high bit marks a next byte.
+        for _i in range(4):
+            byte = descriptors[offset]
+            offset += 1
+            length = (length << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                break
+        if tag == 0x03:
+            # ES_Descriptor: ES_ID (2 bytes) and flags, followed by nested descriptors.
+            flags = descriptors[offset + 2]
+            offset += 3 + (2 if flags & 0x80 else 0) + (2 if flags & 0x20 else 0)
+            if flags & 0x40:
+                offset += 1 + descriptors[offset]
+            continue
+        if tag == 0x04:
+            return descriptors[offset]
+        offset += length
+    return None
+
+
+def ebml_vint_length(first, max_length):
+    """
+    Get the length of the EBML variable size integer starting with the byte first, from its leading zero bits.
+    """
+    length = 1
+    while length <= max_length and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > max_length:
+        raise MalformedHeader(f'EBML variable size integer longer than {max_length} bytes')
+    return length
+
+
+def read_ebml_element(data, offset):
+    """
+    Read the id and size of the EBML element at offset.
+
+    :return: a tuple with the id, the offset of the payload and the size of the payload (None when unknown).
+    """
+    # Ids are at most 4 bytes long and sizes 8 bytes, a longer one is a corrupt file.
+    length = ebml_vint_length(data[offset], 4)
+    element_id = int.from_bytes(data[offset:offset + length], 'big')
+    offset += length
+
+    first = data[offset]
+    length = ebml_vint_length(first, 8)
+    size = first & (0xFF >> length)
+    for byte in data[offset + 1:offset + length]:
+        size = (size << 8) | byte
+    unknown = size == (1 << (7 * length)) - 1
+    return element_id, offset + length, None if unknown else size
+
+
+def read_ebml_elements(data, offset=0, end=None):
+    end = len(data) if end is None else end
+    while offset < end:
+        element_id, payload, size = read_ebml_element(data, offset)
+        if size is None:
+            size = end - payload
+        yield element_id, data[payload:payload + size]
+        offset = payload + size
+
+
+def ebml_uint(payload):
+    return int.from_bytes(payload, 'big')
+
+
+def ebml_float(payload):
+    return struct.unpack('>f' if len(payload) == 4 else '>d', payload)[0]
+
+
+def parse_matroska(f, file_size):
+    data = f.read(min(file_size, 1024 * 1024))
+    element_id, payload, size = read_ebml_element(data, 0)
+    doc_type = None
+    for child_id, child in read_ebml_elements(data, payload, payload + size):
+        if child_id == 0x4282:
+            doc_type = child.decode('ascii')
+    if doc_type not in ('matroska', 'webm'):
+        return None
+
+    segment_id, segment_offset, segment_size = read_ebml_element(data, payload + size)
+    if segment_id != 0x18538067:
+        return None
+
+    general = {'Format': 'WebM' if doc_type == 'webm' else 'Matroska'}
+    tracks = []
+    # The positions of the top level elements within the segment, from the SeekHead.
+    positions = {}
+    tags = None
+    offset = segment_offset
+    while offset < len(data):
+        element_id, payload, size = read_ebml_element(data, offset)
+        if element_id == 0x1F43B675 or size is None or payload + size > len(data):
+            # Clusters hold the media data, the headers needed are before the first one.
+            break
+        if element_id == 0x114D9B74:
+            for seek_id, seek in read_ebml_elements(data, payload, payload + size):
+                if seek_id == 0x4DBB:
+                    entry = dict(read_ebml_elements(seek))
+                    if 0x53AB in entry and 0x53AC in entry:
+                        positions[ebml_uint(entry[0x53AB])] = ebml_uint(entry[0x53AC])
+        elif element_id == 0x1254C367:
+            tags = data[payload:payload + size]
+        elif element_id == 0x1549A966:
+            timecode_scale = 1000000
+            duration = 0
+            for child_id, child in read_ebml_elements(data, payload, payload + size):
+                if child_id == 0x2AD7B1:
+                    timecode_scale = ebml_uint(child)
+                elif child_id == 0x4489:
+                    duration = ebml_float(child)
+            general['duration'] = duration * timecode_scale / 1e9
+        elif element_id == 0x1654AE6B:
+            for entry_id, entry in read_ebml_elements(data, payload, payload + size):
+                if entry_id == 0xAE:
+                    track = matroska_track(entry)
+                    if track is not None:
+                        tracks.append(track)
+        offset = payload + size
+
+    if tags is None and 0x1254C367 in positions:
+        # Muxers like mkvmerge write the tags after the clusters, as they hold statistics of the whole file.
+        tags = read_ebml_at(f, segment_offset + positions[0x1254C367], 0x1254C367)
+    if tags is not None:
+        frame_counts = matroska_frame_counts(tags)
+        for track in tracks:
+            if track['@type'] == 'Video' and track.get('UniqueID') in frame_counts:
+                general['FrameCount'] = str(frame_counts[track['UniqueID']])
+                break
+    return media_tracks(f.name, general, tracks, file_size)
+
+
+def read_ebml_at(f, position, element_id):
+    """
+    Read the payload of the EBML element at position of the file, or None when it is not the expected element.
+    """
+    f.seek(position)
+    header = f.read(12)
+    if len(header) < 2:
+        return None
+    found_id, payload, size = read_ebml_element(header, 0)
+    if found_id != element_id or size is None or size > MAX_HEADER_SIZE:
+        return None
+    f.seek(position + payload)
+    return f.read(size)
+
+
+def matroska_frame_counts(tags):
+    """
+    The NUMBER_OF_FRAMES statistics tags, as written by e.g. mkvmerge, by the UID of their track.
+    """
+    frame_counts = {}
+    for tag_id, tag in read_ebml_elements(tags):
+        if tag_id != 0x7373:
+            continue
+        track_uids = []
+        frame_count = None
+        for child_id, child in read_ebml_elements(tag):
+            if child_id == 0x63C0:
+                track_uids += [ebml_uint(uid) for target_id, uid in read_ebml_elements(child) if target_id == 0x63C5]
+            elif child_id == 0x67C8:
+                simple_tag = dict(read_ebml_elements(child))
+                value = simple_tag.get(0x4487, b'').decode('utf-8', 'replace')
+                if simple_tag.get(0x45A3) == b'NUMBER_OF_FRAMES' and value.isdigit():
+                    frame_count = int(value)
+        if frame_count is not None:
+            for uid in track_uids:
+                frame_counts[uid] = frame_count
+    return frame_counts
+
+
+def matroska_track(entry):
+    track_type = None
+    track = {}
+    for element_id, payload in read_ebml_elements(entry):
+        if element_id == 0x83:
+            track_type = ebml_uint(payload)
+        elif element_id == 0x73C5:
+            track['UniqueID'] = ebml_uint(payload)
+        elif element_id == 0x86:
+            codec = payload.decode('ascii').rstrip('\x00')
+            track['Format'] = MATROSKA_CODECS.get(codec, MATROSKA_CODECS.get(codec.split('/')[0], codec))
+        elif element_id == 0xE0:
+            for child_id, child in read_ebml_elements(payload):
+                if child_id == 0xB0:
+                    track['Width'] = ebml_uint(child)
+                elif child_id == 0xBA:
+                    track['Height'] = ebml_uint(child)
+        elif element_id == 0xE1:
+            for child_id, child in read_ebml_elements(payload):
+                if child_id == 0x6264:
+                    track['BitDepth'] = ebml_uint(child)
+    if track_type == 1:
+        return {'@type': 'Video', **track}
+    if track_type == 2:
+        if track.get('Format') not in LOSSLESS_AUDIO_FORMATS:
+            track.pop('BitDepth', None)
+        return {'@type': 'Audio', **track}
+    return None
+
+
+def parse_wave(f, file_size):
+    riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+    if wave != b'WAVE':
+        return None
+    fmt = None
+    data_size = None
+    offset = 12
+    while offset + 8 <= file_size and (fmt is None or data_size is None):
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'fmt ':
+            fmt = f.read(min(chunk_size, 40))
+        elif chunk_id == b'data':
+            data_size = min(chunk_size, file_size - offset - 8)
+        # Chunks are padded to an even size.
+        offset += 8 + chunk_size + (chunk_size & 1)
+    if fmt is None or data_size is None:
+        return None
+
+    format_tag, channels, sample_rate, byte_rate, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag not in WAVE_FORMATS or not byte_rate:
+        return None
+    track = {'@type': 'Audio', 'Format': WAVE_FORMATS[format_tag]}
+    if track['Format'] in LOSSLESS_AUDIO_FORMATS:
+        track['BitDepth'] = bits
+    return media_tracks(f.name, {'Format': 'Wave', 'duration': data_size / byte_rate}, [track], file_size)
+
+
+def parse_flac(f, file_size):
+    f.seek(4)
+    block_header = f.read(4)
+    if block_header[0] & 0x7F != 0:
+        # The first metadata block must be STREAMINFO.
+        return None
+    streaminfo = f.read(34)
+    # Sample rate (20 bits), channels (3 bits), bits per sample (5 bits) and total samples (36 bits).
+    packed = int.from_bytes(streaminfo[10:18], 'big')
+    sample_rate = packed >> 44
+    bits = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate:
+        return None
+    track = {'@type': 'Audio', 'Format': 'FLAC', 'BitDepth': bits}
+    return media_tracks(f.name, {'Format': 'FLAC', 'duration': total_samples / sample_rate}, [track], file_size)
+
+
+def parse_asf(f, file_size):
+    header_guid, header_size, count = struct.unpack('<16sQI', f.read(28))
+    if uuid.UUID(bytes_le=header_guid) != ASF_HEADER or header_size > MAX_HEADER_SIZE:
+        return None
+    data = f.read(header_size - 28)[2:]
+
+    general = {'Format': 'Windows Media'}
+    tracks = []
+    offset = 0
+    for _i in range(count):
+        if offset + 24 > len(data):
+            raise MalformedHeader('ASF header objects beyond the header')
+        guid = uuid.UUID(bytes_le=data[offset:offset + 16])
+        size = struct.unpack('<Q', data[offset + 16:offset + 24])[0]
+        if size < 24:
+            # An object includes its GUID and size, a smaller one would never advance to the next object.
+            raise MalformedHeader(f'ASF header object of {size} bytes')
+        body = data[offset + 24:offset + size]
+        if guid == ASF_FILE_PROPERTIES:
+            # Play duration in 100ns units, including the preroll in ms.
+            play_duration, send_duration, preroll = struct.unpack('<QQQ', body[40:64])
+            general['duration'] = play_duration / 1e7 - preroll / 1e3
+        elif guid == ASF_STREAM_PROPERTIES:
+            stream_type = uuid.UUID(bytes_le=body[:16])
+            type_data_length = struct.unpack('<I', body[40:44])[0]
+            type_data = body[54:54 + type_data_length]
+            if stream_type == ASF_AUDIO_MEDIA:
+                format_tag, channels, sample_rate, byte_rate, block_align, bits = struct.unpack('<HHIIHH',
+                                                                                              type_data[:16])
+                tracks.append({'@type': 'Audio', 'Format': ASF_AUDIO_FORMATS.get(format_tag, hex(format_tag)),
+                               'BitDepth': bits})
+            elif stream_type == ASF_VIDEO_MEDIA:
+                # Width, height, flags and size, followed by a BITMAPINFOHEADER.
+                width, height = struct.unpack('<II', type_data[:8])
+                compression = type_data[11 + 16:11 + 20]
+                tracks.append({'@type': 'Video', 'Width': width, 'Height': height,
+                               'Format': ASF_VIDEO_FORMATS.get(compression, compression.decode('latin-1'))})
+        offset += size
+    return media_tracks(f.name, general, tracks, file_size)
+
+
+# Each parser is selected on the first bytes of the file.
+MEDIA_HEADER_PARSERS = [
+    (lambda magic: magic[4:8] == b'ftyp', parse_mp4),
+    (lambda magic: magic[:4] == b'\x1a\x45\xdf\xa3', parse_matroska),
+    (lambda magic: magic[:4] == b'RIFF' and magic[8:12] == b'WAVE', parse_wave),
+    (lambda magic: magic[:4] == b'fLaC', parse_flac),
+    (lambda magic: uuid.UUID(bytes_le=magic[:16]) == ASF_HEADER, parse_asf),
+]
+
+
+def parse_media_header(filename, f=None):
+    """
+    Read the container header of a media file in-process.
+
+    :param filename: the media file.
+    :param f: the media file opened in binary mode, when it is open already.
+    :return: the mediainfo-like output, or None when the container is not known.
+    """
+    if f is None:
+        with open(filename, 'rb') as f:
+            return parse_media_header(filename, f)
+
+    f.seek(0)
+    magic = f.read(16)
+    if len(magic) < 16:
+        return None
+    file_size = os.fstat(f.fileno()).st_size
+    for matches, parser in MEDIA_HEADER_PARSERS:
+        if matches(magic):
+            f.seek(0)
+            return parser(f, file_size)
+    return None
+
+
+def read_media_info(filename, f=None):
+    """
+    Get the MediaInfo of a file, from its header when the container is known or from mediainfo otherwise.
+    """
+    if MEDIA_BACKEND == 'auto':
+        try:
+            media = parse_media_header(filename, f)
+        except MalformedHeader:
+            raise
+        except Exception:
+            # Truncated or unusual files are left to mediainfo.
+            media = None
+        if media is not None:
+            return MediaInfo(filename, media)
+    return mediainfo_batcher.get(filename)
+
+
+#################
+# bounded reads #
+#################
+# On network mounts reading a whole file for a few header fields is expensive. In bounded-read mode the headers of
+# images and PDFs are parsed from at most READ_BUDGET bytes, read in blocks through BoundedReader.
+
+class ReadBudgetExceeded(IOError):
+    pass
+
+
+class BoundedReader:
+    """
+    BoundedReader reads blocks of a file and counts the bytes read, raising ReadBudgetExceeded when more than the budget
+    would be read:
+        with BoundedReader('image.jpg') as reader:
+            header = reader.read(0, 1024)
+    Blocks are read only once, so parsers can read overlapping ranges without extra I/O.
+    """
+
+    BLOCK_SIZE = 16 * 1024
+
+    def __init__(self, filename, budget=None):
+        self.filename = filename
+        self.budget = READ_BUDGET if budget is None else budget
+        self.bytes_read = 0
+        self.blocks = {}
+        self.f = open(filename, 'rb', buffering=0)
+        self.size = os.fstat(self.f.fileno()).st_size
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+        first = offset // self.BLOCK_SIZE
+        data = b''.join(self.block(index) for index in range(first, (end - 1) // self.BLOCK_SIZE + 1))
+        start = offset - first * self.BLOCK_SIZE
+        return data[start:start + end - offset]
+
+    def block(self, index):
+        if index not in self.blocks:
+            if self.bytes_read + self.BLOCK_SIZE > self.budget:
+                raise ReadBudgetExceeded(f'Reading {self.filename} exceeds the budget of {self.budget} bytes.')
+            self.f.seek(index * self.BLOCK_SIZE)
+            self.blocks[index] = self.f.read(self.BLOCK_SIZE)
+            self.bytes_read += len(self.blocks[index])
+        return self.blocks[index]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_bounded(file, filename, parse):
+    """
+    Parse the header of a file within the read budget. The bytes read are added to `file.bytes_read`.
+
+    :param file: the ColumnValues of the file.
+    :param filename: the file to read.
+    :param parse: the function parsing the header from a BoundedReader.
+    :return: the result of parse, None when parse does not understand the file or bounded reads are disabled.
+    :raises ReadBudgetExceeded: when the header does not fit within the budget.
+    """
+    if READ_BUDGET <= 0:
+        return None
+    with BoundedReader(filename) as reader:
+        try:
+            return parse(reader)
+        except ReadBudgetExceeded:
+            stats.increment('read_budget_exceeded')
+            raise
+        finally:
+            file.bytes_read += reader.bytes_read
+
+
+class ImageHeader:
+    """
+    ImageHeader holds the pixel dimensions of an image and, for JPEG, the metadata segments: the image without its
+    compressed data, which is enough for exiv2 to read the EXIF, IPTC and XMP tags.
+    """
+
+    def __init__(self, width, height, metadata=None):
+        self.width = width
+        self.height = height
+        self.metadata = metadata
+
+
+def read_image_header(reader):
+    head = reader.read(0, 32)
+    if head[:2] == b'\xff\xd8':
+        return read_jpeg_header(reader)
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        return ImageHeader(*struct.unpack('>II', head[16:24]))
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return ImageHeader(*struct.unpack('<HH', head[6:10]))
+    if head[:2] == b'BM':
+        width, height = struct.unpack('<ii', head[18:26])
+        return ImageHeader(width, abs(height))
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        if head[12:16] == b'VP8X':
+            return ImageHeader(int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+        if head[12:16] == b'VP8L':
+            bits = int.from_bytes(head[21:25], 'little')
+            return ImageHeader((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+        if head[12:16] == b'VP8 ':
+            width, height = struct.unpack('<HH', head[26:30])
+            return ImageHeader(width & 0x3FFF, height & 0x3FFF)
+    return None
+
+
+def read_jpeg_header(reader):
+    segments = [b'\xff\xd8']
+    width = height = None
+    offset = 2
+    while True:
+        marker = reader.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            # Fill byte.
+            offset += 1
+            continue
+        if marker[1] == 0xDA or marker[1] == 0xD9:
+            # Start of scan, the compressed image data follows.
+            break
+        length = struct.unpack('>H', marker[2:4])[0]
+        segment = reader.read(offset, 2 + length)
+        # Start of frame markers, except DHT, JPG and DAC which share the range.
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', segment[5:9])
+        segments.append(segment)
+        offset += 2 + length
+    if width is None:
+        return None
+    segments.append(b'\xff\xd9')
+    return ImageHeader(width, height, b''.join(segments))
+
+
+class PdfHeader:
+    """
+    PdfHeader reads the document information, page count and size of the first page of a PDF by following the
+    cross-reference tables from the trailer, reading only the objects needed:
+        with BoundedReader('document.pdf') as reader:
+            pdf = PdfHeader(reader)
+            pages = pdf.pages
+    Without pages, the page tree is not read and `pages` and `media_box` are None.
+    Raises ValueError for PDFs it does not understand, e.g. with cross-reference streams, encryption or
+    cross-reference entries that are not 20 bytes long.
+    """
+
+    XREF_ENTRY_SIZE = 20
+    # An entry is an offset, a generation, n or f and a two character end of line.
+    XREF_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])(?: \r| \n|\r\n)')
+    # Objects are read in windows of this size until `endobj` is found.
+    OBJECT_WINDOW = 4096
+    MAX_OBJECT_SIZE = 64 * 1024
+    MAX_DEPTH = 32
+
+    def __init__(self, reader, pages=True):
+        self.reader = reader
+        # The subsections (first object, count, offset of the entries) of all cross-reference tables, newest first.
+        self.subsections = []
+        self.trailer = {}
+
+        tail = reader.read(max(0, reader.size - 1024), 1024)
+        position = tail.rfind(b'startxref')
+        if position < 0:
+            raise ValueError('startxref not found.')
+        offset = int(tail[position + 9:].split()[0])
+        visited = set()
+        while offset is not None and offset not in visited:
+            visited.add(offset)
+            offset = self.read_xref(offset)
+
+        if '/Encrypt' in self.trailer:
+            raise ValueError('Encrypted PDF.')
+        self.info = self.object(pdf_ref(self.trailer['/Info'])) if '/Info' in self.trailer else {}
+        self.pages, self.media_box = None, None
+        if pages:
+            root = self.object(pdf_ref(self.trailer['/Root']))
+            self.pages, self.media_box = self.read_pages(self.object(pdf_ref(root['/Pages'])))
+
+    def read_xref(self, offset):
+        """
+        Read the cross-reference table at offset, skipping over the entries.
+
+        :return: the offset of the previous table, or None.
+        """
+        data = self.reader.read(offset, 64)
+        if not data.startswith(b'xref'):
+            raise ValueError('Cross-reference streams are not supported.')
+        offset += 4
+        while True:
+            data = self.reader.read(offset, 64)
+            stripped = data.lstrip()
+            offset += len(data) - len(stripped)
+            if stripped.startswith(b'trailer'):
+                break
+            line = stripped.split(b'\n')[0].split(b'\r')[0]
+            first, count = (int(v) for v in line.split())
+            offset += len(line)
+            # The line ends with one or two end-of-line characters.
+            while self.reader.read(offset, 1) in (b'\r', b'\n', b' '):
+                offset += 1
+            self.subsections.append((first, count, offset))
+            if count:
+                # Entries are found by position, which is wrong when a writer used other entry lengths.
+                self.entry(offset)
+            offset += count * self.XREF_ENTRY_SIZE
+
+        trailer = pdf_dict(self.read_until(offset + 7, b'>>'))
+        for key, value in trailer.items():
+            self.trailer.setdefault(key, value)
+        return int(trailer['/Prev']) if '/Prev' in trailer else None
+
+    def read_until(self, offset, end):
+        size = self.OBJECT_WINDOW
+        while True:
+            data = self.reader.read(offset, size)
+            if end in data or len(data) < size:
+                return data
+            if size >= self.MAX_OBJECT_SIZE:
+                raise ValueError('Object too large.')
+            size *= 2
+
+    def entry(self, offset):
+        match = self.XREF_ENTRY.fullmatch(self.reader.read(offset, self.XREF_ENTRY_SIZE))
+        if match is None:
+            raise ValueError('Malformed cross-reference entry.')
+        return match
+
+    def offset(self, number):
+        for first, count, offset in self.subsections:
+            if first <= number < first + count:
+                position, generation, kind = self.entry(offset + (number - first) * self.XREF_ENTRY_SIZE).groups()
+                return int(position) if kind == b'n' else None
+        return None
+
+    def object(self, number):
+        """
+        Read an indirect object, a dict for dictionaries or the raw value otherwise.
+        """
+        offset = self.offset(number)
+        if offset is None:
+            raise ValueError(f'Object {number} not found.')
+        data = self.read_until(offset, b'endobj')
+        body = data[data.index(b'obj') + 3:].lstrip()
+        return pdf_dict(body) if body.startswith(b'<<') else body[:body.find(b'endobj')].strip()
+
+    def value(self, value):
+        """
+        Resolve a value that may be an indirect reference.
+        """
+        ref = pdf_ref(value)
+        return self.object(ref) if ref is not None else value
+
+    def read_pages(self, pages):
+        count = int(self.value(pages['/Count']))
+        # The media box is inherited, so it is tracked while descending to the first page.
+        media_box = None
+        for _i in range(self.MAX_DEPTH):
+            if '/MediaBox' in pages:
+                media_box = pdf_numbers(self.value(pages['/MediaBox']))
+            kids = pdf_refs(self.value(pages['/Kids'])) if '/Kids' in pages else []
+            if not kids:
+                break
+            pages = self.object(kids[0])
+        return count, media_box
+
+    def text(self, key):
+        if key not in self.info:
+            return None
+        return pdf_text(self.value(self.info[key]))
+
+
+PDF_DELIMITERS = b'()<>[]{}/%'
+PDF_WHITESPACE = b' \t\r\n\x0c\x00'
+PDF_REF = re.compile(rb'(\d+)\s+(\d+)\s+R')
+PDF_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f',
+               ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+
+
+def pdf_skip(data, offset):
+    """
+    Skip whitespace and comments.
+    """
+    while offset < len(data):
+        if data[offset] in PDF_WHITESPACE:
+            offset += 1
+        elif data[offset] == ord('%'):
+            while offset < len(data) and data[offset] not in b'\r\n':
+                offset += 1
+        else:
+            break
+    return offset
+
+
+def pdf_value_end(data, offset):
+    """
+    Find the end of the value starting at offset.
+    """
+    if data.startswith(b'<<', offset) or data[offset] == ord('['):
+        depth = 0
+        while offset < len(data):
+            if data.startswith(b'<<', offset) or data[offset] == ord('['):
+                depth += 1
+                offset += 1 if data[offset] == ord('[') else 2
+            elif data.startswith(b'>>', offset) or data[offset] == ord(']'):
+                depth -= 1
+                offset += 1 if data[offset] == ord(']') else 2
+                if depth == 0:
+                    return offset
+            elif data[offset] in b'(<':
+                offset = pdf_value_end(data, offset)
+            else:
+                offset += 1
+        raise ValueError('Unterminated dictionary or array.')
+    if data[offset] == ord('('):
+        depth = 0
+        while offset < len(data):
+            if data[offset] == ord('\\'):
+                offset += 2
+                continue
+            if data[offset] == ord('('):
+                depth += 1
+            elif data[offset] == ord(')'):
+                depth -= 1
+                if depth == 0:
+                    return offset + 1
+            offset += 1
+        raise ValueError('Unterminated string.')
+    if data[offset] == ord('<'):
+        return data.index(b'>', offset) + 1
+
+    match = PDF_REF.match(data, offset)
+    if match:
+        return match.end()
+    offset += 1
+    while offset < len(data) and data[offset] not in PDF_WHITESPACE and data[offset] not in PDF_DELIMITERS:
+        offset += 1
+    return offset
+
+
+def pdf_dict(data):
+    """
+    Parse the top level entries of the dictionary at the start of data.
+
+    :return: a dict mapping the keys, e.g. '/Count', to the raw bytes of their values.
+    """
+    offset = pdf_skip(data, 0)
+    if not data.startswith(b'<<', offset):
+        raise ValueError('Not a dictionary.')
+    offset = pdf_skip(data, offset + 2)
+    entries = {}
+    while not data.startswith(b'>>', offset):
+        key_end = pdf_value_end(data, offset)
+        key = data[offset:key_end].decode('latin-1')
+        offset = pdf_skip(data, key_end)
+        end = pdf_value_end(data, offset)
+        entries[key] = data[offset:end]
+        offset = pdf_skip(data, end)
+        if offset >= len(data):
+            raise ValueError('Unterminated dictionary.')
+    return entries
+
+
+def pdf_ref(value):
+    match = PDF_REF.fullmatch(value.strip()) if isinstance(value, bytes) else None
+    return int(match.group(1)) if match else None
+
+
+def pdf_refs(value):
+    return [int(match.group(1)) for match in PDF_REF.finditer(value)]
+
+
+def pdf_numbers(value):
+    return [float(number) for number in value.strip(b'[] \t\r\n').split()]
+
+
+def pdf_text(value):
+    """
+    Decode a literal or hexadecimal PDF string, as UTF-16 when it starts with a byte order mark.
+    """
+    value = value.strip()
+    if value.startswith(b'<'):
+        raw = bytes.fromhex(value[1:-1].decode('ascii'))
+    else:
+        raw = bytearray()
+        body = value[1:-1]
+        offset = 0
+        while offset < len(body):
+            char = body[offset]
+            offset += 1
+            if char != ord('\\'):
+                raw.append(char)
+                continue
+            escaped = body[offset:offset + 1]
+            offset += 1
+            if escaped in (b'\r', b'\n'):
+                # Line continuation.
+                if escaped == b'\r' and body[offset:offset + 1] == b'\n':
+                    offset += 1
+            elif escaped.isdigit():
+                digits = escaped
+                while len(digits) < 3 and body[offset:offset + 1].isdigit():
+                    digits += body[offset:offset + 1]
+                    offset += 1
+                raw.append(int(digits, 8) & 0xFF)
+            else:
+                raw += PDF_ESCAPES.get(escaped[0], escaped)
+        raw = bytes(raw)
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', errors='replace')
+    return raw.decode('latin-1')
+
+
+class ColumnValues(MutableMapping):
+    """
+    ColumnValues holds the column values of a single file. It mimics `add_string_attribute` of the Nautilus FileInfo
+    object, so the mapping methods can fill it away from the main thread. The values are copied to the FileInfo
+    object afterwards using `apply_to`.
+
+    The caches hold these for hundreds of thousands of files, so it is a compact record instead of a dict: a bitmap of
+    the columns that have a value, by their index in COLUMN_DEFINITIONS, and a tuple with only those values. Empty
+    values are not stored, values of INTERNED_COLUMNS and the sets of extractor names are shared between files.
+        columns = ColumnValues({'title': 'Galway'}, extractors=['audio'])
+        columns['title']
+    Values of names that are not a column are dropped, `map_any` warns about those.
+    """
+
+    __slots__ = ('present', 'values', 'extractors', 'bytes_read', 'errors', '_failed')
+
+    def __init__(self, values=None, extractors=()):
+        self.present = 0
+        self.values = ()
+        # The names of the extractors that filled these values, a frozenset shared by all files with the same names.
+        self.extractors = intern_extractors(extractors)
+        # The number of bytes read from the file by bounded reads, for diagnostics.
+        self.bytes_read = 0
+        # The number of exceptions while extracting, for diagnostics.
+        self.errors = 0
+        # The names of the extractors that timed out or failed, mapped to the reason. Only created on a failure.
+        self._failed = None
+        if values:
+            self.update(values)
+
+    def position(self, bit):
+        # The position of the value of a column within values: the number of columns with a value before it.
+        return bin(self.present & (bit - 1)).count('1')
+
+    def __getitem__(self, name):
+        index = COLUMN_INDEX.get(name)
+        if index is None or not self.present & (1 << index):
+            raise KeyError(name)
+        return self.values[self.position(1 << index)]
+
+    def __contains__(self, name):
+        return name in COLUMN_INDEX and bool(self.present & (1 << COLUMN_INDEX[name]))
+
+    def get(self, name, default=None):
+        index = COLUMN_INDEX.get(name)
+        if index is None or not self.present & (1 << index):
+            return default
+        return self.values[self.position(1 << index)]
+
+    def __setitem__(self, name, value):
+        index = COLUMN_INDEX.get(name)
+        if index is None:
+            return
+        if value == '':
+            self.pop(name, None)
+            return
+        if name in INTERNED_COLUMNS and type(value) is str:
+            value = sys.intern(value)
+        bit = 1 << index
+        position = self.position(bit)
+        if self.present & bit:
+            self.values = self.values[:position] + (value,) + self.values[position + 1:]
+        else:
+            self.values = self.values[:position] + (value,) + self.values[position:]
+            self.present |= bit
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        bit = 1 << COLUMN_INDEX[name]
+        position = self.position(bit)
+        self.values = self.values[:position] + self.values[position + 1:]
+        self.present &= ~bit
+
+    def __iter__(self):
+        present = self.present
+        return (name for index, name in enumerate(COLUMN_ORDER) if present & (1 << index))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f'ColumnValues({dict(self)!r}, extractors={sorted(self.extractors)!r})'
+
+    def __reduce__(self):
+        # Pickled by the pre-warm workers, the extractor names are interned again when unpickled.
+        return type(self), (dict(self), self.extractors), (self.bytes_read, self.errors, self._failed)
+
+    def __setstate__(self, state):
+        self.bytes_read, self.errors, self._failed = state
+
+    @property
+    def failed(self):
+        return self._failed if self._failed is not None else NO_FAILURES
+
+    def fail(self, extractor, reason):
+        if self._failed is None:
+            self._failed = {}
+        self._failed.setdefault(extractor, reason)
+
+    def add_string_attribute(self, attribute_name, value):
+        self[attribute_name] = value
+
+    def add_extractor(self, name):
+        self.extractors = intern_extractors(self.extractors | {name})
+
+    def merge(self, other):
+        """
+        Add the values and extractors of other, e.g. the values of extractors that were missing in a cached entry.
+        """
+        self.update(other)
+        self.extractors = intern_extractors(self.extractors | other.extractors)
+        for extractor, reason in other.failed.items():
+            self.fail(extractor, reason)
+        self.bytes_read += other.bytes_read
+        self.errors += other.errors
+
+    def apply_to(self, file):
+        # Set defaults to blank, else values are showing 'unknown' instead.
+        for name in COLUMN_ORDER:
+            file.add_string_attribute(name, self.get(name, ''))
+
+
+NO_FAILURES = MappingProxyType({})
+# The distinct sets of extractor names, shared by the ColumnValues of all files.
+EXTRACTOR_SETS = {}
+
+
+def intern_extractors(names):
+    names = frozenset(names)
+    return EXTRACTOR_SETS.setdefault(names, names)
+
+
+def filename_from_uri(uri):
+    # strip file:// to get absolute path
+    return urllib.parse.unquote(uri[7:])
+
+
+def points_from_bbox(bbox, index):
+    return abs(bbox.upperRight[index] - bbox.lowerLeft[index])
+
+
+def points_to_mm(pt):
+    return int(float(pt) * math.sqrt(2.0) / 4.0)
+
+
+##################
+# audio handling #
+##################
+# The tag keys of every column, for the easy tags of mutagen (MP3, FLAC, Ogg, MP4), ASF (WMA) and plain ID3 (WAV).
+AUDIO_TAGS = {
+    'title': ['title', 'Title', 'TIT2'],
+    'album': ['album', 'WM/AlbumTitle', 'TALB'],
+    'artist': ['artist', 'Author', 'TPE1'],
+    'tracknumber': ['tracknumber', 'WM/TrackNumber', 'TRCK'],
+    'genre': ['genre', 'WM/Genre', 'TCON'],
+    'date': ['date', 'WM/Year', 'TDRC'],
+}
+
+
+def audio_tag(audio, keys):
+    """
+    Get the first value of the first of keys within the tags of a mutagen file.
+    """
+    for key in keys:
+        if key in audio.tags:
+            value = audio.tags[key]
+            # Easy and ASF tags hold a list of values, ID3 frames hold the text.
+            if isinstance(value, list):
+                value = value[0]
+            return str(value)
+    return None
+
+
+def extract_audio(file, filename):
+    """
+    Extract the tags and audio information with a single open of the file.
+    """
+    import mutagen
+
+    with open(filename, 'rb') as f:
+        audio = mutagen.File(f, easy=True)
+        if audio is not None:
+            if audio.tags is not None:
+                for field in AUDIO_TAGS:
+                    map_audio(file, audio, field)
+            map_any(file, audio.info, 'bitrate',    f=lambda i: i.bitrate // 1000, c=lambda v: f'{v} Kbps')
+            map_any(file, audio.info, 'samplerate', f=lambda i: i.sample_rate,     c=lambda v: f'{v} Hz')
+            map_any(file, audio.info, 'length',     f=lambda i: i.length,          c=secToTimeFormat)
+
+
+##################
+# image handling #
+##################
+def extract_image(file, filename):
+    """
+    Extract the EXIF tags and the pixel dimensions in a single pass: from the bounded header when the format is known,
+    or from the whole file by extract_image_file otherwise.
+    """
+    try:
+        header = read_bounded(file, filename, read_image_header)
+    except ReadBudgetExceeded:
+        # E.g. large ICC profiles or XMP packets before the frame, the whole file is read below.
+        header = None
+    except OSError:
+        raise
+    except Exception:
+        # A header read_image_header does not understand.
+        header = None
+
+    if header is not None and header.metadata is not None:
+        from gi.repository import GExiv2
+        try:
+            metadata = GExiv2.Metadata()
+            metadata.open_buf(header.metadata)
+        except Exception:
+            metadata = None
+        if metadata is not None:
+            map_image(file, metadata, header)
+            return
+    file.merge(parser_pool.run(extract_image_file, filename, header))
+
+
+def extract_image_file(filename, header=None):
+    """
+    Extract the EXIF tags with GExiv2 reading the whole file, and the pixel dimensions from the header, GExiv2 or PIL.
+    PIL is only used for images GExiv2 cannot read. Runs in a process of parser_pool.
+
+    :param header: the ImageHeader of the file, None when it is not known.
+    :return: the ColumnValues of the image.
+    """
+    from gi.repository import GExiv2
+
+    file = ColumnValues()
+    try:
+        metadata = GExiv2.Metadata(filename)
+        if header is None:
+            header = ImageHeader(metadata.get_pixel_width(), metadata.get_pixel_height())
+    except Exception:
+        file.errors += 1
+        metadata = GExiv2.Metadata()
+    map_image(file, metadata, header)
+    if header is not None:
+        return file
+
+    from PIL import Image
+    try:
+        im = Image.open(filename)
+    except Image.UnidentifiedImageError:
+        # Images without pixel dimensions, like SVG.
+        file.errors += 1
+        return file
+    with im:
+        map_any(file, im, 'width', f=lambda i: i.size[0])
+        map_any(file, im, 'height', f=lambda i: i.size[1])
+    return file
+
+
+def map_image(file, metadata, header):
+    """
+    Add the EXIF tags of the GExiv2 metadata, and the pixel dimensions of the ImageHeader when it is known.
+    """
+    map_exif(file, metadata, 'aperture_value', 'Exif.Photo.ApertureValue')
+    map_exif(file, metadata, 'artist', 'Exif.Image.Artist')
+    map_exif(file, metadata, 'brightness_value', 'Exif.Photo.BrightnessValue')
+    map_exif(file, metadata, 'datetime_original', 'Exif.Image.DateTime')
+    map_exif(file, metadata, 'exposure_bias_value', 'Exif.Photo.ExposureBiasValue')
+    map_exif(file, metadata, 'exposure_mode', 'Exif.Photo.ExposureMode', c=lambda v: convert(EXPOSURE_MODE, v))
+    map_exif(file, metadata, 'exposure_time', f=lambda m,t: m.get_exposure_time())
+    map_exif(file, metadata, 'flash', 'Exif.Photo.Flash', c=lambda v: convert(FLASH, v))
+    map_exif(file, metadata, 'fnumber',       f=lambda m,t: m.get_fnumber())
+    map_exif(file, metadata, 'focal_length',  f=lambda m,t: m.get_focal_length())
+    map_exif(file, metadata, 'gain_control', 'Exif.Photo.GainControl', c=lambda v: convert(GAIN_CONTROL, v))
+    map_exif(file, metadata, 'gps_altitude',  f=lambda m,t: m.get_gps_altitude())
+    map_exif(file, metadata, 'gps_latitude',  f=lambda m,t: m.get_gps_latitude())
+    map_exif(file, metadata, 'gps_longitude', f=lambda m,t: m.get_gps_longitude())
+    map_exif(file, metadata, 'iso_speed',     f=lambda m,t: m.get_iso_speed())
+    map_exif(file, metadata, 'light_source', 'Exif.Photo.LightSource', c=lambda v: convert(LIGHT_SOURCE, v))
+    map_exif(file, metadata, 'max_aperture_value', 'Exif.Photo.MaxApertureValue')
+    map_exif(file, metadata, 'metering_mode', 'Exif.Photo.MeteringMode', c=lambda v: convert(METERING_MODE, v))
+    map_exif(file, metadata, 'model', 'Exif.Image.Model')
+    map_exif(file, metadata, 'orientation',   f=lambda m,t:m.get_orientation(), c=lambda v: convert(ORIENTATION, v))
+    map_exif(file, metadata, 'resolution_unit', 'Exif.Image.ResolutionUnit', c=lambda v: convert(RESOLUTION_UNIT, v))
+    map_exif(file, metadata, 'shutter_speed_value', 'Exif.Photo.ShutterSpeedValue')
+    map_exif(file, metadata, 'title', 'Exif.Image.ImageDescription')
+    map_exif(file, metadata, 'xresolution', 'Exif.Image.XResolution')
+    map_exif(file, metadata, 'yresolution', 'Exif.Image.YResolution')
+
+    if header is not None:
+        map_any(file, header, 'width', f=lambda h: h.width)
+        map_any(file, header, 'height', f=lambda h: h.height)
+
+
+##################
+# video handling #
+##################
+MEDIAINFO_MIME_TYPES = ('video/x-msvideo',
+                        'video/mpeg',
+                        'video/x-ms-wmv',
+                        'video/mp4',
+                        'video/x-flv',
+                        'video/x-matroska')
+# Audio formats of which the media columns are read besides the tags.
+AUDIO_MEDIA_MIME_TYPES = ('audio/x-ms-wma',
+                          'audio/x-flac',
+                          'audio/flac',
+                          'audio/x-wav')
+AUDIO_MIME_TYPES = ('audio/mpeg',
+                    'audio/ogg',
+                    'audio/x-vorbis+ogg',
+                    'audio/x-opus+ogg',
+                    'audio/mp4',
+                    'audio/x-m4a')
+
+
+def extract_mediainfo(file, filename):
+    mediainfo = read_media_info(filename)
+    map_mediainfo(file, mediainfo, 'format', 'Format')
+    map_mediainfo(file, mediainfo, 'duration', 'Duration', c=secToTimeFormat)
+    map_mediainfo(file, mediainfo, 'overall_bitrate', 'OverallBitRate')
+    map_mediainfo(file, mediainfo, 'frame_count', 'FrameCount')
+    map_mediainfo(file, mediainfo, 'video_format', 'VideoFormat')
+    map_mediainfo(file, mediainfo, 'width', 'Width')
+    map_mediainfo(file, mediainfo, 'height', 'Height')
+    map_mediainfo(file, mediainfo, 'bit_depth', 'BitDepth')
+    map_mediainfo(file, mediainfo, 'audio_format', 'AudioFormat')
+
+
+################
+# pdf handling #
+################
+def extract_pdf(file, filename, info=True, pages=True):
+    """
+    Extract the document information (title, author) and/or the page count and size of the first page.
+    """
+    try:
+        pdf = read_bounded(file, filename, lambda reader: PdfHeader(reader, pages))
+    except Exception:
+        # Not understood by PdfHeader or larger than the read budget, let PyPDF2 parse the whole file.
+        pdf = None
+
+    if pdf is not None:
+        if info:
+            map_any(file, pdf, 'title', f=lambda p: p.text('/Title'))
+            map_any(file, pdf, 'artist', f=lambda p: p.text('/Author'))
+        if pages:
+            map_any(file, pdf, 'pages', f=lambda p: p.pages)
+            if pdf.pages > 0 and pdf.media_box is not None:
+                map_any(file, pdf.media_box, 'width', f=lambda b: abs(b[2] - b[0]), c=points_to_mm)
+                map_any(file, pdf.media_box, 'height', f=lambda b: abs(b[3] - b[1]), c=points_to_mm)
+        return
+
+    file.merge(parser_pool.run(extract_pdf_file, filename, info, pages))
+
+
+def extract_pdf_file(filename, info=True, pages=True):
+    """
+    Extract the columns of a PDF with PyPDF2 parsing the whole file. Runs in a process of parser_pool.
+
+    :return: the ColumnValues of the PDF.
+    """
+    from PyPDF2 import PdfFileReader
+
+    file = ColumnValues()
+    with open(filename, 'rb') as f:
+        pdf = PdfFileReader(f)
+        if info:
+            info = pdf.getDocumentInfo()
+            map_any(file, info, 'title', f=lambda i:i.title)
+            map_any(file, info, 'artist', f=lambda i:i.author)
+
+        if pages:
+            map_any(file, pdf, 'pages', f=lambda i:i.getNumPages())
+            if pdf.getNumPages() > 0:
+                bbox = pdf.getPage(0).mediaBox
+                map_any(file, bbox, 'width', f=lambda b: points_from_bbox(b, 0), c=points_to_mm)
+                map_any(file, bbox, 'height', f=lambda b: points_from_bbox(b, 1), c=points_to_mm)
+    return file
+
+
+# Increase when the values extracted by EXTRACTORS change, so values stored in the metadata cache and extended
+# attributes by other versions are extracted again.
+EXTRACTOR_VERSION = 3
+AUDIO_FIELDS = ['title', 'album', 'artist', 'tracknumber', 'genre', 'date', 'bitrate', 'samplerate', 'length']
+MEDIA_FIELDS = ['format', 'duration', 'overall_bitrate', 'frame_count', 'video_format', 'width', 'height', 'bit_depth',
+                'audio_format']
+# Every extractor with the mime types it handles and the columns it fills. A mime type ending with '/*' matches the
+# whole family. An extractor is skipped when none of its columns are visible. The columns of slow extractors are shown
+# after the ones of the other extractors of the file.
+EXTRACTORS = [
+    {'name': 'audio', 'mime_types': AUDIO_MIME_TYPES + AUDIO_MEDIA_MIME_TYPES, 'extract': extract_audio,
+     'fields': AUDIO_FIELDS},
+    {'name': 'image', 'mime_types': ['image/*'], 'extract': extract_image,
+     'fields': ['aperture_value', 'artist', 'brightness_value', 'datetime_original', 'exposure_bias_value',
+                'exposure_mode', 'exposure_time', 'flash', 'fnumber', 'focal_length', 'gain_control', 'gps_altitude',
+                'gps_latitude', 'gps_longitude', 'iso_speed', 'light_source', 'max_aperture_value', 'metering_mode',
+                'model', 'orientation', 'resolution_unit', 'shutter_speed_value', 'title', 'xresolution',
+                'yresolution', 'width', 'height']},
+    # Waiting for mediainfo includes the window of its batch, the batch and the retry of the file when the batch
+    # failed, both of which are killed after TIMEOUT seconds.
+    {'name': 'mediainfo', 'mime_types': MEDIAINFO_MIME_TYPES + AUDIO_MEDIA_MIME_TYPES, 'extract': extract_mediainfo,
+     'fields': MEDIA_FIELDS, 'slow': True, 'timeout': 2 * TIMEOUT + BATCH_WINDOW},
+    {'name': 'pdf', 'mime_types': ['application/pdf'],
+     'extract': lambda file, filename: extract_pdf(file, filename, pages=False),
+     'fields': ['title', 'artist']},
+    {'name': 'pdf_pages', 'mime_types': ['application/pdf'],
+     'extract': lambda file, filename: extract_pdf(file, filename, info=False),
+     'fields': ['pages', 'width', 'height'], 'slow': True},
+]
+SLOW_EXTRACTORS = frozenset(extractor['name'] for extractor in EXTRACTORS if extractor.get('slow'))
+
+
+def compile_extractors(extractors):
+    """
+    Compile the extractors to a dict mapping each mime type, or mime family ending with '/*', to the extractors that
+    handle it, in order of `extractors`. The fields of every extractor are made a frozenset.
+    """
+    by_mime = {}
+    for extractor in extractors:
+        extractor['fields'] = frozenset(extractor['fields'])
+        for mime_type in extractor['mime_types']:
+            by_mime.setdefault(mime_type, []).append(extractor)
+
+    compiled = {}
+    for mime_type, matched in by_mime.items():
+        # Exact mime types are handled by the extractors of their family too.
+        family = by_mime.get(mime_type.split('/')[0] + '/*', []) if not mime_type.endswith('/*') else []
+        compiled[mime_type] = tuple(e for e in extractors if e in matched or e in family)
+    return compiled
+
+
+EXTRACTORS_BY_MIME = compile_extractors(EXTRACTORS)
+
+
+def extractors_for(mime_type):
+    """
+    The extractors for a mime type, with a single dict lookup once the mime type has been seen.
+    """
+    extractors = EXTRACTORS_BY_MIME.get(mime_type)
+    if extractors is None:
+        # Other mime types of a family, e.g. image/png, are added on first use.
+        family = EXTRACTORS_BY_MIME.get(mime_type.split('/')[0] + '/*', ())
+        extractors = EXTRACTORS_BY_MIME.setdefault(mime_type, family)
+    return extractors
+
+
+def needed_extractors(mime_type, visible=None):
+    """
+    The names of the extractors to run for a mime type.
+
+    :param mime_type: the mime type of the file.
+    :param visible: the names of the visible columns, or None when all columns are needed.
+    :return: the names of the extractors, in order of EXTRACTORS.
+    """
+    return [extractor['name'] for extractor in extractors_for(mime_type)
+            if visible is None or not visible.isdisjoint(extractor['fields'])]
+
+
+def extract_columns(filename, mime_type, extractors=None):
+    """
+    Extract the column values of a single file. This does not touch any Nautilus object, so it is safe to call it
+    from a worker thread.
+
+    :param filename: the absolute path of the file.
+    :param mime_type: the mime type of the file, as reported by Nautilus.
+    :param extractors: the names of the extractors to run, all extractors for the mime type when None.
+    :return: a ColumnValues dict with the extracted values. The columns of extractors that timed out or failed show
+        'Error', and the extractors are listed in `failed`.
+    """
+    file = ColumnValues()
+    for extractor in extractors_for(mime_type):
+        if extractors is None or extractor['name'] in extractors:
+            try:
+                run_extractor(extractor, file, filename)
+            except Exception as error:
+                file.fail(extractor['name'], f'{type(error).__name__}: {error}')
+                for field in extractor['fields']:
+                    if field not in file:
+                        file.add_string_attribute(field, _('Error'))
+    return file
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def run_extractor(extractor, file, filename, timeout=None):
+    """
+    Run a single extractor and add its values to file. The extractor runs on a thread of its own, which is abandoned
+    when it does not finish within timeout: a Python thread cannot be stopped, but its values are dropped and the
+    caller can go on. The abandoned thread keeps running, and using memory, until the parser finishes or fails.
+    MEMORY_LIMIT does not apply to it, as it would limit Nautilus itself. The parsers reading whole files therefore
+    run in parser_pool, where they are limited and killed instead.
+
+    Extractors raise their errors, e.g. an unreadable file or a missing mediainfo, instead of leaving their columns
+    empty: extract_columns then remembers the extractor as failed, rather than caching empty columns as extracted.
+
+    :param timeout: the timeout in seconds, the 'timeout' of the extractor or TIMEOUT when None, and no timeout when 0.
+    :raises ExtractionTimeout: when the extractor did not finish in time.
+    """
+    if timeout is None:
+        timeout = extractor.get('timeout', TIMEOUT) if TIMEOUT > 0 else 0
+    values = ColumnValues()
+    start = time.perf_counter()
+    try:
+        if timeout > 0:
+            future = Future()
+            thread = threading.Thread(target=run_future, args=(future, extractor['extract'], values, filename),
+                                      name=f"{APP}-{extractor['name']}", daemon=True)
+            thread.start()
+            try:
+                future.result(timeout)
+            except FutureTimeoutError:
+                stats.increment('extractor_timeouts')
+                raise ExtractionTimeout(f"{extractor['name']} did not finish within {timeout} s") from None
+        else:
+            extractor['extract'](values, filename)
+    except Exception:
+        values.errors += 1
+        raise
+    finally:
+        stats.record(extractor['name'], filename, time.perf_counter() - start, values.bytes_read, values.errors)
+        file.bytes_read += values.bytes_read
+        file.errors += values.errors
+    file.update(values)
+    file.add_extractor(extractor['name'])
+
+
+def run_future(future, function, *args):
+    try:
+        future.set_result(function(*args))
+    except BaseException as error:
+        future.set_exception(error)
+
+
+def content_fingerprint(filename, mime_type, size):
+    """
+    A cheap fingerprint of the content of a file: its size and mime type, and a hash of the first and last
+    FINGERPRINT_SIZE bytes. Copies of a file have the same fingerprint, wherever they are. Files that only differ in
+    the middle do too, which is unlikely for media files as their headers and trailers hold the metadata.
+
+    :return: the fingerprint, or None when it is disabled or the file cannot be read.
+    """
+    if FINGERPRINT_SIZE <= 0:
+        return None
+    digest = hashlib.blake2b(f'{mime_type}\0{size}\0'.encode(), digest_size=16)
+    try:
+        with open(filename, 'rb') as f:
+            digest.update(f.read(FINGERPRINT_SIZE))
+            if size > FINGERPRINT_SIZE:
+                f.seek(max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE))
+                digest.update(f.read(FINGERPRINT_SIZE))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class MetadataCache:
+    """
+    MetadataCache stores the extracted column values of files in a SQLite database, so unchanged files do not have to
+    be parsed again when a directory is reopened:
+        cache = MetadataCache('/path/to/metadata.sqlite')
+        stamp = cache.stamp(filename)
+        columns = cache.get(filename, stamp)
+    Entries are keyed on the absolute path and validated against the inode, modification time and size of the file.
+    The cache is cleared when it was written by another EXTRACTOR_VERSION. When the cache grows beyond `max_entries`,
+    the least recently used entries are evicted.
+
+    Every entry is also written to the metadata index, a table with a typed column for every column in
+    COLUMN_DEFINITIONS, which answers queries over a directory tree without reading the files again:
+        cache.query([('duration', '>', 600), ('width', '>=', 1920)], directory='/home/user/Videos')
+    The index entry of a file is deleted together with its cached entry, when the file changed or the entry is evicted.
+
+    Entries can also be found by the `content_fingerprint` of the file, so copies of a file at other paths reuse its
+    column values.
+    """
+
+    # Evict after this number of writes, instead of checking the size of the cache on every write.
+    EVICT_INTERVAL = 1000
+
+    def __init__(self, path, max_entries=CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.writes = 0
+        self.lock = threading.Lock()
+        # The connection is shared by the worker threads, access is serialized by the lock.
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # The write-ahead log needs shared memory between processes, which network filesystems like NFS lack.
+        network = Mounts().for_path(os.path.abspath(path)).kind == 'network'
+        self.connection.execute(f'PRAGMA journal_mode={"DELETE" if network else "WAL"}')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS columns ('
+                                'path TEXT PRIMARY KEY, inode INTEGER, mtime INTEGER, size INTEGER, '
+                                'accessed REAL, data TEXT, extractors TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS columns_accessed ON columns (accessed)')
+        if 'fingerprint' not in {row[1] for row in self.connection.execute('PRAGMA table_info(columns)')}:
+            self.connection.execute('ALTER TABLE columns ADD COLUMN fingerprint TEXT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS columns_fingerprint ON columns (fingerprint)')
+        # The negative cache: extractors that timed out or failed on a file.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS failures ('
+                                'path TEXT, extractor TEXT, inode INTEGER, mtime INTEGER, size INTEGER, '
+                                'failed REAL, reason TEXT, PRIMARY KEY (path, extractor))')
+        self.create_index()
+        # The values extracted by another version of the extractors are extracted again.
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != EXTRACTOR_VERSION:
+            for table in ('columns', 'failures', 'metadata'):
+                self.connection.execute(f'DELETE FROM {table}')
+            self.connection.execute(f'PRAGMA user_version = {EXTRACTOR_VERSION}')
+
+    # The operators of query conditions, ~ matches text containing the value regardless of case.
+    OPERATORS = {'=': '"{}" = ?', '!=': '"{}" != ?', '<': '"{}" < ?', '<=': '"{}" <= ?', '>': '"{}" > ?',
+                 '>=': '"{}" >= ?', '~': 'instr(lower("{}"), lower(?)) > 0'}
+
+    def create_index(self):
+        """
+        Create the metadata index, adding the columns that were defined since it was created.
+        """
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY)')
+        if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'columns_deleted'"
+                                   ).fetchone() is None:
+            # Caches from before the trigger kept the index entries of deleted entries.
+            self.connection.execute('DELETE FROM metadata WHERE path NOT IN (SELECT path FROM columns)')
+            self.connection.execute('CREATE TRIGGER columns_deleted AFTER DELETE ON columns '
+                                    'BEGIN DELETE FROM metadata WHERE path = old.path; END')
+        existing = {row[1] for row in self.connection.execute('PRAGMA table_info(metadata)')}
+        for field in COLUMN_ORDER:
+            if field not in existing:
+                self.connection.execute(f'ALTER TABLE metadata ADD COLUMN "{field}" '
+                                        f'{INDEX_AFFINITY[COLUMN_TYPES[field]]}')
+        names = ', '.join(f'"{field}"' for field in COLUMN_ORDER)
+        self.index_insert = f'INSERT OR REPLACE INTO metadata (path, {names}) VALUES (?{", ?" * len(COLUMN_ORDER)})'
+
+    @classmethod
+    def open_default(cls):
+        """
+        Open the cache within CACHE_DIR, or return None when it is disabled or cannot be created.
+        """
+        if CACHE_SIZE <= 0:
+            return None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            return cls(os.path.join(CACHE_DIR, 'metadata.sqlite'))
+        except (OSError, sqlite3.Error) as error:
+            print(f"WARNING! Metadata cache disabled: {error}")
+            return None
+
+    @staticmethod
+    def stamp(filename):
+        """
+        The validity stamp of a file, a cached entry is only used when the stamp did not change.
+        """
+        stat = os.stat(filename)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self, filename, stamp):
+        path = os.path.abspath(filename)
+        try:
+            with self.lock:
+                row = self.connection.execute('SELECT inode, mtime, size, data, extractors FROM columns WHERE path = ?',
+                                              (path,)).fetchone()
+                if row is None:
+                    return None
+                if tuple(row[:3]) != tuple(stamp):
+                    # The file changed since it was cached.
+                    self.connection.execute('DELETE FROM columns WHERE path = ?', (path,))
+                    return None
+                self.connection.execute('UPDATE columns SET accessed = ? WHERE path = ?', (time.time(), path))
+        except sqlite3.Error:
+            # E.g. the database is locked by another Nautilus process, extracting again is always correct.
+            return None
+        return ColumnValues(json.loads(row[3]), extractors=filter(None, row[4].split(',')))
+
+    def find(self, fingerprint, filename):
+        """
+        The column values of another file with the same content fingerprint, or None when there is none.
+        """
+        try:
+            with self.lock:
+                row = self.connection.execute('SELECT path, data, extractors FROM columns '
+                                              'WHERE fingerprint = ? AND path != ? ORDER BY accessed DESC LIMIT 1',
+                                              (fingerprint, os.path.abspath(filename))).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute('UPDATE columns SET accessed = ? WHERE path = ?', (time.time(), row[0]))
+        except sqlite3.Error:
+            return None
+        return ColumnValues(json.loads(row[1]), extractors=filter(None, row[2].split(',')))
+
+    def deduplicate(self, filename, mime_type, stamp):
+        """
+        Find the cached column values of a copy of a file that is not cached itself.
+
+        :return: the fingerprint of the file, to cache its values with, and the column values of the copy, or None
+            when no copy was extracted yet. Only the values of the extractors that completed on the copy are reused,
+            the others are run on the file itself.
+        """
+        fingerprint = content_fingerprint(filename, mime_type, stamp[2])
+        if fingerprint is None:
+            return None, None
+        columns = self.find(fingerprint, filename)
+        if columns is None:
+            stats.increment('dedupe_misses')
+        else:
+            stats.increment('dedupe_hits')
+            stats.increment('dedupe_bytes', stamp[2])
+            # The columns of an extractor that failed on the copy show 'Error', which is not a value of this file.
+            completed = {field for extractor in extractors_for(mime_type) if extractor['name'] in columns.extractors
+                         for field in extractor['fields']}
+            columns = ColumnValues({field: value for field, value in columns.items() if field in completed},
+                                   extractors=columns.extractors)
+        return fingerprint, columns
+
+    def put(self, filename, stamp, columns, fingerprint=None):
+        path = os.path.abspath(filename)
+        try:
+            with self.lock:
+                self.connection.execute('INSERT OR REPLACE INTO columns '
+                                        '(path, inode, mtime, size, accessed, data, extractors, fingerprint) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        (path, *stamp, time.time(), json.dumps(dict(columns)),
+                                         ','.join(sorted(getattr(columns, 'extractors', ()))), fingerprint))
+                self.index(path, columns)
+                self.writes += 1
+                if self.writes % self.EVICT_INTERVAL == 0:
+                    self.evict()
+        except sqlite3.Error as error:
+            print(f"WARNING! Could not cache metadata of {path}: {error}")
+
+    def failed(self, filename, stamp, retry=None):
+        """
+        The names of the extractors that timed out or failed on the file within the last `retry` seconds
+        (FAILURE_RETRY by default), and did not change since.
+        """
+        retry = FAILURE_RETRY if retry is None else retry
+        try:
+            with self.lock:
+                rows = self.connection.execute('SELECT extractor FROM failures '
+                                               'WHERE path = ? AND inode = ? AND mtime = ? AND size = ? AND failed > ?',
+                                               (os.path.abspath(filename), *stamp, time.time() - retry)).fetchall()
+        except sqlite3.Error:
+            return set()
+        return {row[0] for row in rows}
+
+    def put_failures(self, filename, stamp, failures):
+        """
+        Remember the extractors that timed out or failed on the file.
+
+        :param failures: a dict of extractor names to the reason of the failure.
+        """
+        path = os.path.abspath(filename)
+        try:
+            with self.lock:
+                self.connection.executemany('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            [(path, extractor, *stamp, time.time(), reason)
+                                             for extractor, reason in failures.items()])
+        except sqlite3.Error as error:
+            print(f"WARNING! Could not cache failures of {path}: {error}")
+
+    def evict(self):
+        """
+        Remove the least recently used entries above `max_entries`, and the failures that expired. The caller must
+        hold the lock.
+        """
+        self.connection.execute('DELETE FROM columns WHERE path IN '
+                                '(SELECT path FROM columns ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                (self.max_entries,))
+        self.connection.execute('DELETE FROM failures WHERE failed <= ?', (time.time() - FAILURE_RETRY,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM columns').fetchone()[0]
+
+    def index(self, path, columns):
+        """
+        Write the typed values of the columns of a file to the metadata index. The caller must hold the lock.
+        """
+        self.connection.execute(self.index_insert,
+                                (path, *(index_value(field, columns.get(field)) for field in COLUMN_ORDER)))
+
+    def reindex(self):
+        """
+        Rebuild the metadata index from the cached entries, e.g. for a cache written before the index existed.
+
+        :return: the number of indexed files.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT path, data FROM columns').fetchall()
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.execute('DELETE FROM metadata')
+                for path, data in rows:
+                    self.index(path, json.loads(data))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    def indexed(self):
+        """
+        The number of files in the metadata index.
+        """
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+
+    def query(self, conditions, directory=None, fields=()):
+        """
+        Find the files in the metadata index matching all conditions.
+
+        :param conditions: (field, operator, value) tuples, see OPERATORS and `parse_condition`. Values are compared
+            with the typed values, so they should be converted with `index_value` first.
+        :param directory: only return files within this directory tree.
+        :param fields: the columns to return for every file.
+        :return: a list of (path, values of fields) tuples, ordered by path. Files that were removed or changed since
+            they were indexed are left out.
+        """
+        clauses, parameters = [], []
+        if directory is not None:
+            directory = os.path.abspath(directory).rstrip('/')
+            # All paths starting with the directory and a slash, '0' is the character after '/'.
+            clauses.append('metadata.path >= ? AND metadata.path < ?')
+            parameters += [directory + '/', directory + '0']
+        for field, operator, value in conditions:
+            if field not in COLUMN_INDEX:
+                raise ValueError(f"Unknown column '{field}'.")
+            clauses.append(self.OPERATORS[operator].format(field))
+            parameters.append(value)
+        columns = ''.join(f', "{field}"' for field in fields if field in COLUMN_INDEX)
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        with self.lock:
+            rows = self.connection.execute(f'SELECT metadata.path, inode, mtime, size{columns} FROM metadata '
+                                           f'JOIN columns ON columns.path = metadata.path{where} '
+                                           'ORDER BY metadata.path', parameters).fetchall()
+        results = []
+        for path, inode, mtime, size, *values in rows:
+            try:
+                if self.stamp(path) != (inode, mtime, size):
+                    continue
+            except OSError:
+                continue
+            results.append((path, tuple(values)))
+        return results
+
+
+class XattrStore:
+    """
+    XattrStore keeps the extracted column values in an extended attribute of the file itself, so every machine showing
+    the file, e.g. on a shared NAS, reuses the metadata extracted by the first one:
+        xattrs = XattrStore()
+        columns = xattrs.get(filename, stamp)
+        xattrs.put(filename, stamp, columns)
+    Values are only used when the modification time and size of the file and EXTRACTOR_VERSION did not change, the
+    inode may differ between machines. Directories on filesystems without user extended attributes are skipped.
+    """
+
+    ATTRIBUTE = 'user.nautilus-columns.columns'
+
+    def __init__(self):
+        # Directories of which the filesystem does not support user extended attributes.
+        self.unsupported = set()
+
+    @classmethod
+    def open_default(cls):
+        """
+        Return a XattrStore when XATTRS is enabled and the platform has extended attributes, None otherwise.
+        """
+        if not XATTRS or not hasattr(os, 'getxattr'):
+            return None
+        return cls()
+
+    def get(self, filename, stamp):
+        if os.path.dirname(filename) in self.unsupported:
+            return None
+        try:
+            entry = json.loads(os.getxattr(filename, self.ATTRIBUTE))
+            if entry['version'] != EXTRACTOR_VERSION or entry['stamp'] != list(stamp[1:]):
+                return None
+            return ColumnValues(entry['data'], extractors=entry['extractors'])
+        except OSError as error:
+            # ENODATA when the file has no values yet.
+            if error.errno == errno.ENOTSUP:
+                self.unsupported.add(os.path.dirname(filename))
+            return None
+        except (ValueError, KeyError, TypeError):
+            # Written by something else, it is overwritten by the next put.
+            return None
+
+    def put(self, filename, stamp, columns):
+        if os.path.dirname(filename) in self.unsupported:
+            return
+        entry = {'version': EXTRACTOR_VERSION, 'stamp': list(stamp[1:]), 'extractors': sorted(columns.extractors),
+                 'data': dict(columns)}
+        try:
+            os.setxattr(filename, self.ATTRIBUTE, json.dumps(entry).encode())
+        except OSError as error:
+            # E.g. no write permission, a read-only filesystem or values exceeding the size of an attribute.
+            if error.errno == errno.ENOTSUP:
+                self.unsupported.add(os.path.dirname(filename))
+
+
+class MemoryCache:
+    """
+    MemoryCache keeps the column values of the most recently used files in memory, in front of the metadata cache and
+    the extractors. Nautilus asks for the same files again and again, e.g. when a thumbnail is ready or a file is
+    renamed, and these requests are served without touching the disk:
+        memory = MemoryCache(max_entries=10000)
+        columns = memory.get((uri, mtime, size), ['pdf'], lambda: extract_columns(filename, mime_type))
+    Requests for a file that is being extracted wait for that extraction, instead of extracting it again.
+    """
+
+    def __init__(self, max_entries=MEMORY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # Maps the keys of the files being extracted to the future of their values.
+        self.running = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def covers(columns, extractors):
+        # Extractors that failed are not run again for a while, they count as done.
+        return all(name in columns.extractors or name in columns.failed for name in extractors)
+
+    def get(self, key, extractors, extract):
+        """
+        Get the column values of a file.
+
+        :param key: identifies the file and its version, e.g. (uri, mtime, size).
+        :param extractors: the names of the extractors of which the values are needed.
+        :param extract: the function to get the column values when they are not in memory.
+        :return: a ColumnValues dict, which must not be changed.
+        """
+        with self.lock:
+            columns = self.entries.get(key)
+            if columns is not None and self.covers(columns, extractors):
+                self.entries.move_to_end(key)
+                stats.increment('memory_hits')
+                return columns
+            future = self.running.get(key)
+            if future is None:
+                future = self.running[key] = Future()
+                running = None
+            else:
+                running = future
+
+        if running is not None:
+            stats.increment('memory_coalesced')
+            columns = running.result()
+            if self.covers(columns, extractors):
+                return columns
+            # Extracted for other columns, e.g. before the visible columns changed.
+            return self.get(key, extractors, extract)
+
+        stats.increment('memory_misses')
+        try:
+            columns = extract()
+        except BaseException as error:
+            with self.lock:
+                del self.running[key]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.running[key]
+            if self.max_entries > 0:
+                self.entries[key] = columns
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        future.set_result(columns)
+        return columns
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class VisibleColumns:
+    """
+    VisibleColumns follows which of the columns are visible in the list view of Nautilus, so the extractors of hidden
+    columns can be skipped:
+        visible = VisibleColumns(on_changed=callback)
+        names = visible.names_for(filename)
+    Folders with their own visible columns override the default of the list view. `names_for` returns None when all
+    columns are needed, e.g. when the settings schema of Nautilus is not installed. The columns of a folder are looked
+    up once per FOLDER_TTL seconds, instead of for every file within it, and on_changed is also called when they
+    changed since the last look up.
+    """
+
+    SCHEMA = 'org.gnome.nautilus.list-view'
+    KEY = 'default-visible-columns'
+    FOLDER_ATTRIBUTE = 'metadata::nautilus-list-view-visible-columns'
+    # The name Nautilus uses for a column, see `ColumnExtension.jsonToColumn`.
+    COLUMN_NAME = re.compile(r'NautilusPython::(\w+)_column')
+    # Seconds the visible columns of a folder are remembered, and the maximum number of folders remembered.
+    FOLDER_TTL = 5
+    MAX_FOLDERS = 1000
+
+    def __init__(self, on_changed=None):
+        self.on_changed = on_changed
+        self.default = None
+        self.settings = None
+        # Maps a folder to the time its columns were looked up and its column names, None for the default.
+        self.folders = {}
+
+        source = Gio.SettingsSchemaSource.get_default()
+        if not VISIBLE_ONLY or source is None or source.lookup(self.SCHEMA, True) is None:
+            return
+        self.settings = Gio.Settings.new(self.SCHEMA)
+        self.settings.connect(f'changed::{self.KEY}', self.changed)
+        self.default = self.column_names(self.settings.get_strv(self.KEY))
+
+    @classmethod
+    def column_names(cls, columns):
+        return frozenset(match.group(1) for match in map(cls.COLUMN_NAME.fullmatch, columns) if match)
+
+    def changed(self, settings, key):
+        self.default = self.column_names(settings.get_strv(key))
+        self.folders = {}
+        if self.on_changed is not None:
+            self.on_changed()
+
+    def names_for(self, filename):
+        if self.default is None:
+            return None
+        folder = os.path.dirname(filename)
+        now = time.monotonic()
+        cached = self.folders.get(folder)
+        if cached is not None and now - cached[0] < self.FOLDER_TTL:
+            return cached[1] if cached[1] is not None else self.default
+
+        names = None
+        try:
+            directory = Gio.File.new_for_path(folder)
+            info = directory.query_info(self.FOLDER_ATTRIBUTE, Gio.FileQueryInfoFlags.NONE, None)
+            columns = info.get_attribute_stringv(self.FOLDER_ATTRIBUTE)
+            if columns:
+                names = self.column_names(columns)
+        except GLib.Error:
+            pass
+        if len(self.folders) >= self.MAX_FOLDERS:
+            self.folders = {}
+        self.folders[folder] = (now, names)
+        if cached is not None and cached[1] != names and self.on_changed is not None:
+            # Looked up on the workers, while the files must be invalidated on the main thread.
+            GLib.idle_add(self.on_changed)
+        return names if names is not None else self.default
+
+
+##################
+# i/o scheduling #
+##################
+def parse_concurrency(value):
+    """
+    Parse the concurrency per kind of filesystem or mount point, e.g. 'network=2,/media/nas=8', into a dict. Every kind
+    that is not mentioned can use all WORKERS.
+    """
+    concurrency = {'local': WORKERS, 'rotational': WORKERS, 'network': WORKERS}
+    for item in filter(None, value.split(',')):
+        try:
+            key, limit = item.rsplit('=', 1)
+            concurrency[key.strip()] = max(1, int(limit))
+        except ValueError:
+            print(f"WARNING! Ignoring concurrency '{item}', expected kind=number or /mount/point=number.")
+    return concurrency
+
+
+class Mount:
+    """
+    A mounted filesystem, with the kind that decides how files on it are scheduled: 'network', 'rotational' for
+    spinning disks or 'local' for the others.
+    """
+
+    __slots__ = ('mount_point', 'fstype', 'source', 'device', 'kind')
+
+    def __init__(self, mount_point, fstype, source, device):
+        self.mount_point = mount_point
+        self.fstype = fstype
+        self.source = source
+        self.device = device
+        self.kind = 'local'
+
+    def __repr__(self):
+        return f'Mount({self.mount_point!r}, {self.fstype!r}, {self.kind!r})'
+
+
+class Mounts:
+    """
+    Mounts finds the filesystem of a path from /proc/self/mountinfo, without touching the path itself, so it is safe on
+    the main thread even for unreachable network shares:
+        mounts = Mounts()
+        mount = mounts.for_path('/media/nas/movie.mkv')
+        mount.kind
+    The mount table is read again when it is older than REFRESH seconds.
+    """
+
+    MOUNTINFO = '/proc/self/mountinfo'
+    REFRESH = 10
+    NETWORK_FSTYPES = frozenset(['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ceph', 'glusterfs', 'davfs', '9p',
+                                 'fuse.sshfs', 'fuse.rclone', 'fuse.gvfsd-fuse'])
+    ESCAPE = re.compile(r'\\([0-7]{3})')
+
+    def __init__(self, lines=None):
+        self.mounts = []
+        self.read = 0
+        if lines is not None:
+            self.mounts = self.parse(lines)
+            self.read = math.inf
+
+    @classmethod
+    def parse(cls, lines):
+        """
+        Parse the lines of mountinfo, see proc(5).
+
+        :return: the mounts, the longest mount points first.
+        """
+        mounts = []
+        for line in lines:
+            fields = line.split()
+            try:
+                separator = fields.index('-')
+                mount = Mount(cls.ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), fields[4]),
+                              fields[separator + 1], fields[separator + 2], fields[2])
+            except (ValueError, IndexError):
+                continue
+            mount.kind = cls.kind(mount)
+            mounts.append(mount)
+        return sorted(mounts, key=lambda m: len(m.mount_point), reverse=True)
+
+    @classmethod
+    def kind(cls, mount):
+        if mount.fstype in cls.NETWORK_FSTYPES or mount.source.startswith('//'):
+            return 'network'
+        device = mount.device
+        if device.startswith('0:') and mount.source.startswith('/dev/'):
+            # E.g. btrfs reports an anonymous device, the block device is the source.
+            try:
+                rdev = os.stat(mount.source).st_rdev
+                device = f'{os.major(rdev)}:{os.minor(rdev)}'
+            except OSError:
+                return 'local'
+        # Partitions have no queue of their own, it is the one of their disk.
+        for path in (f'/sys/dev/block/{device}/queue/rotational', f'/sys/dev/block/{device}/../queue/rotational'):
+            try:
+                with open(path) as f:
+                    return 'rotational' if f.read().strip() == '1' else 'local'
+            except OSError:
+                continue
+        return 'local'
+
+    def for_path(self, path):
+        if time.monotonic() - self.read > self.REFRESH:
+            try:
+                with open(self.MOUNTINFO) as f:
+                    self.mounts = self.parse(f)
+            except OSError:
+                self.mounts = []
+            self.read = time.monotonic()
+        for mount in self.mounts:
+            if path == mount.mount_point or path.startswith(mount.mount_point.rstrip('/') + '/'):
+                return mount
+        return Mount('/', 'unknown', 'unknown', '0:0')
+
+
+class MountQueue:
+    """
+    The queued files of a single mount, extracted at most `limit` at the same time. Files on spinning disks are
+    extracted in order of path, so the files of a directory, which filesystems tend to place together, are read one
+    after the other. The path is used instead of the inode, as files are queued on the main thread, which must not wait
+    for a disk that is spun down.
+
+    The limit adapts to the latency, like TCP congestion control: when the recent latency is well above the long term
+    latency, the disk or network is saturated and the limit is halved, otherwise it grows by one until `max_limit`. The
+    latency is tracked per phase, as the slow phase takes much longer than the fast phase of the same file.
+
+    Batched jobs, the slow phases that wait for a mediainfo batch, share a slot per `batch_size` jobs, because a whole
+    batch is read by a single mediainfo process.
+    """
+
+    # Weights of a new latency in the recent and long term averages.
+    RECENT = 0.2
+    LONG_TERM = 0.02
+    # Back off when the recent latency is this many times the long term latency.
+    BACKOFF = 2.0
+
+    def __init__(self, mount, max_limit, batch_size=None):
+        self.mount = mount
+        self.max_limit = max_limit
+        self.limit = max_limit
+        if batch_size is None:
+            batch_size = BATCH_SIZE if BATCH_WINDOW > 0 else 1
+        self.batch_size = max(1, batch_size)
+        # The number of running jobs that are not batched, and that are.
+        self.running = 0
+        self.batched = 0
+        self.jobs = []
+        self.sequence = 0
+        # The average latencies by phase.
+        self.recent = {}
+        self.long_term = {}
+        # Files done since the limit changed, the limit only changes after a full round at the current limit.
+        self.done_since = 0
+
+    def push(self, filename, job, batched=False):
+        order = filename if self.mount.kind == 'rotational' else ''
+        self.sequence += 1
+        heapq.heappush(self.jobs, (order, self.sequence, batched, job))
+
+    def pop(self):
+        return heapq.heappop(self.jobs)[3]
+
+    def slots(self, batched=0):
+        """
+        The number of slots taken by the running jobs, with `batched` more batched jobs.
+        """
+        return self.running + -(-(self.batched + batched) // self.batch_size)
+
+    def start(self):
+        """
+        Pop the next job and take its slot, or return None when the mount has no slot left for it.
+        :return: the job and whether it is batched, or None.
+        """
+        if not self.jobs:
+            return None
+        batched = self.jobs[0][2]
+        if (self.slots(1) if batched else self.slots() + 1) > self.limit:
+            return None
+        if batched:
+            self.batched += 1
+        else:
+            self.running += 1
+        return self.pop(), batched
+
+    def finish(self, batched):
+        if batched:
+            self.batched -= 1
+        else:
+            self.running -= 1
+
+    def done(self, seconds, phase='fast'):
+        recent = self.recent.get(phase)
+        if recent is None:
+            recent = long_term = seconds
+        else:
+            long_term = self.long_term[phase]
+            recent += (seconds - recent) * self.RECENT
+            long_term += (seconds - long_term) * self.LONG_TERM
+        self.recent[phase], self.long_term[phase] = recent, long_term
+        self.done_since += 1
+        if self.done_since < self.limit:
+            return
+        if recent > self.BACKOFF * long_term and self.limit > 1:
+            self.limit = max(1, self.limit // 2)
+            stats.increment('mount_backoffs')
+            self.done_since = 0
+        elif recent <= long_term and self.limit < self.max_limit:
+            self.limit += 1
+            self.done_since = 0
+
+
+class IOScheduler:
+    """
+    IOScheduler runs the extraction of files on the executor through a queue per mount, so a slow network share gets a
+    few files at the same time and does not hold all workers, while local disks use all of them:
+        scheduler = IOScheduler(executor)
+        future = scheduler.submit(filename, extract, uri, mime_type)
+    The returned future can be cancelled as long as the file is queued. Slow phases are submitted with phase='slow',
+    and with batched=True when they may wait for a mediainfo batch, see MountQueue.
+    """
+
+    def __init__(self, executor, mounts=None, concurrency=None):
+        self.executor = executor
+        self.mounts = mounts or Mounts()
+        self.concurrency = concurrency or parse_concurrency(CONCURRENCY)
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, filename, function, *args, phase='fast', batched=False, **kwargs):
+        future = Future()
+        mount = self.mounts.for_path(filename)
+        with self.lock:
+            queue = self.queues.get(mount.mount_point)
+            if queue is None:
+                limit = self.concurrency.get(mount.mount_point, self.concurrency.get(mount.kind, WORKERS))
+                queue = self.queues[mount.mount_point] = MountQueue(mount, limit)
+            queue.push(filename, (future, function, args, kwargs, phase), batched)
+            self.schedule(queue)
+        return future
+
+    def schedule(self, queue):
+        """
+        Start queued files while the mount has slots left. The caller must hold the lock.
+        """
+        started = queue.start()
+        while started is not None:
+            self.executor.submit(self.run, queue, *started)
+            started = queue.start()
+
+    def run(self, queue, job, batched=False):
+        future, function, args, kwargs, phase = job
+        start = time.perf_counter()
+        cancelled = not future.set_running_or_notify_cancel()
+        try:
+            if not cancelled:
+                future.set_result(function(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self.lock:
+                queue.finish(batched)
+                if not cancelled:
+                    queue.done(time.perf_counter() - start, phase)
+                self.schedule(queue)
+
+
+class ColumnExtension(GObject.GObject,
+                      FileManager.ColumnProvider,
+                      FileManager.InfoProvider):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Extraction is done on a pool of worker threads, so the main thread of Nautilus is never blocked.
+        self.executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix=APP)
+        # Files are queued per mount before they get a worker, see IOScheduler.
+        self.scheduler = IOScheduler(self.executor)
+        # Maps the Nautilus operation handle to the future of the running extraction and the directory of its file, only
+        # used on the main thread.
+        self.pending = {}
+        self.cache = MetadataCache.open_default()
+        self.xattrs = XattrStore.open_default()
+        self.memory = MemoryCache()
+        # The slow phase needs the memory cache, else the values would be extracted again when Nautilus asks for them,
+        # and the metadata cache, else a file evicted from memory before Nautilus asks again would lack them again.
+        self.progressive = PROGRESSIVE and self.memory.max_entries > 0 and self.cache is not None
+        # The futures of the queued slow phases, by directory and uri, so they are cancelled when leaving a directory.
+        self.slow_jobs = {}
+        # The (uri, mtime, size) of files of which the slow phase is done, least recent first. Their slow phase is not
+        # queued again when their values were evicted from memory before Nautilus asked for them.
+        self.slow_done = OrderedDict()
+        self.visible_columns = VisibleColumns(on_changed=self.visible_columns_changed)
+        # Uris of files of which extractors were skipped because their columns were hidden, least recent first.
+        self.partial_uris = OrderedDict()
+        self.lock = threading.Lock()
+        if stats.enabled:
+            GLib.timeout_add_seconds(STATS_INTERVAL, self.report_stats)
+
+    def get_columns(self):
+        return [self.jsonToColumn(column) for column in COLUMN_DEFINITIONS]
+
+    @staticmethod
+    def jsonToColumn(dict):
+        name = dict.get('name')
+        return FileManager.Column(name=f'NautilusPython::{name}_column',
+                                  attribute=name,
+                                  label=_(dict.get('label')),
+                                  description=_(dict.get('description')))
+
+    def update_file_info(self, file, **kwargs):
+        """
+        Synchronous variant, only used by Nautilus when `update_file_info_full` is not available.
+        """
+        if file.get_uri_scheme() != 'file':
+            return
+
+        self.extract(file.get_uri(), file.get_mime_type()).apply_to(file)
+
+    def update_file_info_full(self, provider, handle, closure, file):
+        """
+        Asynchronous variant. The extraction is queued on the worker pool and Nautilus is notified with
+        `info_provider_update_complete_invoke` as soon as the columns are ready. Only the fast extractors are waited
+        for, the columns of the slow ones follow when Nautilus asks again after `slow_phase_done`.
+        """
+        if file.get_uri_scheme() != 'file':
+            return FileManager.OperationResult.COMPLETE
+
+        # Nautilus objects may only be used on the main thread, so the uri and mime type are read here.
+        uri = file.get_uri()
+        filename = filename_from_uri(uri)
+        future = self.scheduler.submit(filename, self.extract, uri, file.get_mime_type(), slow=not self.progressive)
+        self.pending[handle] = (future, os.path.dirname(filename))
+        future.add_done_callback(
+            lambda f: GLib.idle_add(self.complete_update, provider, handle, closure, file, f))
+        return FileManager.OperationResult.IN_PROGRESS
+
+    def extract(self, uri, mime_type, slow=True):
+        """
+        Get the column values of the visible columns of a file. Without slow, only the fast extractors are run and the
+        slow ones are queued, unless their values are known already.
+        """
+        filename = filename_from_uri(uri)
+        extractors = needed_extractors(mime_type, self.visible_columns.names_for(filename))
+        with self.lock:
+            if len(extractors) < len(needed_extractors(mime_type)):
+                self.partial_uris[uri] = None
+                self.partial_uris.move_to_end(uri)
+                # Like the memory cache, only the files Nautilus asked for recently are remembered.
+                while len(self.partial_uris) > max(self.memory.max_entries, 1):
+                    self.partial_uris.popitem(last=False)
+            else:
+                self.partial_uris.pop(uri, None)
+        deferred = [] if slow else [name for name in extractors if name in SLOW_EXTRACTORS]
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return self.columns_for(filename, mime_type, extractors)
+        fast = [name for name in extractors if name not in deferred]
+        key = (uri, stat.st_mtime_ns, stat.st_size)
+        columns = self.memory.get(key, fast, lambda: self.columns_for(filename, mime_type, fast))
+
+        if deferred and not MemoryCache.covers(columns, deferred):
+            directory = os.path.dirname(filename)
+            with self.lock:
+                jobs = self.slow_jobs.setdefault(directory, {})
+                if uri not in jobs and key not in self.slow_done:
+                    jobs[uri] = self.scheduler.submit(filename, self.extract_slow, uri, mime_type, phase='slow',
+                                                      batched='mediainfo' in deferred)
+        elif slow and not SLOW_EXTRACTORS.isdisjoint(extractors):
+            with self.lock:
+                self.slow_done[key] = None
+                self.slow_done.move_to_end(key)
+                while len(self.slow_done) > max(self.memory.max_entries, 1):
+                    self.slow_done.popitem(last=False)
+        return columns
+
+    def extract_slow(self, uri, mime_type):
+        """
+        The slow phase: extract all columns of the file, then let Nautilus know they changed.
+        """
+        try:
+            self.extract(uri, mime_type)
+        finally:
+            directory = os.path.dirname(filename_from_uri(uri))
+            with self.lock:
+                jobs = self.slow_jobs.get(directory, {})
+                jobs.pop(uri, None)
+                if not jobs:
+                    self.slow_jobs.pop(directory, None)
+        GLib.idle_add(self.slow_phase_done, uri)
+
+    def columns_for(self, filename, mime_type, extractors=None):
+        """
+        Get the column values of a file from the cache, or extract and cache them when the file is not cached yet or
+        changed since. Cached values are completed when they lack extractors that are needed now.
+        """
+        if not extractors_for(mime_type):
+            # E.g. text files and source code, these are not worth a stat, a fingerprint or a cache entry.
+            return ColumnValues()
+        if extractors is None:
+            extractors = needed_extractors(mime_type)
+        try:
+            stamp = MetadataCache.stamp(filename)
+        except OSError:
+            return extract_columns(filename, mime_type, extractors)
+
+        if self.cache is None:
+            return self.extract_uncached(filename, mime_type, stamp, ColumnValues(), extractors)
+        columns = self.cache.get(filename, stamp)
+        if columns is None:
+            stats.increment('cache_misses')
+            if not extractors:
+                return ColumnValues()
+            fingerprint, columns = self.cache.deduplicate(filename, mime_type, stamp)
+            if columns is None:
+                columns = ColumnValues()
+        else:
+            stats.increment('cache_hits')
+            if all(name in columns.extractors for name in extractors):
+                return columns
+            fingerprint = content_fingerprint(filename, mime_type, stamp[2])
+        if not all(name in columns.extractors for name in extractors):
+            columns = self.extract_uncached(filename, mime_type, stamp, columns, extractors)
+        self.cache.put(filename, stamp, columns, fingerprint)
+        return columns
+
+    def extract_uncached(self, filename, mime_type, stamp, columns, extractors):
+        """
+        Add the values of the extractors columns lacks: from the extended attributes when another machine extracted
+        them already, or by running the extractors. Extractors that recently timed out or failed on this file are not
+        run, their columns show 'Error' until FAILURE_RETRY passed or the file changed, so one bad file does not hang
+        every refresh of its folder.
+        """
+        if self.xattrs is not None:
+            shared = self.xattrs.get(filename, stamp)
+            if shared is not None:
+                stats.increment('xattr_hits')
+                columns.merge(shared)
+        missing = [name for name in extractors if name not in columns.extractors]
+        if not missing:
+            return columns
+
+        failed = self.cache.failed(filename, stamp) if self.cache is not None else set()
+        skipped = [name for name in missing if name in failed]
+        extracted = extract_columns(filename, mime_type, [name for name in missing if name not in failed])
+        columns.merge(extracted)
+        if skipped:
+            stats.increment('failures_skipped', len(skipped))
+            for extractor in extractors_for(mime_type):
+                if extractor['name'] in skipped:
+                    columns.fail(extractor['name'], 'Failed before')
+                    for field in extractor['fields']:
+                        columns.setdefault(field, _('Error'))
+        if extracted.failed:
+            stats.increment('extractor_failures', len(extracted.failed))
+            if self.cache is not None:
+                self.cache.put_failures(filename, stamp, extracted.failed)
+        if self.xattrs is not None and extracted.extractors:
+            self.xattrs.put(filename, stamp, columns)
+        return columns
+
+    def report_stats(self):
+        print(stats.log_line())
+        if STATS_PATH != '-':
+            try:
+                stats.dump(STATS_PATH)
+            except OSError as error:
+                print(f"WARNING! Could not write stats to {STATS_PATH}: {error}")
+        # Keep the timeout of GLib running.
+        return True
+
+    def visible_columns_changed(self):
+        # Files that were extracted partially lack the columns that may have become visible, let Nautilus ask again.
+        with self.lock:
+            uris, self.partial_uris = list(self.partial_uris), OrderedDict()
+        for uri in uris:
+            file = FileManager.FileInfo.lookup_for_uri(uri)
+            if file is not None:
+                file.invalidate_extension_info()
+
+    def slow_phase_done(self, uri):
+        # Nautilus asks for the columns again, and gets the values of all extractors from the memory cache.
+        file = FileManager.FileInfo.lookup_for_uri(uri)
+        if file is not None:
+            file.invalidate_extension_info()
+        # Remove from the idle queue of GLib.
+        return False
+
+    def complete_update(self, provider, handle, closure, file, future):
+        # A cancelled or superseded request must not be completed, Nautilus already forgot about the handle.
+        if future.cancelled() or self.pending.get(handle, (None,))[0] is not future:
+            return False
+        del self.pending[handle]
+
+        try:
+            future.result().apply_to(file)
+            result = FileManager.OperationResult.COMPLETE
+        except Exception:
+            result = FileManager.OperationResult.FAILED
+        FileManager.info_provider_update_complete_invoke(closure, provider, handle, result)
+        # Remove from the idle queue of GLib.
+        return False
+
+    def cancel_update(self, provider, handle):
+        """
+        Called by Nautilus when the result is not needed anymore, e.g. when leaving the directory. Queued extractions
+        are abandoned, running ones finish but are not reported. The queued slow phases of the directory are abandoned
+        too: Nautilus asks for the files of a directory one at a time, so the slow phases of the files before were
+        queued by requests that completed already, and would otherwise hold up the directory shown next.
+        """
+        future, directory = self.pending.pop(handle, (None, None))
+        if future is None:
+            return
+        future.cancel()
+        with self.lock:
+            jobs = self.slow_jobs.pop(directory, {})
+        for job in jobs.values():
+            job.cancel()
+
+
+###############
+# pre-warming #
+###############
+def content_type(filename):
+    """
+    The mime type of a file, detected the same way as Nautilus does.
+    """
+    info = Gio.File.new_for_path(filename).query_info(Gio.FILE_ATTRIBUTE_STANDARD_CONTENT_TYPE,
+                                                      Gio.FileQueryInfoFlags.NONE, None)
+    return Gio.content_type_get_mime_type(info.get_content_type())
+
+
+def prewarm_file(filename, cached_extractors=None, failed=()):
+    """
+    Extract the columns of a file that are not cached yet. Runs in a worker process of Prewarmer.
+
+    :param filename: the file to extract.
+    :param cached_extractors: the extractors of the cached entry of the file, None when it is not cached.
+    :param failed: the extractors that recently timed out or failed on the file, these are not tried again.
+    :return: the extracted ColumnValues, or None when there is nothing left to extract.
+    """
+    mime_type = content_type(filename)
+    missing = [name for name in needed_extractors(mime_type)
+               if name not in (cached_extractors or ()) and name not in failed]
+    if not missing:
+        return None
+    return extract_columns(filename, mime_type, missing)
+
+
+class Prewarmer:
+    """
+    Prewarmer fills the metadata cache for directory trees ahead of time, extracting on a pool of processes:
+        prewarmer = Prewarmer(cache, workers=4)
+        prewarmer.walk('/media/library')
+        prewarmer.wait()
+    Files that are cached and did not change are skipped, copies of extracted files reuse their columns. `watch`
+    keeps extracting files that change, as long as the GLib main loop runs.
+
+    When a worker dies, e.g. killed for its memory, the pool breaks and fails all its files. The pool is replaced, and
+    its files are extracted once more in a process of their own, so a file that kills that process too is known to be
+    the cause. It is remembered as failed, so the next run does not crash on it again.
+    """
+
+    def __init__(self, cache, workers, xattrs=None):
+        self.cache = cache
+        self.xattrs = xattrs
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_parser_process)
+        # The single process pools of the files of a broken pool.
+        self.retries = set()
+        # Limits the number of queued files, so walking a huge tree does not queue all of them at once.
+        self.queue = threading.BoundedSemaphore(workers * 4)
+        self.monitors = {}
+        # Counted by the walking thread and the threads of the pools.
+        self.lock = threading.Lock()
+        self.counts = {'extracted': 0, 'deduplicated': 0, 'skipped': 0, 'failed': 0}
+
+    def walk(self, directory):
+        for root, directories, files in os.walk(directory):
+            for name in files:
+                self.submit(os.path.join(root, name))
+
+    def submit(self, filename):
+        try:
+            stamp = self.cache.stamp(filename)
+        except OSError:
+            return
+        cached = self.cache.get(filename, stamp)
+        if cached is None and self.xattrs is not None:
+            cached = self.xattrs.get(filename, stamp)
+            if cached is not None:
+                self.cache.put(filename, stamp, cached)
+        fingerprint = None
+        deduplicated = False
+        if cached is None:
+            try:
+                mime_type = content_type(filename)
+            except GLib.Error:
+                return
+            if not extractors_for(mime_type):
+                self.count('skipped')
+                return
+            # Copies of files that were extracted already, e.g. backups, only run the extractors the copy lacks.
+            fingerprint, cached = self.cache.deduplicate(filename, mime_type, stamp)
+            if cached is not None:
+                self.cache.put(filename, stamp, cached, fingerprint)
+                self.count('deduplicated')
+                deduplicated = True
+        failed = self.cache.failed(filename, stamp)
+        self.queue.acquire()
+        job = (filename, stamp, cached, failed, fingerprint, deduplicated)
+        while True:
+            executor = self.executor
+            try:
+                future = executor.submit(prewarm_file, filename, cached.extractors if cached is not None else None,
+                                         failed)
+                break
+            except BrokenProcessPool:
+                self.restart(executor)
+        future.add_done_callback(lambda f: self.store(job, f, executor))
+
+    def retry(self, job):
+        """
+        Extract a file of a broken pool once more, in a process of its own.
+        """
+        filename, stamp, cached, failed, fingerprint, deduplicated = job
+        executor = ProcessPoolExecutor(max_workers=1, initializer=init_parser_process)
+        with self.lock:
+            self.retries.add(executor)
+        future = executor.submit(prewarm_file, filename, cached.extractors if cached is not None else None, failed)
+        future.add_done_callback(lambda f: self.store(job, f, executor, retried=True))
+        executor.shutdown(wait=False)
+
+    def restart(self, executor):
+        """
+        Replace the pool when it is the broken executor, and not replaced already.
+        """
+        with self.lock:
+            if self.executor is executor:
+                stats.increment('prewarm_pool_restarts')
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_parser_process)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def store(self, job, future, executor, retried=False):
+        filename, stamp, cached, failed, fingerprint, deduplicated = job
+        retrying = False
+        try:
+            extracted = future.result()
+            if extracted is None:
+                if not deduplicated:
+                    self.count('skipped')
+                return
+            columns = cached if cached is not None else ColumnValues()
+            columns.merge(extracted)
+            if fingerprint is None:
+                fingerprint = content_fingerprint(filename, content_type(filename), stamp[2])
+            self.cache.put(filename, stamp, columns, fingerprint)
+            if extracted.failed:
+                self.cache.put_failures(filename, stamp, extracted.failed)
+            if self.xattrs is not None and extracted.extractors:
+                self.xattrs.put(filename, stamp, columns)
+            self.count('extracted')
+        except BrokenProcessPool as error:
+            if not retried:
+                self.restart(executor)
+                self.retry(job)
+                retrying = True
+                return
+            print(f"WARNING! Could not extract {filename}, its worker died: {error}")
+            self.put_failures(job, f'{type(error).__name__}: {error}')
+            self.count('failed')
+        except Exception as error:
+            print(f"WARNING! Could not extract {filename}: {error}")
+            self.count('failed')
+        finally:
+            if retried:
+                with self.lock:
+                    self.retries.discard(executor)
+            if not retrying:
+                self.queue.release()
+
+    def put_failures(self, job, reason):
+        """
+        Remember the extractors that were to run on the file of job as failed.
+        """
+        filename, stamp, cached, failed, fingerprint, deduplicated = job
+        try:
+            extractors = needed_extractors(content_type(filename))
+        except GLib.Error:
+            return
+        self.cache.put_failures(filename, stamp, {name: reason for name in extractors
+                                                  if name not in (cached.extractors if cached is not None else ())
+                                                  and name not in failed})
+
+    def wait(self):
+        # The pool is replaced when it breaks, until its files are done.
+        executor = None
+        while executor is not self.executor:
+            executor = self.executor
+            executor.shutdown(wait=True)
+        with self.lock:
+            retries = list(self.retries)
+        for executor in retries:
+            executor.shutdown(wait=True)
+
+    def watch(self, directory):
+        for root, directories, files in os.walk(directory):
+            self.monitor(root)
+
+    def monitor(self, directory):
+        if directory in self.monitors:
+            return
+        monitor = Gio.File.new_for_path(directory).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        monitor.connect('changed', self.changed)
+        self.monitors[directory] = monitor
+
+    def changed(self, monitor, file, other_file, event):
+        if event == Gio.FileMonitorEvent.RENAMED:
+            file = other_file
+        elif event not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.MOVED_IN):
+            return
+        path = file.get_path()
+        if os.path.isdir(path):
+            # A new directory, or one moved into the tree.
+            self.watch(path)
+            self.walk(path)
+        elif os.path.isfile(path):
+            self.submit(path)
+
+
+def prewarm(args):
+    cache = MetadataCache.open_default()
+    if cache is None:
+        print('The metadata cache is disabled, there is nothing to pre-warm.')
+        return 1
+
+    prewarmer = Prewarmer(cache, args.workers, XattrStore.open_default())
+    start = time.time()
+    for directory in args.directories:
+        prewarmer.walk(directory)
+    if args.watch:
+        for directory in args.directories:
+            prewarmer.watch(directory)
+        try:
+            GLib.MainLoop().run()
+        except KeyboardInterrupt:
+            pass
+    prewarmer.wait()
+    counts = prewarmer.counts
+    print(f"Extracted {counts['extracted']}, deduplicated {counts['deduplicated']}, skipped {counts['skipped']} and "
+          f"failed {counts['failed']} files in {time.time() - start:.1f} s.")
+    return 0
+
+
+CONDITION = re.compile(r'\s*(\w+)\s*(<=|>=|!=|=|<|>|~)\s*(.*?)\s*$')
+
+
+def parse_condition(text):
+    """
+    Parse a query condition like 'duration>600', 'model=Canon EOS 5D' or 'title~holiday' into a (field, operator,
+    value) tuple for `MetadataCache.query`, converting the value to the type of the column.
+    Raises ValueError for unknown columns and values that do not match the type of the column.
+    """
+    match = CONDITION.match(text)
+    if match is None:
+        raise ValueError(f"Invalid condition '{text}', expected a column, an operator and a value.")
+    field, operator, value = match.groups()
+    if field not in COLUMN_INDEX:
+        raise ValueError(f"Unknown column '{field}'.")
+    if operator != '~':
+        value = index_value(field, value)
+        if value is None:
+            raise ValueError(f"Invalid value for {field} ({COLUMN_TYPES[field]}) in '{text}'.")
+    return field, operator, value
+
+
+def format_indexed(field, value):
+    if value is None:
+        return ''
+    if COLUMN_TYPES[field] == 'seconds':
+        return secToTimeFormat(value)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def query(args):
+    cache = MetadataCache.open_default()
+    if cache is None:
+        print('The metadata cache is disabled, there is nothing to query.')
+        return 1
+    try:
+        conditions = [parse_condition(condition) for condition in args.conditions]
+    except ValueError as error:
+        print(error)
+        return 2
+
+    if args.reindex or cache.indexed() == 0:
+        cache.reindex()
+    fields = args.show.split(',') if args.show else list(dict.fromkeys(field for field, _op, _v in conditions))
+    unknown = [field for field in fields if field not in COLUMN_INDEX]
+    if unknown:
+        print(f"Unknown column '{unknown[0]}'.")
+        return 2
+    for path, values in cache.query(conditions, args.directory, fields):
+        print('\t'.join([path] + [format_indexed(field, value) for field, value in zip(fields, values)]))
+    return 0
 
-                    info = pdf.getDocumentInfo()
-                    map_any(file, info, 'title', f=lambda i:i.title)
-                    map_any(file, info, 'artist', f=lambda i:i.author)
 
-                    if pdf.getNumPages() > 0:
-                        bbox = pdf.getPage(0).mediaBox
-                        map_any(file, bbox, 'width', f=lambda b: self.points_from_bbox(b, 0), c=self.points_to_mm)
-                        map_any(file, bbox, 'height', f=lambda b: self.points_from_bbox(b, 1), c=self.points_to_mm)
-            except Exception:
-                pass
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bsc_v2.py', description='Tools for the nautilus-columns extension.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    prewarm_parser = subparsers.add_parser('prewarm', help='fill the metadata cache for directory trees')
+    prewarm_parser.add_argument('directories', nargs='+', help='the directories to walk')
+    prewarm_parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                                help='number of processes extracting metadata, defaults to the number of CPUs')
+    prewarm_parser.add_argument('--watch', action='store_true',
+                                help='keep running and extract files again when they change')
+    query_parser = subparsers.add_parser('query', help='find files in the metadata index',
+                                         description='Find files in the metadata index without reading them. '
+                                                     'Durations are compared in seconds or as hh:mm:ss.')
+    query_parser.add_argument('conditions', nargs='*',
+                              help="conditions like 'duration>600', 'iso_speed<=400', 'model=Canon EOS 5D' or "
+                                   "'title~holiday', all have to match")
+    query_parser.add_argument('--directory', help='only files within this directory tree')
+    query_parser.add_argument('--show', help='comma separated columns to print, defaults to the queried columns')
+    query_parser.add_argument('--reindex', action='store_true',
+                              help='rebuild the index from the metadata cache first')
+    args = parser.parse_args(argv)
 
-    def points_from_bbox(self, bbox, index):
-        return abs(bbox.upperRight[index] - bbox.lowerLeft[index])
+    if args.command == 'prewarm':
+        return prewarm(args)
+    if args.command == 'query':
+        return query(args)
 
-    def points_to_mm(self, pt):
-        return int(float(pt) * math.sqrt(2.0) / 4.0)
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,416 @@
+"""
+Benchmarks for nautilus-columns. Run them from the test directory, like the tests:
+    python3 benchmark_bsc_v2.py dispatch
+    python3 benchmark_bsc_v2.py corpus --files 1000
+    python3 benchmark_bsc_v2.py memory --records 100000 1000000
+The corpus benchmark generates a directory of synthetic JPEGs, MP3s, PDFs, MP4s and FLVs, which go to mediainfo, and
+shows it in the extension like Nautilus does, cold, with a warm cache and with a warm memory cache. It reports the
+throughput, latency per mime type, peak memory and number of mediainfo processes of each run. The memory benchmark
+reports the memory of the column values of many photos, as held by the caches.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import statistics
+import struct
+import tempfile
+import time
+import timeit
+import tracemalloc
+from unittest import mock
+
+import bsc_v2
+
+from mutagen.easyid3 import EasyID3
+from PIL import Image
+from gi.repository import GExiv2, GLib
+from test_bsc_v2 import DummyFileInfoProvider
+
+
+RESOURCES = [
+    ['image-JPG', 'resources/CanonEOS70D.jpg', 'image/jpg'],
+    ['audio-MP3', 'resources/gs-16b-2c-44100hz.mp3', 'audio/mpeg'],
+    ['video-MP4', 'resources/gs-16b-2c-44100hz.mp4', 'video/mp4'],
+    ['audio-WMA', 'resources/gs-16b-2c-44100hz.wma', 'audio/x-ms-wma'],
+    ['doc-PDF', 'resources/sample.pdf', 'application/pdf'],
+]
+
+
+def legacy_dispatch(mime_type):
+    """
+    The dispatch as it was done before the extractor registry: sequential mime checks, and a list of all column names
+    built for every mapped field.
+    """
+    fields = []
+    if mime_type == 'audio/mpeg':
+        fields += ['title', 'album', 'artist', 'tracknumber', 'genre', 'date', 'bitrate', 'samplerate', 'length']
+    if mime_type.split('/')[0] in ('image'):
+        fields += list(bsc_v2.EXTRACTORS_BY_MIME['image/*'][0]['fields'])
+    if mime_type == 'video/x-msvideo' or\
+            mime_type == 'video/mpeg' or\
+            mime_type == 'video/x-ms-wmv' or\
+            mime_type == 'audio/x-ms-wma' or\
+            mime_type == 'video/mp4' or\
+            mime_type == 'audio/x-flac' or\
+            mime_type == 'video/x-flv' or\
+            mime_type == 'video/x-matroska' or\
+            mime_type == 'audio/x-wav':
+        fields += ['format', 'duration', 'overall_bitrate', 'frame_count', 'video_format', 'width', 'height',
+                   'bit_depth', 'audio_format']
+    if mime_type == 'application/pdf':
+        fields += ['pages', 'title', 'artist', 'width', 'height']
+    return [field in [c['name'] for c in bsc_v2.COLUMN_DEFINITIONS] for field in fields]
+
+
+def registry_dispatch(mime_type):
+    """
+    The dispatch through the compiled registry, doing the same checks as `legacy_dispatch`.
+    """
+    return [field in bsc_v2.COLUMN_NAMES
+            for extractor in bsc_v2.extractors_for(mime_type)
+            for field in extractor['fields']]
+
+
+def benchmark_dispatch(number):
+    print(f"{'resource':<12}{'before (us/file)':>20}{'after (us/file)':>20}{'speedup':>10}")
+    for name, file, mime_type in RESOURCES:
+        before = timeit.timeit(lambda: legacy_dispatch(mime_type), number=number) / number * 1e6
+        after = timeit.timeit(lambda: registry_dispatch(mime_type), number=number) / number * 1e6
+        print(f'{name:<12}{before:>20.2f}{after:>20.2f}{before / after:>9.1f}x')
+
+
+CAMERA_MODELS = ['Canon EOS 70D', 'NIKON D750', 'ILCE-7M3', 'X-T3']
+
+
+def generate_jpeg(path, index):
+    Image.new('RGB', (64 + index % 64, 48 + index % 48), (index % 256, 0, 0)).save(path, 'JPEG')
+    metadata = GExiv2.Metadata(path)
+    metadata.set_tag_string('Exif.Image.Model', CAMERA_MODELS[index % len(CAMERA_MODELS)])
+    metadata.set_tag_string('Exif.Image.ImageDescription', f'Synthetic image {index}')
+    metadata.set_tag_string('Exif.Photo.ISOSpeedRatings', str(100 * (1 + index % 32)))
+    metadata.set_tag_string('Exif.Photo.ExposureTime', f'1/{index % 1000 + 1}')
+    metadata.save_file(path)
+
+
+def generate_mp3(path, index):
+    shutil.copyfile('resources/gs-16b-2c-44100hz.mp3', path)
+    tags = EasyID3(path)
+    tags['title'] = f'Synthetic song {index}'
+    tags['artist'] = f'Artist {index % 50}'
+    tags['album'] = f'Album {index % 200}'
+    tags['tracknumber'] = str(index % 20 + 1)
+    tags.save()
+
+
+def generate_pdf(path, index):
+    pages = index % 10 + 1
+    kids = ' '.join(f'{4 + page} 0 R' for page in range(pages))
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Type /Pages /Count {pages} /Kids [{kids}] /MediaBox [0 0 595 842] >>',
+               f'<< /Title (Synthetic document {index}) /Author (Benchmark) >>']
+    objects += ['<< /Type /Page /Parent 2 0 R >>'] * pages
+
+    content = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f'{number} 0 obj\n{body}\nendobj\n'
+    xref = len(content)
+    content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    content += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R /Info 3 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def generate_mp4(path, index):
+    shutil.copyfile('resources/gs-16b-2c-44100hz.mp4', path)
+    # A free box with the index makes every copy unique, else all but the first are answered by deduplication.
+    payload = f'synthetic video {index}'.encode()
+    with open(path, 'ab') as f:
+        f.write(struct.pack('>I4s', 8 + len(payload), b'free') + payload)
+
+
+def amf_value(value):
+    if isinstance(value, str):
+        return b'\x02' + struct.pack('>H', len(value)) + value.encode()
+    return b'\x00' + struct.pack('>d', value)
+
+
+def generate_flv(path, index):
+    """
+    An FLV with only its onMetaData script tag. There is no in-process parser for FLV, so it is read by mediainfo.
+    """
+    metadata = {'duration': 10.0 + index, 'width': 640.0, 'height': 360.0, 'framerate': 25.0,
+                'encoder': f'synthetic video {index}'}
+    data = amf_value('onMetaData') + b'\x08' + struct.pack('>I', len(metadata))
+    for name, value in metadata.items():
+        data += struct.pack('>H', len(name)) + name.encode() + amf_value(value)
+    data += b'\x00\x00\x09'
+    tag = b'\x12' + struct.pack('>I', len(data))[1:] + b'\x00' * 7 + data
+    with open(path, 'wb') as f:
+        f.write(b'FLV\x01\x05' + struct.pack('>I', 9) + struct.pack('>I', 0))
+        f.write(tag + struct.pack('>I', len(tag)))
+
+
+GENERATORS = [
+    ('image/jpeg', 'jpg', generate_jpeg),
+    ('audio/mpeg', 'mp3', generate_mp3),
+    ('application/pdf', 'pdf', generate_pdf),
+    ('video/mp4', 'mp4', generate_mp4),
+    ('video/x-flv', 'flv', generate_flv),
+]
+
+
+def generate_corpus(directory, files):
+    """
+    Generate `files` files per mime type within directory.
+
+    :return: a list of (path, mime_type).
+    """
+    corpus = []
+    for mime_type, extension, generate in GENERATORS:
+        for index in range(files):
+            path = os.path.join(directory, f'{extension}-{index:06d}.{extension}')
+            generate(path, index)
+            corpus.append((path, mime_type))
+    return corpus
+
+
+class ProcessCounter:
+    """
+    Counts the mediainfo processes started through MediaInfo.run.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.run = bsc_v2.MediaInfo.run
+
+    def __enter__(self):
+        def counting_run(paths):
+            self.count += 1
+            return self.run(paths)
+        bsc_v2.MediaInfo.run = staticmethod(counting_run)
+        return self
+
+    def __exit__(self, *args):
+        bsc_v2.MediaInfo.run = staticmethod(self.run)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class CorpusFileInfo(DummyFileInfoProvider):
+    """
+    A file of the corpus shown in Nautilus, requested again when the extension invalidates it, like Nautilus does.
+    """
+
+    def __init__(self, listing, path, mime_type):
+        super().__init__('file://' + path, mime_type)
+        self.listing = listing
+        self.path = path
+
+    def invalidate_extension_info(self):
+        self.listing.request(self)
+
+
+class CorpusListing:
+    """
+    Lists the corpus in the extension like Nautilus lists a directory: every file is requested at once through
+    `update_file_info_full` on the GLib main loop, so the scheduler, the caches and the slow phase are part of the
+    measurement. The latency of a file is the time until its first and its last update completed.
+    """
+
+    def __init__(self, extension, corpus):
+        self.extension = extension
+        self.files = {f'file://{path}': CorpusFileInfo(self, path, mime_type) for path, mime_type in corpus}
+        self.handles = 0
+        self.started = {}
+        self.first = {}
+        self.last = {}
+        # Slow phases started and done, the listing is complete when all of them are done.
+        self.slow_started = 0
+        self.slow_done = 0
+
+    def request(self, fileinfo):
+        self.handles += 1
+        result = self.extension.update_file_info_full(None, self.handles, fileinfo, fileinfo)
+        if result == bsc_v2.FileManager.OperationResult.COMPLETE:
+            self.completed(fileinfo, None, self.handles, result)
+
+    def completed(self, fileinfo, provider, handle, result):
+        now = time.perf_counter()
+        self.first.setdefault(fileinfo.path, now)
+        self.last[fileinfo.path] = now
+
+    def extract_slow(self, uri, mime_type):
+        self.slow_started += 1
+        return type(self.extension).extract_slow(self.extension, uri, mime_type)
+
+    def slow_phase_done(self, uri):
+        try:
+            return type(self.extension).slow_phase_done(self.extension, uri)
+        finally:
+            self.slow_done += 1
+
+    def check_done(self, loop):
+        if (len(self.first) == len(self.files) and not self.extension.pending and not self.extension.slow_jobs and
+                self.slow_started == self.slow_done):
+            loop.quit()
+            return False
+        return True
+
+    def run(self):
+        """
+        :return: the elapsed seconds, and a list of (mime type, seconds to the first update, seconds to the last
+            update) per file.
+        """
+        loop = GLib.MainLoop()
+        self.extension.extract_slow = self.extract_slow
+        self.extension.slow_phase_done = self.slow_phase_done
+        with mock.patch.object(bsc_v2.FileManager, 'info_provider_update_complete_invoke',
+                               side_effect=self.completed), \
+                mock.patch.object(bsc_v2.FileManager.FileInfo, 'lookup_for_uri', side_effect=self.files.get):
+            start = time.perf_counter()
+            for fileinfo in self.files.values():
+                self.started[fileinfo.path] = time.perf_counter()
+                self.request(fileinfo)
+            GLib.timeout_add(10, self.check_done, loop)
+            loop.run()
+            elapsed = time.perf_counter() - start
+        return elapsed, [(fileinfo.mime_type, self.first[fileinfo.path] - self.started[fileinfo.path],
+                          self.last[fileinfo.path] - self.started[fileinfo.path])
+                         for fileinfo in self.files.values()]
+
+
+def corpus_extension(workers):
+    extension = bsc_v2.ColumnExtension()
+    extension.visible_columns.default = None
+    extension.executor = bsc_v2.ThreadPoolExecutor(max_workers=workers)
+    extension.scheduler = bsc_v2.IOScheduler(extension.executor)
+    return extension
+
+
+def print_corpus_run(name, elapsed, results, processes):
+    print(f'\n{name}: {len(results)} files in {elapsed:.2f} s, {len(results) / elapsed:.1f} files/s, '
+          f'{processes} mediainfo processes')
+    print(f"{'mime type':<20}{'files':>8}{'first p50 (ms)':>16}{'first p99 (ms)':>16}{'all p50 (ms)':>14}"
+          f"{'all p99 (ms)':>14}")
+    for mime_type, _extension, _generate in GENERATORS:
+        first = [f for m, f, _l in results if m == mime_type]
+        last = [l for m, _f, l in results if m == mime_type]
+        print(f'{mime_type:<20}{len(first):>8}{statistics.median(first) * 1e3:>16.2f}'
+              f'{percentile(first, 0.99) * 1e3:>16.2f}{statistics.median(last) * 1e3:>14.2f}'
+              f'{percentile(last, 0.99) * 1e3:>14.2f}')
+
+
+def benchmark_corpus(files, workers, directory=None):
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = directory or os.path.join(temporary, 'corpus')
+        os.makedirs(directory, exist_ok=True)
+        print(f'Generating {files} files per mime type in {directory}')
+        corpus = generate_corpus(directory, files)
+
+        # Start with an empty cache, to measure extraction instead of an earlier run.
+        bsc_v2.CACHE_DIR = os.path.join(temporary, 'cache')
+        if bsc_v2.CACHE_SIZE <= 0:
+            print('The metadata cache is disabled, the warm cache run extracts again.')
+        extension = corpus_extension(workers)
+        # Cold: nothing is cached. Warm cache: a new Nautilus process, the values come from the metadata cache. Warm
+        # memory: the directory is shown again by the same process.
+        for name, run_extension in [('cold', extension), ('warm cache', corpus_extension(workers)),
+                                    ('warm memory', None)]:
+            extension = run_extension or extension
+            with ProcessCounter() as processes:
+                elapsed, results = CorpusListing(extension, corpus).run()
+            print_corpus_run(name, elapsed, results, processes.count)
+            gc.collect()
+
+    print(f'\npeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+
+def photo_columns(index):
+    """
+    The column values of a photo, as extracted by the image extractor.
+    """
+    columns = {
+        'title': f'IMG_{index:07d}',
+        'datetime_original': f'2019:{index % 12 + 1:02d}:{index % 28 + 1:02d} {index % 24:02d}:{index % 60:02d}:00',
+        'model': CAMERA_MODELS[index % len(CAMERA_MODELS)],
+        'iso_speed': str(100 * (1 + index % 32)),
+        'exposure_time': f'1/{(index % 10 + 1) * 100}',
+        'fnumber': f'{index % 16 + 1}.0',
+        'focal_length': f'{(index % 20 + 1) * 5}.0',
+        'flash': 'Auto mode',
+        'metering_mode': 'Pattern',
+        'exposure_mode': 'Auto exposure',
+        'orientation': 'Normal',
+        'resolution_unit': 'Inch',
+        'xresolution': '72/1',
+        'yresolution': '72/1',
+        'width': '6000',
+        'height': '4000',
+    }
+    # Like values read from the cache or extracted from a file, every string is a new object.
+    return json.loads(json.dumps(columns))
+
+
+class DictColumnValues(dict):
+    """
+    The column values as a dict, as they were before ColumnValues became a compact record.
+    """
+
+    def __init__(self, *args, extractors=()):
+        super().__init__(*args)
+        self.extractors = set(extractors)
+        self.bytes_read = 0
+        self.errors = 0
+        self.failed = {}
+
+
+RECORD_TYPES = [
+    ('dict, all columns', lambda i: DictColumnValues({**dict.fromkeys(bsc_v2.COLUMN_ORDER, ''), **photo_columns(i)},
+                                                     extractors=['image'])),
+    ('dict', lambda i: DictColumnValues(photo_columns(i), extractors=['image'])),
+    ('ColumnValues', lambda i: bsc_v2.ColumnValues(photo_columns(i), extractors=['image'])),
+]
+
+
+def benchmark_memory(counts):
+    print(f"{'records':>10}  {'type':<20}{'total (MB)':>12}{'per record (bytes)':>20}")
+    for count in counts:
+        for name, build in RECORD_TYPES:
+            gc.collect()
+            tracemalloc.start()
+            records = [build(index) for index in range(count)]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del records
+            print(f'{count:>10}  {name:<20}{size / 1024 ** 2:>12.1f}{size / count:>20.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    dispatch = subparsers.add_parser('dispatch', help='per-file overhead of dispatching to the extractors')
+    dispatch.add_argument('--number', type=int, default=10000, help='number of files to dispatch per resource')
+    corpus = subparsers.add_parser('corpus', help='throughput and latency on a synthetic directory')
+    corpus.add_argument('--files', type=int, default=1000, help='number of files to generate per mime type')
+    corpus.add_argument('--workers', type=int, default=bsc_v2.WORKERS, help='number of threads extracting in parallel')
+    corpus.add_argument('--directory', help='directory to generate the files in, a temporary one by default')
+    memory = subparsers.add_parser('memory', help='memory of the column values of many files')
+    memory.add_argument('--records', type=int, nargs='+', default=[100000, 1000000],
+                        help='numbers of records to hold in memory')
+    args = parser.parse_args()
+
+    if args.benchmark == 'dispatch':
+        benchmark_dispatch(args.number)
+    elif args.benchmark == 'corpus':
+        benchmark_corpus(args.files, args.workers, args.directory)
+    elif args.benchmark == 'memory':
+        benchmark_memory(args.records)
@@ -1,5 +1,18 @@
 import bsc_v2
+import errno
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from parameterized import parameterized
 from gi.repository import Nautilus, GObject
@@ -10,6 +23,22 @@ if __name__ == '__main__':
     unittest.main()
 
 
+def setUpModule():
+    # Every ColumnExtension opens the default cache, which must not be the cache of the user running the tests.
+    global cache_home, patches
+    cache_home = tempfile.TemporaryDirectory()
+    patches = [mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home.name}),
+               mock.patch.object(bsc_v2, 'CACHE_DIR', os.path.join(cache_home.name, bsc_v2.APP))]
+    for patch in patches:
+        patch.start()
+
+
+def tearDownModule():
+    for patch in patches:
+        patch.stop()
+    cache_home.cleanup()
+
+
 class Test(unittest.TestCase):
     def test_get_resolution_unit(self):
         self.assertEqual(convert(RESOLUTION_UNIT, '2'), 'Inch', 'Unexpected resolution unit.')
@@ -48,15 +77,21 @@ class TestColumnExtension(unittest.TestCase):
 
     @parameterized.expand([
         ['image-JPG', 'resources/CanonEOS70D.jpg', 'image/jpg', {'title': 'Sample image from exiftool.js', 'artist': 'exiftool.js', 'exposure_time': '1/320', 'fnumber': '11.0', 'focal_length': '12.0', 'gps_altitude': '0.0', 'gps_latitude': '0.0', 'gps_longitude': '0.0', 'iso_speed': '100', 'orientation': '180º', 'model': 'Canon EOS 70D', 'resolution_unit': 'Inch', 'xresolution': '72/1', 'yresolution': '72/1', 'datetime_original': '2013:03:25 15:27:13', 'shutter_speed_value': '548864/65536', 'aperture_value': '458752/65536', 'exposure_bias_value': '-1/3', 'metering_mode': 'Pattern', 'flash': 'Auto mode', 'exposure_mode': 'Auto exposure', 'width': '8', 'height': '8'}],
-        ['audio-MP3', 'resources/gs-16b-2c-44100hz.mp3', 'audio/mpeg', {'title': 'Galway', 'artist': 'Kevin MacLeod'}],
+        ['audio-MP3', 'resources/gs-16b-2c-44100hz.mp3', 'audio/mpeg', {'title': 'Galway', 'artist': 'Kevin MacLeod', 'bitrate': '128 Kbps', 'samplerate': '44100 Hz', 'length': '00:00:15'}],
         ['video-MP4', 'resources/gs-16b-2c-44100hz.mp4', 'video/mp4', {'duration': '00:00:15', 'format': 'MPEG-4', 'overall_bitrate': '130860', 'frame_count': '683', 'audio_format': 'AAC'}],
-        ['audio-WMA', 'resources/gs-16b-2c-44100hz.wma', 'audio/x-ms-wma', {'duration': '00:00:15', 'format': 'Windows Media', 'overall_bitrate': '139387', 'bit_depth': '16', 'audio_format': 'WMA'}],
+        ['audio-WMA', 'resources/gs-16b-2c-44100hz.wma', 'audio/x-ms-wma', {'title': 'Galway', 'artist': 'Kevin MacLeod', 'bitrate': '128 Kbps', 'samplerate': '44100 Hz', 'length': '00:00:15', 'duration': '00:00:15', 'format': 'Windows Media', 'overall_bitrate': '139387', 'bit_depth': '16', 'audio_format': 'WMA'}],
         ['doc-PDF', 'resources/sample.pdf', 'application/pdf', {'title': 'This is the Title', 'artist': 'Happy Woman', 'width': '216', 'height': '280', 'pages': '2'}],
     ])
     def test_update_file_info(self, testname, file, mime_type, non_empty_expected):
         # Set up required objects
         fileinfo = DummyFileInfoProvider('file://' + file, mime_type)
-        bsc_v2.ColumnExtension.update_file_info(bsc_v2.ColumnExtension(), file=fileinfo)
+        extension = bsc_v2.ColumnExtension()
+        # Always extract, the metadata cache of this machine may hold values of an older version.
+        extension.cache = None
+        extension.xattrs = None
+        # Extract all columns, regardless of the columns visible within Nautilus on this machine.
+        extension.visible_columns.default = None
+        bsc_v2.ColumnExtension.update_file_info(extension, file=fileinfo)
 
         # Remove keys with default values from actual to visualize the difference in the message easier.
         non_empty_actual = {k: v for k, v in fileinfo.actual.items() if v is not ''}
@@ -64,4 +99,946 @@ class TestColumnExtension(unittest.TestCase):
         # Extend the expected values with empty values for other keys.
         expected = {**self.EMPTY_VALUES, **non_empty_expected}
         actual = fileinfo.actual
-        self.assertEqual(actual, expected, msg=f"\nSummary:\nexpected: {non_empty_expected}\nactual  : {non_empty_actual}")
\ No newline at end of file
+        self.assertEqual(actual, expected, msg=f"\nSummary:\nexpected: {non_empty_expected}\nactual  : {non_empty_actual}")
+
+
+class TestBoundedReads(unittest.TestCase):
+    def test_pdf_header(self):
+        with bsc_v2.BoundedReader('resources/sample.pdf') as reader:
+            pdf = bsc_v2.PdfHeader(reader)
+        self.assertEqual(pdf.pages, 2)
+        self.assertEqual(pdf.media_box, [0, 0, 612, 792])
+        self.assertEqual(pdf.text('/Title'), 'This is the Title')
+        self.assertEqual(pdf.text('/Author'), 'Happy Woman')
+
+    def test_pdf_with_short_xref_entries(self):
+        # Some writers end the cross-reference entries with a single newline, making them 19 bytes long. The blank
+        # lines keep the trailer where 20 byte entries would end, so only the entries are misplaced.
+        objects = ['<< /Type /Catalog /Pages 2 0 R >>', '<< /Type /Pages /Count 0 /Kids [] >>']
+        content = b'%PDF-1.4\n'
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(content))
+            content += f'{number} 0 obj\n{body}\nendobj\n'.encode()
+        xref = len(content)
+        content += b'xref\n0 3\n0000000000 65535 f\n' + b''.join(b'%010d 00000 n\n' % o for o in offsets) + b'\n' * 3
+        content += f'trailer\n<< /Size 3 /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+            f.write(content)
+            f.flush()
+            with bsc_v2.BoundedReader(f.name) as reader, self.assertRaises(ValueError):
+                bsc_v2.PdfHeader(reader)
+
+            reader = mock.Mock()
+            reader.return_value.getNumPages.return_value = 0
+            file = bsc_v2.ColumnValues()
+            with mock.patch.dict(sys.modules, {'PyPDF2': mock.Mock(PdfFileReader=reader)}), \
+                    mock.patch.object(bsc_v2.parser_pool, 'workers', 0):
+                bsc_v2.extract_pdf(file, f.name, info=False)
+        reader.assert_called_once()
+        self.assertEqual(file['pages'], '0', 'The full parse should be used instead.')
+
+    def test_jpeg_header(self):
+        with bsc_v2.BoundedReader('resources/CanonEOS70D.jpg') as reader:
+            header = bsc_v2.read_image_header(reader)
+        self.assertEqual((header.width, header.height), (8, 8))
+        self.assertTrue(header.metadata.endswith(b'\xff\xd9'), 'Metadata should end with the end of image marker.')
+
+    def test_budget_exceeded(self):
+        with bsc_v2.BoundedReader('resources/gs-16b-2c-44100hz.mp3', budget=bsc_v2.BoundedReader.BLOCK_SIZE) as reader:
+            reader.read(0, 10)
+            with self.assertRaises(bsc_v2.ReadBudgetExceeded):
+                reader.read(bsc_v2.BoundedReader.BLOCK_SIZE, 10)
+            self.assertEqual(reader.bytes_read, bsc_v2.BoundedReader.BLOCK_SIZE)
+
+    def test_budget_exceeded_falls_back_to_full_parse(self):
+        reader = mock.Mock()
+        reader.return_value.getNumPages.return_value = 0
+        file = bsc_v2.ColumnValues()
+        # The parser pool runs PyPDF2 in this process, where it is mocked.
+        with mock.patch.object(bsc_v2, 'read_bounded', side_effect=bsc_v2.ReadBudgetExceeded('budget')), \
+                mock.patch.dict(sys.modules, {'PyPDF2': mock.Mock(PdfFileReader=reader)}), \
+                mock.patch.object(bsc_v2.parser_pool, 'workers', 0):
+            bsc_v2.extract_pdf(file, 'resources/sample.pdf', info=False)
+        reader.assert_called_once()
+        self.assertEqual(file['pages'], '0')
+
+    def test_pdf_text(self):
+        self.assertEqual(bsc_v2.pdf_text(rb'(Rave \(nested (parens)\) \101)'), 'Rave (nested (parens)) A')
+        self.assertEqual(bsc_v2.pdf_text(b'<FEFF00480069>'), 'Hi')
+
+
+class TestExtractionStats(unittest.TestCase):
+    def test_record(self):
+        stats = bsc_v2.ExtractionStats(enabled=True)
+        stats.record('exif', 'fast.jpg', 0.002, bytes_read=16384)
+        stats.record('exif', 'slow.jpg', 2.0, errors=1)
+        stats.increment('cache_hits')
+        snapshot = stats.snapshot()
+        exif = snapshot['extractors']['exif']
+        self.assertEqual((exif['calls'], exif['bytes_read'], exif['errors']), (2, 16384, 1))
+        self.assertEqual(exif['histogram'], [0, 1, 0, 0, 0, 0, 0, 1, 0])
+        self.assertEqual(exif['slowest'][0], {'seconds': 2.0, 'file': 'slow.jpg'})
+        self.assertEqual(snapshot['counters'], {'cache_hits': 1})
+        self.assertEqual(snapshot['hit_rates'], {'cache': 1.0})
+
+    def test_disabled(self):
+        stats = bsc_v2.ExtractionStats()
+        stats.record('exif', 'fast.jpg', 0.002)
+        stats.increment('cache_hits')
+        self.assertEqual((stats.snapshot()['extractors'], stats.snapshot()['counters']), ({}, {}))
+
+
+class TestVisibleColumns(unittest.TestCase):
+    def test_column_names(self):
+        names = bsc_v2.VisibleColumns.column_names(['name', 'size', 'NautilusPython::title_column',
+                                                   'NautilusPython::iso_speed_column'])
+        self.assertEqual(names, {'title', 'iso_speed'})
+
+    def test_skip_extractors_of_hidden_columns(self):
+        self.assertEqual(bsc_v2.needed_extractors('image/jpeg', frozenset({'title'})), ['image'])
+        self.assertEqual(bsc_v2.needed_extractors('image/jpeg', frozenset({'iso_speed'})), ['image'])
+        self.assertEqual(bsc_v2.needed_extractors('audio/mpeg', frozenset({'bitrate'})), ['audio'])
+        self.assertEqual(bsc_v2.needed_extractors('audio/mpeg', frozenset()), [])
+
+    def test_look_up_folder_once(self):
+        with mock.patch.object(bsc_v2, 'VISIBLE_ONLY', False):
+            visible = bsc_v2.VisibleColumns()
+        visible.default = frozenset({'title'})
+        with mock.patch.object(bsc_v2.Gio.File, 'new_for_path') as new_for_path:
+            new_for_path.return_value.query_info.return_value.get_attribute_stringv.return_value = [
+                'NautilusPython::pages_column']
+            self.assertEqual(visible.names_for('/music/a.pdf'), {'pages'})
+            self.assertEqual(visible.names_for('/music/b.pdf'), {'pages'})
+        new_for_path.assert_called_once_with('/music')
+
+    def test_folder_columns_changed(self):
+        on_changed = mock.Mock()
+        with mock.patch.object(bsc_v2, 'VISIBLE_ONLY', False):
+            visible = bsc_v2.VisibleColumns(on_changed=on_changed)
+        visible.default = frozenset({'title'})
+        with mock.patch.object(bsc_v2.Gio.File, 'new_for_path') as new_for_path, \
+                mock.patch.object(bsc_v2.GLib, 'idle_add') as idle_add:
+            get_attribute_stringv = new_for_path.return_value.query_info.return_value.get_attribute_stringv
+            get_attribute_stringv.return_value = ['NautilusPython::pages_column']
+            self.assertEqual(visible.names_for('/music/a.pdf'), {'pages'})
+            visible.folders['/music'] = (time.monotonic() - visible.FOLDER_TTL, frozenset({'pages'}))
+            self.assertEqual(visible.names_for('/music/a.pdf'), {'pages'})
+            idle_add.assert_not_called()
+
+            visible.folders['/music'] = (time.monotonic() - visible.FOLDER_TTL, frozenset({'pages'}))
+            get_attribute_stringv.return_value = ['NautilusPython::pages_column', 'NautilusPython::title_column']
+            self.assertEqual(visible.names_for('/music/a.pdf'), {'pages', 'title'})
+        idle_add.assert_called_once_with(on_changed)
+
+    def test_forget_partial_files(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.memory = bsc_v2.MemoryCache(max_entries=2)
+        extension.visible_columns.names_for = mock.Mock(return_value=frozenset({'title'}))
+        with mock.patch.object(extension, 'columns_for', return_value=bsc_v2.ColumnValues()):
+            for name in ['a', 'b', 'c']:
+                extension.extract(f'file:///missing/{name}.pdf', 'application/pdf')
+            self.assertEqual(list(extension.partial_uris), ['file:///missing/b.pdf', 'file:///missing/c.pdf'])
+            extension.visible_columns.names_for.return_value = None
+            extension.extract('file:///missing/c.pdf', 'application/pdf')
+        self.assertEqual(list(extension.partial_uris), ['file:///missing/b.pdf'])
+
+
+class TestAsyncUpdate(unittest.TestCase):
+    def test_cancel_update_abandons_extraction(self):
+        extension = bsc_v2.ColumnExtension()
+        future = Future()
+        extension.pending['handle'] = (future, '/media/videos')
+        extension.cancel_update(None, 'handle')
+        self.assertTrue(future.cancelled(), 'Queued extraction should be cancelled.')
+        self.assertEqual(extension.pending, {})
+
+    def test_cancel_update_abandons_slow_phases_of_directory(self):
+        extension = bsc_v2.ColumnExtension()
+        slow, other = Future(), Future()
+        extension.slow_jobs = {'/media/videos': {'file:///media/videos/a.mkv': slow},
+                               '/media/music': {'file:///media/music/b.flac': other}}
+        extension.pending['handle'] = (Future(), '/media/videos')
+        extension.cancel_update(None, 'handle')
+        self.assertTrue(slow.cancelled(), 'Slow phases of the directory left should be cancelled.')
+        self.assertFalse(other.cancelled())
+        self.assertEqual(list(extension.slow_jobs), ['/media/music'])
+
+    def test_complete_update_ignores_cancelled(self):
+        extension = bsc_v2.ColumnExtension()
+        fileinfo = DummyFileInfoProvider('file://resources/sample.pdf', 'application/pdf')
+        future = Future()
+        future.cancel()
+        self.assertFalse(extension.complete_update(None, 'handle', None, fileinfo, future))
+        self.assertEqual(fileinfo.actual, {}, 'A cancelled update should not set any attribute.')
+
+    def test_fast_phase_queues_slow_extractors(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.visible_columns.default = None
+        extension.cache = None
+        extension.scheduler = mock.Mock()
+        columns = extension.extract('file://resources/sample.pdf', 'application/pdf', slow=False)
+        self.assertEqual(columns, {'title': 'This is the Title', 'artist': 'Happy Woman'})
+        extension.scheduler.submit.assert_called_once_with('resources/sample.pdf', extension.extract_slow,
+                                                           'file://resources/sample.pdf', 'application/pdf',
+                                                           phase='slow', batched=False)
+
+        with mock.patch.object(bsc_v2.GLib, 'idle_add') as idle_add:
+            extension.extract_slow('file://resources/sample.pdf', 'application/pdf')
+        idle_add.assert_called_once_with(extension.slow_phase_done, 'file://resources/sample.pdf')
+        columns = extension.extract('file://resources/sample.pdf', 'application/pdf', slow=False)
+        self.assertEqual(columns['pages'], '2')
+        extension.scheduler.submit.assert_called_once()
+
+    def test_slow_phase_is_not_queued_again_after_eviction(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.visible_columns.default = None
+        extension.cache = None
+        extension.scheduler = mock.Mock()
+        extension.extract('file://resources/sample.pdf', 'application/pdf', slow=False)
+        with mock.patch.object(bsc_v2.GLib, 'idle_add'):
+            extension.extract_slow('file://resources/sample.pdf', 'application/pdf')
+        # Evicted from memory before Nautilus asks again, after slow_phase_done.
+        extension.memory.entries.clear()
+        extension.extract('file://resources/sample.pdf', 'application/pdf', slow=False)
+        extension.scheduler.submit.assert_called_once()
+
+    def test_no_slow_phase_without_cache(self):
+        with mock.patch.object(bsc_v2, 'CACHE_SIZE', 0):
+            extension = bsc_v2.ColumnExtension()
+        self.assertIsNone(extension.cache)
+        self.assertFalse(extension.progressive)
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = bsc_v2.MetadataCache(os.path.join(self.directory.name, 'metadata.sqlite'), max_entries=2)
+        self.filename = os.path.join(self.directory.name, 'file.mp3')
+        with open(self.filename, 'w') as f:
+            f.write('content')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_cached_columns(self):
+        stamp = self.cache.stamp(self.filename)
+        self.assertIsNone(self.cache.get(self.filename, stamp))
+        self.cache.put(self.filename, stamp, {'title': 'Galway'})
+        self.assertEqual(self.cache.get(self.filename, stamp), {'title': 'Galway'})
+
+    def test_changed_file_is_invalidated(self):
+        self.cache.put(self.filename, self.cache.stamp(self.filename), {'title': 'Galway'})
+        with open(self.filename, 'a') as f:
+            f.write('more content')
+        self.assertIsNone(self.cache.get(self.filename, self.cache.stamp(self.filename)))
+
+    def test_evict_least_recently_used(self):
+        stamp = self.cache.stamp(self.filename)
+        for name in ['a', 'b', 'c']:
+            self.cache.put(name, stamp, {})
+        self.cache.get('a', stamp)
+        self.cache.evict()
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.indexed(), 2, 'The index entry should be evicted too.')
+        self.assertIsNone(self.cache.get('b', stamp), 'Least recently used entry should be evicted.')
+
+    def test_no_write_ahead_log_on_network_filesystem(self):
+        path = self.cache.path
+        self.cache.connection.close()
+        os.remove(path)
+        mount = bsc_v2.Mount(self.directory.name, 'nfs4', 'server:/export', '0:46')
+        mount.kind = 'network'
+        with mock.patch.object(bsc_v2.Mounts, 'for_path', return_value=mount):
+            self.cache = bsc_v2.MetadataCache(path)
+        self.assertEqual(self.cache.connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_other_extractor_version_is_invalidated(self):
+        stamp = self.cache.stamp(self.filename)
+        self.cache.put(self.filename, stamp, {'title': 'Galway'})
+        path = self.cache.path
+        self.cache.connection.close()
+        with mock.patch.object(bsc_v2, 'EXTRACTOR_VERSION', bsc_v2.EXTRACTOR_VERSION + 1):
+            self.cache = bsc_v2.MetadataCache(path)
+        self.assertIsNone(self.cache.get(self.filename, stamp))
+        self.assertEqual(self.cache.indexed(), 0)
+
+    def test_remember_failures(self):
+        stamp = self.cache.stamp(self.filename)
+        self.cache.put_failures(self.filename, stamp, {'mediainfo': 'ExtractionTimeout'})
+        self.assertEqual(self.cache.failed(self.filename, stamp), {'mediainfo'})
+        self.assertEqual(self.cache.failed(self.filename, stamp, retry=0), set(), 'Expired failures should be retried.')
+        with open(self.filename, 'a') as f:
+            f.write('more content')
+        self.assertEqual(self.cache.failed(self.filename, self.cache.stamp(self.filename)), set(),
+                         'Changed files should be retried.')
+
+
+class TestMetadataIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = bsc_v2.MetadataCache(os.path.join(self.directory.name, 'metadata.sqlite'))
+        self.files = {}
+        for name, columns in [('Videos/long.mkv', {'duration': '01:02:03', 'width': '1920', 'format': 'Matroska'}),
+                              ('Videos/short.mkv', {'duration': '00:00:42', 'width': '1280', 'format': 'Matroska'}),
+                              ('Photos/dsc.jpg', {'iso_speed': '400', 'exposure_time': '1/320',
+                                                  'model': 'Canon EOS 70D'}),
+                              ('Photos/error.jpg', {'iso_speed': 'Error', 'model': 'Error'})]:
+            filename = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            open(filename, 'w').close()
+            self.cache.put(filename, self.cache.stamp(filename), columns)
+            self.files[name] = filename
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @parameterized.expand([
+        ('duration', '01:02:03', 3723.0),
+        ('duration', '42.5', 42.5),
+        ('bitrate', '128 Kbps', 128),
+        ('tracknumber', '3/12', 3),
+        ('exposure_time', '1/320', 1 / 320),
+        ('fnumber', 'f/2.8', 2.8),
+        ('gps_altitude', '-12.5', -12.5),
+        ('iso_speed', 'Error', None),
+        ('model', 'Canon EOS 70D', 'Canon EOS 70D'),
+        ('model', '', None),
+    ])
+    def test_index_value(self, field, value, expected):
+        self.assertEqual(bsc_v2.index_value(field, value), expected)
+
+    def test_range_query(self):
+        results = self.cache.query([bsc_v2.parse_condition('duration>=00:10:00')], fields=['duration', 'width'])
+        self.assertEqual(results, [(self.files['Videos/long.mkv'], (3723.0, 1920))])
+        results = self.cache.query([bsc_v2.parse_condition('iso_speed<=400'),
+                                    bsc_v2.parse_condition('exposure_time<0.01')])
+        self.assertEqual([path for path, _values in results], [self.files['Photos/dsc.jpg']])
+
+    def test_text_query(self):
+        results = self.cache.query([bsc_v2.parse_condition('model~canon')])
+        self.assertEqual([path for path, _values in results], [self.files['Photos/dsc.jpg']],
+                         'Errors should not be indexed.')
+        self.assertEqual(len(self.cache.query([bsc_v2.parse_condition('format=Matroska')])), 2)
+
+    def test_query_directory_tree(self):
+        results = self.cache.query([], directory=os.path.join(self.directory.name, 'Videos'))
+        self.assertEqual([path for path, _values in results],
+                         [self.files['Videos/long.mkv'], self.files['Videos/short.mkv']])
+        self.assertEqual(self.cache.query([], directory=os.path.join(self.directory.name, 'Vid')), [])
+
+    def test_query_after_file_changes(self):
+        filename = self.files['Videos/long.mkv']
+        with open(filename, 'w') as f:
+            f.write('re-encoded')
+        self.assertEqual(self.cache.query([bsc_v2.parse_condition('duration>=00:10:00')]), [],
+                         'A changed file should not be found by its old values.')
+        self.assertIsNone(self.cache.get(filename, self.cache.stamp(filename)))
+        self.assertEqual(self.cache.indexed(), 3, 'The index entry of the changed file should be deleted.')
+
+    def test_reindex(self):
+        self.cache.connection.execute('DELETE FROM metadata')
+        self.assertEqual(self.cache.reindex(), 4)
+        self.assertEqual(self.cache.indexed(), 4)
+
+    def test_invalid_condition(self):
+        for condition in ['duration', 'unknown=1', 'width>wide']:
+            with self.assertRaises(ValueError):
+                bsc_v2.parse_condition(condition)
+
+    def test_query_command(self):
+        with mock.patch.object(bsc_v2.MetadataCache, 'open_default', return_value=self.cache), \
+                mock.patch('builtins.print') as print_:
+            self.assertEqual(bsc_v2.main(['query', 'width>1000', '--directory', self.directory.name,
+                                          '--show', 'duration,width']), 0)
+        self.assertEqual([c.args[0] for c in print_.call_args_list],
+                         [f"{self.files['Videos/long.mkv']}\t01:02:03\t1920",
+                          f"{self.files['Videos/short.mkv']}\t00:00:42\t1280"])
+
+
+class TestColumnValues(unittest.TestCase):
+    def test_store_non_empty_values(self):
+        columns = bsc_v2.ColumnValues({'title': 'Galway', 'album': '', 'pages': '2'}, extractors=['pdf'])
+        self.assertEqual(columns, {'title': 'Galway', 'pages': '2'})
+        columns['title'] = ''
+        columns['unknown'] = 'dropped'
+        self.assertEqual(dict(columns), {'pages': '2'})
+        self.assertEqual(columns.get('title', ''), '')
+
+    def test_share_values_between_files(self):
+        first = bsc_v2.ColumnValues({'model': ''.join(['Canon ', 'EOS 70D'])}, extractors=['image'])
+        second = bsc_v2.ColumnValues({'model': ''.join(['Canon EOS', ' 70D'])}, extractors=['image'])
+        self.assertIs(first['model'], second['model'])
+        self.assertIs(first.extractors, second.extractors)
+
+    def test_pickle(self):
+        columns = bsc_v2.ColumnValues({'title': 'Galway'}, extractors=['audio'])
+        columns.fail('mediainfo', 'ExtractionTimeout')
+        unpickled = pickle.loads(pickle.dumps(columns))
+        self.assertEqual(unpickled, columns)
+        self.assertIs(unpickled.extractors, columns.extractors)
+        self.assertEqual(unpickled.failed, {'mediainfo': 'ExtractionTimeout'})
+
+
+class TestIOScheduler(unittest.TestCase):
+    MOUNTINFO = [
+        '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw',
+        '40 22 0:45 / /media/nas rw,relatime shared:20 - cifs //nas/share rw,vers=3.0',
+        '41 22 0:46 / /media/my\\040disk rw,relatime shared:21 - nfs4 server:/export rw',
+    ]
+
+    def test_mount_for_path(self):
+        mounts = bsc_v2.Mounts(self.MOUNTINFO)
+        self.assertEqual(mounts.for_path('/media/nas/movie.mkv').mount_point, '/media/nas')
+        self.assertEqual(mounts.for_path('/media/nas/movie.mkv').kind, 'network')
+        self.assertEqual(mounts.for_path('/media/my disk/movie.mkv').kind, 'network')
+        self.assertEqual(mounts.for_path('/media/nasty/movie.mkv').mount_point, '/')
+
+    def test_parse_concurrency(self):
+        concurrency = bsc_v2.parse_concurrency('network=2,/media/nas=8,rotational')
+        self.assertEqual((concurrency['network'], concurrency['/media/nas']), (2, 8))
+        self.assertEqual(concurrency['rotational'], bsc_v2.WORKERS)
+
+    def test_back_off_when_latency_rises(self):
+        queue = bsc_v2.MountQueue(bsc_v2.Mount('/media/nas', 'cifs', '//nas/share', '0:45'), max_limit=8)
+        for _i in range(100):
+            queue.done(0.01)
+        self.assertEqual(queue.limit, 8)
+        queue.done(0.5)
+        self.assertEqual(queue.limit, 4)
+        for _i in range(8):
+            queue.done(0.5)
+        self.assertEqual(queue.limit, 1)
+        for _i in range(200):
+            queue.done(0.01)
+        self.assertEqual(queue.limit, 8, 'The limit should recover when the latency drops.')
+
+    def test_latency_per_phase(self):
+        queue = bsc_v2.MountQueue(bsc_v2.Mount('/media/nas', 'cifs', '//nas/share', '0:45'), max_limit=8)
+        for _i in range(100):
+            queue.done(0.01)
+        for _i in range(8):
+            queue.done(2.0, 'slow')
+            queue.done(0.01)
+        self.assertEqual(queue.limit, 8, 'A slow phase should not look like a saturated mount.')
+
+    def test_batch_takes_one_slot(self):
+        queue = bsc_v2.MountQueue(bsc_v2.Mount('/media/nas', 'cifs', '//nas/share', '0:45'), max_limit=2,
+                                  batch_size=4)
+        for i in range(6):
+            queue.push(f'/media/nas/{i}.mkv', i, batched=True)
+        queue.push('/media/nas/fast.mkv', 'fast')
+        started = []
+        job = queue.start()
+        while job is not None:
+            started.append(job)
+            job = queue.start()
+        self.assertEqual(started, [(i, True) for i in range(6)], 'Six batched jobs should fit in two batches.')
+        queue.finish(True)
+        queue.finish(True)
+        self.assertEqual(queue.start(), ('fast', False))
+
+    def test_limit_concurrency_per_mount(self):
+        executor = ThreadPoolExecutor(max_workers=4)
+        scheduler = bsc_v2.IOScheduler(executor, bsc_v2.Mounts(self.MOUNTINFO), {'network': 1, 'local': 4})
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def extract():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        futures = [scheduler.submit(f'/media/nas/{i}.mkv', extract) for i in range(5)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(peak[0], 1)
+        executor.shutdown()
+
+    def test_rotational_order_without_io(self):
+        queue = bsc_v2.MountQueue(bsc_v2.Mount('/', 'ext4', '/dev/sda1', '8:1'), max_limit=1)
+        queue.mount.kind = 'rotational'
+        with mock.patch.object(bsc_v2.os, 'stat') as stat:
+            for filename in ['/b/2.mkv', '/a/1.mkv', '/b/1.mkv']:
+                queue.push(filename, filename)
+        stat.assert_not_called()
+        self.assertEqual([queue.pop() for _i in range(3)], ['/a/1.mkv', '/b/1.mkv', '/b/2.mkv'])
+
+    def test_cancel_queued_file(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        scheduler = bsc_v2.IOScheduler(executor, bsc_v2.Mounts(self.MOUNTINFO), {'network': 1})
+        release = threading.Event()
+        first = scheduler.submit('/media/nas/1.mkv', release.wait, 5)
+        second = scheduler.submit('/media/nas/2.mkv', mock.Mock())
+        self.assertTrue(second.cancel())
+        release.set()
+        self.assertTrue(first.result(5))
+        executor.shutdown()
+
+
+class TestMemoryCache(unittest.TestCase):
+    def setUp(self):
+        self.memory = bsc_v2.MemoryCache(max_entries=2)
+        self.extract = mock.Mock(return_value=bsc_v2.ColumnValues({'pages': '2'}, extractors=['pdf']))
+
+    def test_get_extracted_columns(self):
+        with mock.patch.object(bsc_v2, 'stats', bsc_v2.ExtractionStats(enabled=True)) as stats:
+            first = self.memory.get(('file:///a.pdf', 1, 2), ['pdf'], self.extract)
+            second = self.memory.get(('file:///a.pdf', 1, 2), ['pdf'], self.extract)
+        self.assertIs(first, second)
+        self.extract.assert_called_once()
+        counters = stats.snapshot()['counters']
+        self.assertEqual((counters['memory_hits'], counters['memory_misses']), (1, 1))
+
+    def test_changed_file_is_extracted_again(self):
+        self.memory.get(('file:///a.pdf', 1, 2), ['pdf'], self.extract)
+        self.memory.get(('file:///a.pdf', 3, 2), ['pdf'], self.extract)
+        self.assertEqual(self.extract.call_count, 2)
+
+    def test_extract_missing_extractors(self):
+        self.memory.get(('file:///a.jpg', 1, 2), ['pdf'], self.extract)
+        self.memory.get(('file:///a.jpg', 1, 2), ['pdf', 'image'], self.extract)
+        self.assertEqual(self.extract.call_count, 2)
+
+    def test_evict_least_recently_used(self):
+        for uri in ['file:///a.pdf', 'file:///b.pdf', 'file:///a.pdf', 'file:///c.pdf']:
+            self.memory.get((uri, 1, 2), ['pdf'], self.extract)
+        self.assertEqual(len(self.memory), 2)
+        self.assertEqual(list(self.memory.entries), [('file:///a.pdf', 1, 2), ('file:///c.pdf', 1, 2)])
+
+    def test_coalesce_concurrent_requests(self):
+        started, release = threading.Event(), threading.Event()
+
+        def extract():
+            started.set()
+            release.wait(5)
+            return bsc_v2.ColumnValues({'pages': '2'}, extractors=['pdf'])
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        first = executor.submit(self.memory.get, ('file:///a.pdf', 1, 2), ['pdf'], extract)
+        started.wait(5)
+        second = executor.submit(self.memory.get, ('file:///a.pdf', 1, 2), ['pdf'], self.extract)
+        release.set()
+        self.assertIs(first.result(5), second.result(5))
+        self.extract.assert_not_called()
+        executor.shutdown()
+
+
+class TestXattrStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'file.mp3')
+        with open(self.filename, 'w') as f:
+            f.write('content')
+        self.xattrs = bsc_v2.XattrStore()
+        self.stamp = bsc_v2.MetadataCache.stamp(self.filename)
+        try:
+            os.setxattr(self.filename, 'user.test', b'')
+        except (AttributeError, OSError):
+            self.skipTest('No user extended attributes on this filesystem.')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_stored_columns(self):
+        self.assertIsNone(self.xattrs.get(self.filename, self.stamp))
+        self.xattrs.put(self.filename, self.stamp, bsc_v2.ColumnValues({'title': 'Galway'}, extractors=['audio']))
+        columns = self.xattrs.get(self.filename, self.stamp)
+        self.assertEqual(columns, {'title': 'Galway'})
+        self.assertEqual(columns.extractors, {'audio'})
+
+    def test_changed_file_is_invalidated(self):
+        self.xattrs.put(self.filename, self.stamp, bsc_v2.ColumnValues({'title': 'Galway'}, extractors=['audio']))
+        with open(self.filename, 'a') as f:
+            f.write('more content')
+        self.assertIsNone(self.xattrs.get(self.filename, bsc_v2.MetadataCache.stamp(self.filename)))
+
+    def test_other_extractor_version_is_invalidated(self):
+        self.xattrs.put(self.filename, self.stamp, bsc_v2.ColumnValues({'title': 'Galway'}, extractors=['audio']))
+        with mock.patch.object(bsc_v2, 'EXTRACTOR_VERSION', bsc_v2.EXTRACTOR_VERSION + 1):
+            self.assertIsNone(self.xattrs.get(self.filename, self.stamp))
+
+    def test_skip_unsupported_filesystem(self):
+        with mock.patch('os.getxattr', side_effect=OSError(errno.ENOTSUP, 'Operation not supported')) as getxattr:
+            self.assertIsNone(self.xattrs.get(self.filename, self.stamp))
+            self.assertIsNone(self.xattrs.get(self.filename, self.stamp))
+        self.assertEqual(getxattr.call_count, 1)
+
+
+class TestTimeout(unittest.TestCase):
+    SLOW = {'name': 'slow', 'extract': lambda file, filename: time.sleep(1), 'fields': ['title', 'pages']}
+    FAST = {'name': 'fast', 'extract': lambda file, filename: file.add_string_attribute('title', 'Galway'),
+            'fields': ['title']}
+
+    def test_abandon_slow_extractor(self):
+        with self.assertRaises(bsc_v2.ExtractionTimeout):
+            bsc_v2.run_extractor(self.SLOW, bsc_v2.ColumnValues(), 'file.pdf', timeout=0.01)
+
+    def test_columns_of_failed_extractor(self):
+        with mock.patch.object(bsc_v2, 'TIMEOUT', 0.1), \
+                mock.patch.object(bsc_v2, 'extractors_for', return_value=[self.FAST, self.SLOW]):
+            columns = bsc_v2.extract_columns('file.pdf', 'application/pdf')
+        self.assertEqual(columns, {'title': 'Galway', 'pages': 'Error'})
+        self.assertEqual(columns.extractors, {'fast'})
+        self.assertEqual(list(columns.failed), ['slow'])
+
+    def test_errors_are_failures(self):
+        with mock.patch.object(bsc_v2, 'read_media_info', side_effect=IOError('mediainfo not found.')):
+            columns = bsc_v2.extract_columns('resources/gs-16b-2c-44100hz.mp4', 'video/mp4')
+        self.assertEqual(columns.extractors, set())
+        self.assertEqual(columns.failed, {'mediainfo': 'OSError: mediainfo not found.'})
+        self.assertEqual(columns['duration'], 'Error')
+
+    def test_skip_failed_extractor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            extension = bsc_v2.ColumnExtension()
+            extension.cache = bsc_v2.MetadataCache(os.path.join(directory, 'metadata.sqlite'))
+            stamp = extension.cache.stamp('resources/sample.pdf')
+            extension.cache.put_failures('resources/sample.pdf', stamp,
+                                         {'pdf': 'ExtractionTimeout', 'pdf_pages': 'ExtractionTimeout'})
+            with mock.patch.object(bsc_v2, 'run_extractor') as run_extractor:
+                columns = extension.columns_for('resources/sample.pdf', 'application/pdf')
+            run_extractor.assert_not_called()
+            self.assertEqual(columns['pages'], 'Error')
+
+
+    def test_unreadable_image_is_failure(self):
+        with self.assertRaises(OSError):
+            bsc_v2.extract_image(bsc_v2.ColumnValues(), 'resources/missing.jpg')
+
+
+class TestParserPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = bsc_v2.ParserPool(workers=1)
+        self.addCleanup(lambda: self.pool.executor is not None and self.pool.kill(self.pool.executor))
+
+    def test_parse_in_other_process(self):
+        self.assertNotEqual(self.pool.run(os.getpid), os.getpid())
+
+    def test_kill_parser_that_times_out(self):
+        pid = self.pool.run(os.getpid)
+        with mock.patch.object(bsc_v2, 'TIMEOUT', 0.5), self.assertRaises(bsc_v2.ExtractionTimeout):
+            self.pool.run(time.sleep, 30)
+        self.assertNotEqual(self.pool.run(os.getpid), pid)
+
+    def test_parse_in_process_without_workers(self):
+        self.assertEqual(bsc_v2.ParserPool(workers=0).run(os.getpid), os.getpid())
+
+
+class TestDeduplicate(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open('resources/sample.pdf', 'rb') as f:
+            content = f.read()
+        self.copies = [os.path.join(self.directory.name, name) for name in ['sample.pdf', 'backup/sample-copy.pdf']]
+        for filename in self.copies:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fingerprint(self, filename, mime_type='application/pdf'):
+        return bsc_v2.content_fingerprint(filename, mime_type, os.path.getsize(filename))
+
+    def test_fingerprint(self):
+        self.assertEqual(self.fingerprint(self.copies[0]), self.fingerprint(self.copies[1]))
+        self.assertNotEqual(self.fingerprint(self.copies[0]), self.fingerprint(self.copies[0], 'text/plain'))
+        with open(self.copies[1], 'ab') as f:
+            f.write(b'%%EOF\n')
+        self.assertNotEqual(self.fingerprint(self.copies[0]), self.fingerprint(self.copies[1]))
+
+    def test_copy_reuses_extraction(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.cache = bsc_v2.MetadataCache(os.path.join(self.directory.name, 'metadata.sqlite'))
+        with mock.patch.object(bsc_v2, 'stats', bsc_v2.ExtractionStats(enabled=True)) as stats:
+            original = extension.columns_for(self.copies[0], 'application/pdf')
+            with mock.patch.object(bsc_v2, 'run_extractor') as run_extractor:
+                copy = extension.columns_for(self.copies[1], 'application/pdf')
+            run_extractor.assert_not_called()
+        self.assertEqual(copy, original)
+        self.assertEqual(extension.cache.get(self.copies[1], extension.cache.stamp(self.copies[1])), original)
+        counters = stats.snapshot()['counters']
+        self.assertEqual((counters['dedupe_misses'], counters['dedupe_hits']), (1, 1))
+        self.assertEqual(stats.snapshot()['hit_rates']['dedupe'], 0.5)
+
+    def test_copy_does_not_reuse_errors(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.cache = bsc_v2.MetadataCache(os.path.join(self.directory.name, 'metadata.sqlite'))
+        run_extractor = bsc_v2.run_extractor
+
+        def fail_pdf(extractor, file, filename, timeout=None):
+            if extractor['name'] == 'pdf':
+                raise bsc_v2.ExtractionTimeout()
+            run_extractor(extractor, file, filename, timeout)
+
+        with mock.patch.object(bsc_v2, 'run_extractor', side_effect=fail_pdf):
+            original = extension.columns_for(self.copies[0], 'application/pdf')
+        self.assertEqual(original['title'], 'Error')
+        copy = extension.columns_for(self.copies[1], 'application/pdf', ['pdf_pages'])
+        self.assertNotIn('title', copy, 'The error of the copy should not be reused.')
+        self.assertEqual(copy['pages'], '2')
+        copy = extension.columns_for(self.copies[1], 'application/pdf')
+        self.assertEqual(copy['title'], 'This is the Title')
+
+    def test_skip_files_without_extractors(self):
+        extension = bsc_v2.ColumnExtension()
+        extension.cache = mock.Mock()
+        self.assertEqual(extension.columns_for(self.copies[0], 'text/plain'), {})
+        extension.cache.assert_not_called()
+        self.assertEqual(extension.cache.method_calls, [])
+
+
+class TestMediaInfoBatcher(unittest.TestCase):
+    FILES = ['resources/gs-16b-2c-44100hz.mp4', 'resources/gs-16b-2c-44100hz.wma']
+
+    @staticmethod
+    def fake_run(paths):
+        return [{'media': {'@ref': path, 'track': [{'@type': 'General', 'Format': os.path.basename(path)}]}}
+                for path in paths]
+
+    def test_single_mediainfo_process_per_batch(self):
+        batcher = bsc_v2.MediaInfoBatcher(window=10, max_size=len(self.FILES))
+        with mock.patch.object(bsc_v2.MediaInfo, 'run', side_effect=self.fake_run) as run:
+            futures = [batcher.submit(file) for file in self.FILES]
+            results = [future.result(timeout=1) for future in futures]
+        run.assert_called_once()
+        self.assertEqual([r.get('Format') for r in results], [os.path.basename(f) for f in self.FILES])
+
+    def test_batch_is_flushed_after_window(self):
+        batcher = bsc_v2.MediaInfoBatcher(window=0.01, max_size=100)
+        with mock.patch.object(bsc_v2.MediaInfo, 'run', side_effect=self.fake_run):
+            result = batcher.get(self.FILES[0])
+        self.assertEqual(result.get('Format'), os.path.basename(self.FILES[0]))
+
+    def test_limit_memory_of_mediainfo(self):
+        process = mock.Mock(pid=1234, returncode=0)
+        process.communicate.return_value = (b'{"media": {"@ref": "a.mkv", "track": []}}', b'')
+        plumbum = mock.Mock(local={'mediainfo': mock.Mock(**{'popen.return_value': process})})
+        with mock.patch.dict(sys.modules, {'plumbum': plumbum}), \
+                mock.patch.object(bsc_v2, 'limit_memory') as limit_memory:
+            self.assertEqual(bsc_v2.MediaInfo.run(['a.mkv']), [{'media': {'@ref': 'a.mkv', 'track': []}}])
+        limit_memory.assert_called_once_with(1234)
+        self.assertNotIn('preexec_fn', plumbum.local['mediainfo'].popen.call_args[1])
+
+    def test_failed_batch_is_retried_per_file(self):
+        corrupt = os.path.abspath(self.FILES[1])
+
+        def run(paths):
+            if corrupt in paths:
+                raise IOError('mediainfo timed out.')
+            return self.fake_run(paths)
+
+        batcher = bsc_v2.MediaInfoBatcher(window=10, max_size=len(self.FILES))
+        with mock.patch.object(bsc_v2.MediaInfo, 'run', side_effect=run) as run_mock:
+            futures = [batcher.submit(file) for file in self.FILES]
+            self.assertEqual(futures[0].result(timeout=1).get('Format'), os.path.basename(self.FILES[0]))
+            with self.assertRaises(IOError):
+                futures[1].result(timeout=1)
+        self.assertEqual(run_mock.call_count, 3)
+
+    def test_failed_batch_is_retried_in_parallel(self):
+        # Both files are analysed again at the same time, or the barrier times out.
+        retries = threading.Barrier(len(self.FILES), timeout=1)
+
+        def run(paths):
+            if len(paths) > 1:
+                raise IOError('mediainfo timed out.')
+            retries.wait()
+            return self.fake_run(paths)
+
+        batcher = bsc_v2.MediaInfoBatcher(window=10, max_size=len(self.FILES))
+        with mock.patch.object(bsc_v2.MediaInfo, 'run', side_effect=run):
+            futures = [batcher.submit(file) for file in self.FILES]
+            self.assertEqual([future.result(timeout=2).get('Format') for future in futures],
+                             [os.path.basename(file) for file in self.FILES])
+
+    def test_timeout_of_batch(self):
+        process = mock.Mock(pid=1234, returncode=0)
+        process.communicate.return_value = (b'[]', b'')
+        plumbum = mock.Mock(local={'mediainfo': mock.Mock(**{'popen.return_value': process})})
+        with mock.patch.dict(sys.modules, {'plumbum': plumbum}), mock.patch.object(bsc_v2, 'limit_memory'):
+            bsc_v2.MediaInfo.run(['a.mkv', 'b.mkv', 'c.mkv'])
+        self.assertEqual(process.communicate.call_args[1]['timeout'], bsc_v2.TIMEOUT)
+
+
+class TestMediaHeader(unittest.TestCase):
+    @parameterized.expand([
+        ['video-MP4', 'resources/gs-16b-2c-44100hz.mp4', {'Format': 'MPEG-4', 'Duration': '15.856', 'OverallBitRate': '130860', 'FrameCount': '683', 'AudioFormat': 'AAC'}],
+        ['audio-WMA', 'resources/gs-16b-2c-44100hz.wma', {'Format': 'Windows Media', 'Duration': '15.835', 'OverallBitRate': '139387', 'BitDepth': '16', 'AudioFormat': 'WMA'}],
+    ])
+    def test_parse_media_header(self, testname, file, expected):
+        mediainfo = bsc_v2.MediaInfo(file, bsc_v2.parse_media_header(file))
+        self.assertEqual({key: mediainfo.get(key) for key in expected}, expected)
+
+    def test_unknown_container(self):
+        self.assertIsNone(bsc_v2.parse_media_header('resources/gs-16b-2c-44100hz.mp3'))
+
+    @staticmethod
+    def ebml(element_id, *children):
+        payload = b''.join(children)
+        # Sizes are written in 8 bytes, the longest form.
+        return (element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + b'\x01' +
+                len(payload).to_bytes(7, 'big') + payload)
+
+    @classmethod
+    def ebml_uint(cls, element_id, value):
+        return cls.ebml(element_id, value.to_bytes(4, 'big'))
+
+    def parse(self, content):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            return bsc_v2.MediaInfo(f.name, bsc_v2.parse_media_header(f.name))
+
+    def test_matroska(self):
+        ebml = self.ebml
+        header = ebml(0x1A45DFA3, ebml(0x4282, b'matroska'))
+        info = ebml(0x1549A966, self.ebml_uint(0x2AD7B1, 1000000), ebml(0x4489, struct.pack('>d', 15000.0)))
+        tracks = ebml(0x1654AE6B,
+                      ebml(0xAE, self.ebml_uint(0x83, 1), self.ebml_uint(0x73C5, 7), ebml(0x86, b'V_MPEG4/ISO/AVC'),
+                           ebml(0xE0, self.ebml_uint(0xB0, 1280), self.ebml_uint(0xBA, 720))),
+                      ebml(0xAE, self.ebml_uint(0x83, 2), self.ebml_uint(0x73C5, 8), ebml(0x86, b'A_AAC')))
+        cluster = ebml(0x1F43B675, b'\x00' * 1000)
+        tags = ebml(0x1254C367, ebml(0x7373, ebml(0x63C0, self.ebml_uint(0x63C5, 7)),
+                                     ebml(0x67C8, ebml(0x45A3, b'NUMBER_OF_FRAMES'), ebml(0x4487, b'375'))))
+
+        # The tags follow the clusters, and are found through the SeekHead.
+        def seek_head(position):
+            return ebml(0x114D9B74, ebml(0x4DBB, ebml(0x53AB, b'\x12\x54\xc3\x67'), self.ebml_uint(0x53AC, position)))
+        position = len(seek_head(0) + info + tracks + cluster)
+        segment = ebml(0x18538067, seek_head(position), info, tracks, cluster, tags)
+
+        mediainfo = self.parse(header + segment)
+        self.assertEqual({key: mediainfo.get(key) for key in ['Format', 'Duration', 'FrameCount', 'VideoFormat',
+                                                              'Width', 'Height', 'AudioFormat']},
+                         {'Format': 'Matroska', 'Duration': '15.000', 'FrameCount': '375', 'VideoFormat': 'AVC',
+                          'Width': '1280', 'Height': '720', 'AudioFormat': 'AAC'})
+
+    def test_corrupt_matroska(self):
+        header = self.ebml(0x1A45DFA3, self.ebml(0x4282, b'matroska'))
+        # A zero byte where the size of the EBML header or the id of the segment should be.
+        for content in [b'\x1a\x45\xdf\xa3' + b'\x00' * 16, header + b'\x00' * 16]:
+            with self.subTest(content=content[:8]), self.assertRaises(ValueError):
+                self.parse(content)
+
+    def test_corrupt_asf(self):
+        # A header object with a size of 0, of an ASF header claiming the maximum number of objects.
+        objects = b'\x00' * 2 + b'\x00' * 16 + struct.pack('<Q', 0)
+        header = bsc_v2.ASF_HEADER.bytes_le + struct.pack('<QI', 28 + len(objects), 0xFFFFFFFF)
+        with self.assertRaises(ValueError):
+            self.parse(header + objects)
+
+    def test_wave(self):
+        fmt = struct.pack('<HHIIHH', 0x0001, 2, 44100, 176400, 4, 16)
+        data = b'\x00' * 17640
+        chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+        mediainfo = self.parse(b'RIFF' + struct.pack('<I', len(chunks) + 4) + b'WAVE' + chunks)
+        self.assertEqual({key: mediainfo.get(key) for key in ['Format', 'Duration', 'AudioFormat', 'BitDepth']},
+                         {'Format': 'Wave', 'Duration': '0.100', 'AudioFormat': 'PCM', 'BitDepth': '16'})
+
+    def test_flac(self):
+        # Sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1 (5 bits) and total samples (36 bits).
+        packed = (44100 << 44) | (1 << 41) | (15 << 36) | 441000
+        streaminfo = b'\x10\x00\x10\x00' + b'\x00' * 6 + packed.to_bytes(8, 'big') + b'\x00' * 16
+        mediainfo = self.parse(b'fLaC' + b'\x80' + len(streaminfo).to_bytes(3, 'big') + streaminfo)
+        self.assertEqual({key: mediainfo.get(key) for key in ['Format', 'Duration', 'AudioFormat', 'BitDepth']},
+                         {'Format': 'FLAC', 'Duration': '10.000', 'AudioFormat': 'FLAC', 'BitDepth': '16'})
+
+
+class TestPrewarm(unittest.TestCase):
+    def test_skip_cached_file(self):
+        self.assertIsNone(bsc_v2.prewarm_file('resources/sample.pdf', {'pdf', 'pdf_pages'}))
+
+    def test_extract_missing_extractors(self):
+        columns = bsc_v2.prewarm_file('resources/CanonEOS70D.jpg', set())
+        self.assertEqual(columns.extractors, {'image'})
+        self.assertEqual((columns['width'], columns['height']), ('8', '8'))
+
+    def test_deduplicate_copies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = bsc_v2.MetadataCache(os.path.join(directory, 'metadata.sqlite'))
+            copy = os.path.join(directory, 'copy.pdf')
+            with open('resources/sample.pdf', 'rb') as source, open(copy, 'wb') as f:
+                f.write(source.read())
+            original = os.path.abspath('resources/sample.pdf')
+            cache.put(original, cache.stamp(original),
+                      bsc_v2.ColumnValues({'pages': '2'}, extractors=['pdf', 'pdf_pages']),
+                      bsc_v2.content_fingerprint(original, 'application/pdf', os.path.getsize(original)))
+            prewarmer = bsc_v2.Prewarmer(cache, workers=1)
+            prewarmer.executor = mock.Mock()
+            with mock.patch.object(bsc_v2, 'content_type', return_value='application/pdf'):
+                prewarmer.submit(copy)
+            self.assertEqual(cache.get(copy, cache.stamp(copy)), {'pages': '2'})
+            self.assertEqual(prewarmer.counts['deduplicated'], 1)
+            self.assertEqual(prewarmer.executor.submit.call_args[0][2], {'pdf', 'pdf_pages'})
+
+    def test_file_that_kills_its_worker_is_failure(self):
+        futures = []
+
+        def executor(*args, **kwargs):
+            executor = mock.Mock()
+            executor.submit.side_effect = lambda *args: futures.append(Future()) or futures[-1]
+            return executor
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = bsc_v2.MetadataCache(os.path.join(directory, 'metadata.sqlite'))
+            filename = os.path.abspath('resources/sample.pdf')
+            with mock.patch.object(bsc_v2, 'ProcessPoolExecutor', side_effect=executor), \
+                    mock.patch.object(bsc_v2, 'content_type', return_value='application/pdf'):
+                prewarmer = bsc_v2.Prewarmer(cache, workers=1)
+                broken = prewarmer.executor
+                prewarmer.submit(filename)
+                futures[0].set_exception(BrokenProcessPool('A process in the process pool was terminated.'))
+                # The pool is replaced, and the file is extracted once more in a process of its own.
+                self.assertIsNot(prewarmer.executor, broken)
+                self.assertEqual(len(futures), 2)
+                futures[1].set_exception(BrokenProcessPool('A process in the process pool was terminated.'))
+            self.assertEqual(cache.failed(filename, cache.stamp(filename)), {'pdf', 'pdf_pages'})
+            self.assertEqual(prewarmer.counts['failed'], 1)
+            self.assertEqual(prewarmer.retries, set())
+            # The queue is released.
+            self.assertTrue(all(prewarmer.queue.acquire(blocking=False) for _i in range(4)))
+
+    def test_skip_files_without_extractors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = bsc_v2.MetadataCache(os.path.join(directory, 'metadata.sqlite'))
+            prewarmer = bsc_v2.Prewarmer(cache, workers=1)
+            prewarmer.executor = mock.Mock()
+            with mock.patch.object(bsc_v2, 'content_type', return_value='text/plain'):
+                prewarmer.submit(os.path.abspath(__file__))
+            prewarmer.executor.submit.assert_not_called()
+            self.assertEqual(len(cache), 0)
+
+
+class TestStartup(unittest.TestCase):
+    # Modules only needed once a file of their mime type is shown.
+    HEAVY_MODULES = ['gi.repository.GExiv2', 'mutagen', 'PIL', 'PyPDF2', 'plumbum']
+
+    def test_import_time(self):
+        # Import in a new interpreter, the modules of the other tests are already loaded in this one. The bindings of
+        # Nautilus are imported first, they are loaded anyway when Nautilus loads the extension.
+        script = ('import sys, time\n'
+                  'from gi.repository import Nautilus, GObject, GLib, Gio\n'
+                  'baseline = set(sys.modules)\n'
+                  'start = time.perf_counter()\n'
+                  'import bsc_v2\n'
+                  'print(time.perf_counter() - start)\n'
+                  f'print(",".join(m for m in {self.HEAVY_MODULES!r} if m in sys.modules and m not in baseline))\n')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script], env=env, universal_newlines=True)
+        # The module may print warnings, e.g. when there is no translation for the locale.
+        seconds, loaded = output.splitlines()[-2:]
+        self.assertEqual(loaded, '', 'The extractor libraries should only be imported on first use.')
+        self.assertLess(float(seconds), 0.5)
+
+    def test_filename_from_uri_in_new_interpreter(self):
+        # Nothing else may have imported urllib.parse, like the lazily imported extractor libraries used to.
+        script = ('import bsc_v2\n'
+                  'print(bsc_v2.filename_from_uri("file:///tmp/My%20Music/a+b.mp3"))\n')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script], env=env, universal_newlines=True)
+        self.assertEqual(output.splitlines()[-1], '/tmp/My Music/a+b.mp3', 'A plus is not a space within a uri.')